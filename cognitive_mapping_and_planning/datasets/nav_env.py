@@ -32,14 +32,12 @@ helper functions.
     each building and multiplexes between them as needed.
 """
 
+import hashlib
 import numpy as np
 import os
 import re
 import matplotlib.pyplot as plt
 
-import graph_tool as gt
-import graph_tool.topology
-
 from tensorflow.python.platform import gfile
 import logging
 import src.file_utils as fu
@@ -47,6 +45,7 @@ import src.utils as utils
 import src.graph_utils as gu
 import src.map_utils as mu
 import src.depth_utils as du
+import src.render_cache as rc
 import render.swiftshader_renderer as sru
 from render.swiftshader_renderer import SwiftshaderRenderer
 import cv2
@@ -72,6 +71,7 @@ generate_goal_images             = mu.generate_goal_images
 get_map_to_predict               = mu.get_map_to_predict
 
 bin_points                       = du.bin_points
+PointBinner                      = du.PointBinner
 make_geocentric                  = du.make_geocentric
 get_point_cloud_from_z           = du.get_point_cloud_from_z
 get_camera_matrix                = du.get_camera_matrix
@@ -377,6 +377,7 @@ class Building(GridWorld):
     self.room_dims       = room_dims
     self.flipped         = flip
     self.renderer_entitiy_ids = []
+    self.render_cache    = None
 
     if self.restrict_to_largest_cc:
       self.traversible = pick_largest_cc(self.traversible)
@@ -414,37 +415,80 @@ class Building(GridWorld):
   def set_building_visibility(self, visibility):
     self.r_obj.set_entity_visible(self.renderer_entitiy_ids, visibility)
 
+  def set_render_cache(self, cache_dir, max_size, quanta, camera_param,
+                       writable=False):
+    """Caches the images from render_nodes in a rc.RenderCache, in a
+    subdirectory of cache_dir for this building and camera. Camera poses are
+    snapped to multiples of quanta, in map cells for x and y and in units of
+    task.delta_theta for theta, and keyed by the multiples. Unless writable is
+    set, the cache is only read, since the tasks that share a building would
+    overwrite each other's images."""
+    key = hashlib.md5(repr((
+        camera_param.width, camera_param.height, camera_param.fov,
+        camera_param.z_near, camera_param.z_far, self.robot.sensor_height,
+        self.robot.camera_elevation_degree, self.map.origin.tolist(),
+        self.map.resolution, self.task.delta_theta, list(quanta))))
+    name = '{:s}_{:d}_{:s}_{:s}'.format(self.building_name, int(self.flipped),
+                                        self.r_obj.modality, key.hexdigest())
+    self.render_cache = rc.RenderCache(os.path.join(cache_dir, name), max_size,
+                                       read_only=not writable)
+    self.render_cache_quanta = quanta
+
+  def _render_xyt(self, x, y, theta):
+    r = 2
+    elevation_z = r * np.tan(np.deg2rad(self.robot.camera_elevation_degree))
+    lookat_theta = 3.0 * np.pi / 2.0 - theta * (self.task.delta_theta)
+    nxy = np.array([x, y]).reshape(1, -1)
+    nxy = nxy * self.map.resolution
+    nxy = nxy + self.map.origin
+    camera_xyz = np.zeros((1, 3))
+    camera_xyz[...] = [nxy[0, 0], nxy[0, 1], self.robot.sensor_height]
+    camera_xyz = camera_xyz / 100.
+    lookat_xyz = np.array([-r * np.sin(lookat_theta),
+                           -r * np.cos(lookat_theta), elevation_z])
+    lookat_xyz = lookat_xyz + camera_xyz[0, :]
+    self.r_obj.position_camera(camera_xyz[0, :].tolist(),
+                               lookat_xyz.tolist(), [0.0, 0.0, 1.0])
+    img = self.r_obj.render(take_screenshot=True, output_type=0)
+    img = [im for im in img if im is not None]
+    img = np.concatenate(img, axis=2)
+    return img
+
   def render_nodes(self, nodes, perturb=None, aux_delta_theta=0.):
-    self.set_building_visibility(True)
+    """Renders the views from nodes, with perturbations perturb, after turning
+    by aux_delta_theta. Views are looked up in the render cache first, if one
+    is set, and the building is only made visible if some view is missing."""
     if perturb is None:
       perturb = np.zeros((len(nodes), 4))
 
     imgs = []
-    r = 2
-    elevation_z = r * np.tan(np.deg2rad(self.robot.camera_elevation_degree))
-
+    visible = False
     for i in range(len(nodes)):
       xyt = self.to_actual_xyt(nodes[i])
-      lookat_theta = 3.0 * np.pi / 2.0 - (xyt[2]+perturb[i,2]+aux_delta_theta) * (self.task.delta_theta)
-      nxy = np.array([xyt[0]+perturb[i,0], xyt[1]+perturb[i,1]]).reshape(1, -1)
-      nxy = nxy * self.map.resolution
-      nxy = nxy + self.map.origin
-      camera_xyz = np.zeros((1, 3))
-      camera_xyz[...] = [nxy[0, 0], nxy[0, 1], self.robot.sensor_height]
-      camera_xyz = camera_xyz / 100.
-      lookat_xyz = np.array([-r * np.sin(lookat_theta),
-                             -r * np.cos(lookat_theta), elevation_z])
-      lookat_xyz = lookat_xyz + camera_xyz[0, :]
-      self.r_obj.position_camera(camera_xyz[0, :].tolist(),
-                                 lookat_xyz.tolist(), [0.0, 0.0, 1.0])
-      img = self.r_obj.render(take_screenshot=True, output_type=0)
-      img = [x for x in img if x is not None]
-      img = np.concatenate(img, axis=2).astype(np.float32)
+      x = xyt[0]+perturb[i,0]
+      y = xyt[1]+perturb[i,1]
+      theta = xyt[2]+perturb[i,2]+aux_delta_theta
+      img = None
+      if self.render_cache is not None:
+        q = self.render_cache_quanta
+        key = (int(np.round(x / q[0])), int(np.round(y / q[0])),
+               int(np.round(theta / q[1])))
+        x = key[0]*q[0]; y = key[1]*q[0]; theta = key[2]*q[1];
+        img = self.render_cache.get(key)
+      if img is None:
+        if not visible:
+          self.set_building_visibility(True)
+          visible = True
+        img = self._render_xyt(x, y, theta)
+        if self.render_cache is not None:
+          self.render_cache.put(key, img)
+      img = img.astype(np.float32)
       if perturb[i,3]>0:
         img = img[:,::-1,:]
       imgs.append(img)
 
-    self.set_building_visibility(False)
+    if visible:
+      self.set_building_visibility(False)
     return imgs
 
 
@@ -674,13 +718,16 @@ class MeshMapper(Building):
     return inputs
 
 def _nav_env_reset_helper(type, rng, nodes, batch_size, gtG, max_dist,
-                          num_steps, num_goals, data_augment, **kwargs):
-  """Generates and returns a new episode."""
+                          num_steps, num_goals, data_augment, dist_cache=None,
+                          **kwargs):
+  """Generates and returns a new episode. Distance fields are looked up in
+  dist_cache, a gu.DistanceFieldCache of gtG, if it is given."""
   max_compute = max_dist + 4*num_steps
   if type == 'general':
     start_node_ids, end_node_ids, dist, pred_map, paths = \
         rng_target_dist_field(batch_size, gtG, rng, max_dist, max_compute,
-                              nodes=nodes, compute_path=False)
+                              nodes=nodes, compute_path=False,
+                              dist_cache=dist_cache)
     target_class = None
 
   elif type == 'room_to_room_many':
@@ -689,7 +736,7 @@ def _nav_env_reset_helper(type, rng, nodes, batch_size, gtG, max_dist,
     # Sample the first one
     start_node_ids_, end_node_ids_, dist_, _, _ = rng_room_to_room(
         batch_size, gtG, rng, max_dist, max_compute,
-        node_room_ids=node_room_ids, nodes=nodes)
+        node_room_ids=node_room_ids, nodes=nodes, dist_cache=dist_cache)
     start_node_ids = start_node_ids_
     goal_node_ids.append(end_node_ids_)
     dists.append(dist_)
@@ -697,7 +744,7 @@ def _nav_env_reset_helper(type, rng, nodes, batch_size, gtG, max_dist,
       start_node_ids_, end_node_ids_, dist_, _, _ = rng_next_goal(
           goal_node_ids[n], batch_size, gtG, rng, max_dist,
           max_compute, node_room_ids=node_room_ids, nodes=nodes,
-          dists_from_start_node=dists[n])
+          dists_from_start_node=dists[n], dist_cache=dist_cache)
       goal_node_ids.append(end_node_ids_)
       dists.append(dist_)
     target_class = None
@@ -720,7 +767,8 @@ def _nav_env_reset_helper(type, rng, nodes, batch_size, gtG, max_dist,
       start_node_ids_, end_node_ids_, dist_, _, _, _, _ = rng_next_goal_rejection_sampling(
               input_nodes, batch_size, gtG, rng, max_dist, min_dist,
               max_compute, sampling_distribution, target_distribution, nodes,
-              n_ori, step_size, distribution_bins, rejection_sampling_M)
+              n_ori, step_size, distribution_bins, rejection_sampling_M,
+              dist_cache=dist_cache)
       if n == 0: start_node_ids = start_node_ids_
       goal_node_ids.append(end_node_ids_)
       dists.append(dist_)
@@ -734,20 +782,15 @@ def _nav_env_reset_helper(type, rng, nodes, batch_size, gtG, max_dist,
     # Sample the first one.
     start_node_ids_, end_node_ids_, dist_, _, _ = rng_room_to_room(
         batch_size, gtG, rng, max_dist, max_compute,
-        node_room_ids=node_room_ids, nodes=nodes)
+        node_room_ids=node_room_ids, nodes=nodes, dist_cache=dist_cache)
     start_node_ids = start_node_ids_
     goal_node_ids.append(end_node_ids_)
     dists.append(dist_)
 
     # Set second goal to be starting position, and compute distance to the start node.
     goal_node_ids.append(start_node_ids)
-    dist = []
-    for i in range(batch_size):
-      dist_ = gt.topology.shortest_distance(
-          gt.GraphView(gtG, reversed=True),
-          source=gtG.vertex(start_node_ids[i]), target=None)
-      dist_ = np.array(dist_.get_array())
-      dist.append(dist_)
+    dist, _ = gu.get_distance_fields(gtG, start_node_ids, 'to', None,
+                                     dist_cache)
     dists.append(dist)
     target_class = None
 
@@ -856,6 +899,8 @@ class NavigationEnv(GridWorld, Building):
   def _preprocess_for_task(self, seed):
     """Sets up the task field for doing navigation on the grid world."""
     if self.task is None or self.task.seed != seed:
+      if self.task is not None:
+        self.task.dist_cache.close()
       rng = np.random.RandomState(seed)
       origin_loc = get_graph_origin_loc(rng, self.traversible)
       self.task = utils.Foo(seed=seed, origin_loc=origin_loc,
@@ -867,6 +912,9 @@ class NavigationEnv(GridWorld, Building):
       self.task.nodes = nodes
       self.task.delta_theta = 2.0*np.pi/(self.task.n_ori*1.)
       self.task.nodes_to_id = nodes_to_id
+      self.task.dist_cache = gu.DistanceFieldCache(
+          gtG, max_size=self.task_params.dist_cache_size,
+          num_processes=self.task_params.dist_cache_processes)
 
       logging.info('Building %s, #V=%d, #E=%d', self.building_name,
                    self.task.nodes.shape[0], self.task.gtG.num_edges())
@@ -928,7 +976,8 @@ class NavigationEnv(GridWorld, Building):
           self.task.class_maps_dilated, self.task.node_class_label = label_nodes_with_class_geodesic(
             nodes_xyt, self.class_maps,
             self.task_params.semantic_task.pix_distance+8, self.map.traversible,
-            ff_cost=1., fo_cost=1., oo_cost=4., connectivity=8.)
+            ff_cost=1., fo_cost=1., oo_cost=4., connectivity=8.,
+            cache_dir=self.task_params.graph_cache_dir)
 
         dists = []
         for i in range(len(self.class_map_names)):
@@ -957,6 +1006,7 @@ class NavigationEnv(GridWorld, Building):
         _nav_env_reset_helper(tp.type, rng, self.task.nodes, tp.batch_size,
                               self.task.gtG, tp.max_dist, tp.num_steps,
                               tp.num_goals, tp.data_augment,
+                              dist_cache=self.task.dist_cache,
                               **(self.task.reset_kwargs))
 
     start_nodes = [tuple(nodes[_,:]) for _ in start_node_ids]
@@ -1051,6 +1101,14 @@ class VisualNavigationEnv(NavigationEnv):
       self.traversible.astype(np.float32)*1,
       self.task_params.readout_maps_scales,
       self.task_params.map_resize_method)
+    self.point_binners = None
+    if self.task_params.outputs.analytical_counts:
+      # Binners reuse their buffers for the frames of every step.
+      ac = self.task_params.analytical_counts
+      self.point_binners = [
+          PointBinner(map_size=ac.map_sizes[i], z_bins=ac.z_bins[i],
+                      xy_resolution=ac.xy_resolution[i])
+          for i in range(len(ac.map_sizes))]
     tt.toc(log_at=1, log_str='VisualNavigationEnv __init__: ')
 
   def get_weight(self):
@@ -1167,15 +1225,13 @@ class VisualNavigationEnv(NavigationEnv):
                                       self.robot.camera_elevation_degree)
       for i in range(len(self.task_params.analytical_counts.map_sizes)):
         non_linearity = self.task_params.analytical_counts.non_linearity[i]
-        count, isvalid = bin_points(XYZ*1.,
-                                    map_size=self.task_params.analytical_counts.map_sizes[i],
-                                    xy_resolution=self.task_params.analytical_counts.xy_resolution[i],
-                                    z_bins=self.task_params.analytical_counts.z_bins[i])
+        count, isvalid = self.point_binners[i](XYZ)
         assert(count.shape[2] == 1), 'only works for n_views equal to 1.'
         count = count[:,:,0,:,:,:]
         isvalid = isvalid[:,:,0,:,:,:]
         if non_linearity == 'none':
-          None
+          # The binner overwrites count on the next step.
+          count = count*1.
         elif non_linearity == 'min10':
           count = np.minimum(count, 10.)
         elif non_linearity == 'sqrt':
@@ -1432,6 +1488,11 @@ class BuildingMultiplexer():
       wt.append(b.get_weight())
       b.load_building_into_scene()
       b.set_building_visibility(False)
+      if self.task_params.render_cache_dir is not None:
+        b.set_render_cache(self.task_params.render_cache_dir,
+                           self.task_params.render_cache_size,
+                           self.task_params.render_cache_quanta, cp,
+                           self.task_params.render_cache_writable)
       self.buildings.append(b)
     wt = np.array(wt).astype(np.float32)
     wt = wt / np.sum(wt+0.0001)
@@ -1461,5 +1522,8 @@ class BuildingMultiplexer():
     return self.buildings[self._building_id].pre(inputs)
   
   def __del__(self):
+    for b in self.buildings:
+      if b.render_cache is not None:
+        b.render_cache.flush()
     self.r_obj.clear_scene()
     logging.error('Clearing scene.')
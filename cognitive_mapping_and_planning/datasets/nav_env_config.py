@@ -113,7 +113,14 @@ def nav_env_base_config():
                           reward_at_goal=1.,
                           discount_factor=0.99,
                           rejection_sampling_M=100,
-                          min_dist=None)
+                          min_dist=None,
+                          dist_cache_size=1024,
+                          dist_cache_processes=0,
+                          graph_cache_dir=None,
+                          render_cache_dir=None,
+                          render_cache_size=65536,
+                          render_cache_writable=False,
+                          render_cache_quanta=[0.02, 0.002])
 
   navtask_args = utils.Foo(
       building_names=['area1_gates_wingA_floor1_westpart'],
@@ -0,0 +1,124 @@
+# Copyright 2016 The TensorFlow Authors All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+r"""Benchmarks binning point clouds into maps against the per-image loop and
+np.add.at implementations that they replaced.
+PYTHONPATH='.' python scripts/script_benchmark_binning.py --batch_size 32
+"""
+import time
+import numpy as np
+import logging
+from tensorflow.python.platform import app
+from tensorflow.python.platform import flags
+
+import src.depth_utils as du
+import src.map_utils as mu
+import src.utils as utils
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('batch_size', 16, 'Number of depth images per batch.')
+flags.DEFINE_integer('image_size', 225, 'Size of the depth images.')
+flags.DEFINE_integer('map_size', 128, 'Size of the egocentric maps.')
+flags.DEFINE_float('xy_resolution', 5., 'Size of a map cell, in cm.')
+flags.DEFINE_integer('num_points', 1000000,
+                     'Number of points to project to the top view map.')
+flags.DEFINE_integer('num_processes', 4,
+                     'Number of processes for the pool mode of PointBinner.')
+flags.DEFINE_integer('num_iters', 10, 'Number of timed iterations.')
+
+def _bin_points_loop(XYZ_cms, map_size, z_bins, xy_resolution):
+  """du.bin_points before it was batched."""
+  sh = XYZ_cms.shape
+  XYZ_cms = XYZ_cms.reshape([-1, sh[-3], sh[-2], sh[-1]])
+  n_z_bins = len(z_bins)+1
+  map_center = (map_size-1.)/2.
+  counts = []
+  isvalids = []
+  for XYZ_cm in XYZ_cms:
+    isnotnan = np.logical_not(np.isnan(XYZ_cm[:,:,0]))
+    X_bin = np.round(XYZ_cm[:,:,0] / xy_resolution + map_center).astype(np.int32)
+    Y_bin = np.round(XYZ_cm[:,:,1] / xy_resolution + map_center).astype(np.int32)
+    Z_bin = np.digitize(XYZ_cm[:,:,2], bins=z_bins).astype(np.int32)
+
+    isvalid = np.array([X_bin >= 0, X_bin < map_size, Y_bin >= 0, Y_bin < map_size,
+                        Z_bin >= 0, Z_bin < n_z_bins, isnotnan])
+    isvalid = np.all(isvalid, axis=0)
+
+    ind = (Y_bin * map_size + X_bin) * n_z_bins + Z_bin
+    ind[np.logical_not(isvalid)] = 0
+    count = np.bincount(ind.ravel(), isvalid.ravel().astype(np.int32),
+                         minlength=map_size*map_size*n_z_bins)
+    count = np.reshape(count, [map_size, map_size, n_z_bins])
+    counts.append(count)
+    isvalids.append(isvalid)
+  counts = np.array(counts).reshape(list(sh[:-3]) + [map_size, map_size, n_z_bins])
+  isvalids = np.array(isvalids).reshape(list(sh[:-3]) + [sh[-3], sh[-2], 1])
+  return counts, isvalids
+
+def _project_to_map_add_at(map, vertex, wt):
+  """mu._project_to_map before it used np.bincount."""
+  num_points = np.zeros((map.size[1], map.size[0]))
+  vertex_ = vertex[:, :2] - map.origin
+  vertex_ = np.round(vertex_ / map.resolution).astype(np.int)
+  np.add.at(num_points, (vertex_[:, 1], vertex_[:, 0]), wt)
+  return num_points
+
+def _time(fn, *args):
+  fn(*args)
+  start_time = time.time()
+  for _ in range(FLAGS.num_iters):
+    out = fn(*args)
+  return (time.time() - start_time) / FLAGS.num_iters, out
+
+def _get_point_clouds(rng):
+  depth = rng.uniform(20., 500., size=(FLAGS.batch_size, FLAGS.image_size,
+                                       FLAGS.image_size))
+  depth[rng.rand(*depth.shape) < 0.05] = np.NaN
+  cm = du.get_camera_matrix(FLAGS.image_size, FLAGS.image_size, 60.)
+  XYZ = du.get_point_cloud_from_z(depth, cm)
+  return du.make_geocentric(XYZ, 120., -15.)
+
+def main(_):
+  rng = np.random.RandomState(0)
+  XYZ = _get_point_clouds(rng)
+  z_bins = [-10, 10, 150, 200]
+  args = (FLAGS.map_size, z_bins, FLAGS.xy_resolution)
+
+  base_time, (base_counts, base_isvalid) = _time(_bin_points_loop, XYZ, *args)
+  logging.error('bin_points, per image loop: %8.2fms', 1000*base_time)
+  binners = [du.PointBinner(*args), du.PointBinner(*args, dtype=np.float32),
+             du.PointBinner(*args, num_processes=FLAGS.num_processes)]
+  names = ['PointBinner', 'PointBinner float32',
+           'PointBinner {:d} processes'.format(FLAGS.num_processes)]
+  for name, binner in zip(names, binners):
+    t, (counts, isvalid) = _time(binner, XYZ)
+    binner.close()
+    logging.error('%-26s: %8.2fms, %5.2fx, %d counts differ', name, 1000*t,
+                  base_time / t, np.sum(counts != base_counts))
+    assert(binner.dtype == np.float32 or
+           np.array_equal(isvalid, base_isvalid))
+
+  vertex = rng.uniform(0., 2000., size=(FLAGS.num_points, 3))
+  wt = rng.uniform(size=FLAGS.num_points)
+  map = utils.Foo(origin=np.zeros(2), size=np.array([401, 401]),
+                  resolution=5.)
+  base_time, base_points = _time(_project_to_map_add_at, map, vertex, wt)
+  t, num_points = _time(mu._project_to_map, map, vertex, wt)
+  logging.error('_project_to_map, np.add.at: %8.2fms', 1000*base_time)
+  logging.error('_project_to_map, bincount : %8.2fms, %5.2fx, max diff %g',
+                1000*t, base_time / t, np.max(np.abs(num_points - base_points)))
+
+if __name__ == '__main__':
+  app.run()
@@ -0,0 +1,90 @@
+# Copyright 2016 The TensorFlow Authors All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+r"""Checks gu.get_distance_node_list against graph_tool's shortest_distance
+from a virtual source vertex, which it replaced, on undirected lattices built
+from random traversibility maps, and times both.
+PYTHONPATH='.' python scripts/script_benchmark_distances.py --map_size 256
+"""
+import time
+import numpy as np
+import logging
+from tensorflow.python.platform import app
+from tensorflow.python.platform import flags
+import graph_tool as gt
+import graph_tool.topology
+
+import src.graph_utils as gu
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('map_size', 128, 'Size of the traversibility maps.')
+flags.DEFINE_float('free_fraction', 0.7, 'Fraction of traversible cells.')
+flags.DEFINE_integer('num_sources', 8, 'Number of source nodes.')
+flags.DEFINE_integer('num_iters', 3, 'Number of timed iterations.')
+
+def _get_distance_node_list_virtual_vertex(gtG, source_nodes, direction,
+                                           weights=None):
+  """gu.get_distance_node_list before it used scipy.sparse.csgraph."""
+  gtG_ = gt.Graph(gtG)
+  v = gtG_.add_vertex()
+
+  if weights is not None:
+    weights = gtG_.edge_properties[weights]
+
+  for s in source_nodes:
+    e = gtG_.add_edge(s, int(v))
+    if weights is not None:
+      weights[e] = 0.
+
+  dist = gt.topology.shortest_distance(
+      gt.GraphView(gtG_, reversed=(direction == 'to')),
+      source=gtG_.vertex(int(v)), target=None, weights=weights)
+  dist = np.array(dist.get_array())
+  dist = dist[:-1]
+  if weights is None:
+    dist = dist-1
+  return dist
+
+def _time(fn, *args):
+  start_time = time.time()
+  for _ in range(FLAGS.num_iters):
+    out = fn(*args)
+  return (time.time() - start_time) / FLAGS.num_iters, out
+
+def main(_):
+  rng = np.random.RandomState(0)
+  traversible = rng.rand(FLAGS.map_size, FLAGS.map_size) < FLAGS.free_fraction
+  for connectivity in [4, 8]:
+    g, _ = gu.convert_traversible_to_graph(traversible, ff_cost=1.,
+                                           fo_cost=10., oo_cost=100.,
+                                           connectivity=connectivity)
+    assert(not g.is_directed())
+    source_nodes = rng.choice(g.num_vertices(), size=FLAGS.num_sources,
+                              replace=False).tolist()
+    for weights in [None, 'wts']:
+      for direction in ['to', 'from']:
+        args = (g, source_nodes, direction, weights)
+        base_time, base_dist = _time(_get_distance_node_list_virtual_vertex,
+                                     *args)
+        t, dist = _time(gu.get_distance_node_list, *args)
+        logging.error('%d-connected, weights %-4s, %-4s: %8.2fms, %5.2fx',
+                      connectivity, weights, direction, 1000*t, base_time / t)
+        if weights is None:
+          assert(np.array_equal(dist, base_dist))
+        else:
+          assert(np.allclose(dist, base_dist))
+
+if __name__ == '__main__':
+  app.run()
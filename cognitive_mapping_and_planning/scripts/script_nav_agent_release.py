@@ -83,6 +83,11 @@ flags.DEFINE_integer('solver_seed', 0, '')
 
 flags.DEFINE_integer('delay_start_iters', 20, '')
 
+flags.DEFINE_string('render_cache_dir', '',
+                    'If set, directory of cached rendered images, which are '
+                    'only read in training. It is written by '
+                    'scripts/script_prewarm_render_cache.py.')
+
 logging.basicConfig(level=logging.INFO)
 
 def main(_):
@@ -126,6 +131,8 @@ def _setup_args(config_name, logdir):
   args.solver.seed = FLAGS.solver_seed
   args.logdir = logdir
   args.navtask.logdir = None
+  if FLAGS.render_cache_dir:
+    args.navtask.task_params.render_cache_dir = FLAGS.render_cache_dir
   return args
 
 def _train(args):
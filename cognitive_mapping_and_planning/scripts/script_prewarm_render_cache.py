@@ -0,0 +1,78 @@
+# Copyright 2016 The TensorFlow Authors All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+r"""Pre-warms the render cache with the view from every node of the buildings
+of a config, so that training with the same --render_cache_dir does almost no
+rendering. Training only reads the cache, so this script is the only writer,
+and should not run twice on a directory at the same time. Task numbers pick
+the building and flip as in training, so --num_tasks should be twice the
+number of buildings if buildings are flipped. Views perturbed by data
+augmentation are not cached. Each cache needs a slot per node and rotation of
+the camera, set --render_cache_size to hold them.
+  PYTHONPATH='.' PYOPENGL_PLATFORM=egl python scripts/script_prewarm_render_cache.py \
+    --config_name cmp.lmap_Msc.clip5.sbpd_d_r2r+train_train \
+    --render_cache_dir output/render_cache --num_tasks 1
+"""
+import logging
+from tensorflow.python.platform import app
+from tensorflow.python.platform import flags
+
+import datasets.nav_env as nav_env
+from scripts import script_nav_agent_release as sna
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('num_tasks', 1, 'Number of task numbers to pre-warm.')
+flags.DEFINE_integer('render_batch_size', 256,
+                     'Number of nodes to render at a time.')
+flags.DEFINE_integer('render_cache_size', 0,
+                     'If set, number of images in each new render cache, '
+                     'instead of the render_cache_size of the config.')
+
+def prewarm(b, aux_delta_thetas):
+  if b.render_cache is None:
+    logging.error('%s: no render cache, the task does not render.',
+                  b.building_name)
+    return
+  nodes = b.task.nodes
+  num_views = nodes.shape[0] * (1 + len(aux_delta_thetas))
+  if num_views > b.render_cache.max_size:
+    logging.error('%s: %d views do not fit in the %d images of the render '
+                  'cache, increase --render_cache_size.', b.building_name,
+                  num_views, b.render_cache.max_size)
+  for aux_delta_theta in [0.] + list(aux_delta_thetas):
+    for i in range(0, nodes.shape[0], FLAGS.render_batch_size):
+      b.render_nodes([tuple(x) for x in nodes[i:i+FLAGS.render_batch_size]],
+                     aux_delta_theta=aux_delta_theta)
+  b.render_cache.flush()
+  logging.error('%s: %d images in the render cache, rendered %d.',
+                b.building_name, len(b.render_cache), b.render_cache.misses)
+
+def main(_):
+  assert(FLAGS.render_cache_dir), '--render_cache_dir is not set.'
+  args = sna.get_args_for_config(FLAGS.config_name)
+  args.navtask.logdir = None
+  task_params = args.navtask.task_params
+  task_params.render_cache_dir = FLAGS.render_cache_dir
+  task_params.render_cache_writable = True
+  if FLAGS.render_cache_size > 0:
+    task_params.render_cache_size = FLAGS.render_cache_size
+  for task_number in range(FLAGS.num_tasks):
+    m = nav_env.get_multiplexer_class(args.navtask, task_number)
+    for b in m.buildings:
+      prewarm(b, task_params.aux_delta_thetas)
+    del m
+
+if __name__ == '__main__':
+  app.run()
@@ -15,8 +15,10 @@
 
 """Utilities for processing depth images.
 """
+import multiprocessing
 import numpy as np
 import src.rotation_utils as ru 
+import src.utils as utils
 
 def get_camera_matrix(width, height, fov):
   """Returns a camera matrix from image size and fov."""
@@ -62,34 +64,148 @@ def make_geocentric(XYZ, sensor_height, camera_elevation_degree):
   XYZ[...,2] = XYZ[...,2] + sensor_height
   return XYZ
 
-def bin_points(XYZ_cms, map_size, z_bins, xy_resolution):
+_pool_binner = None
+
+def _bin_points_worker(XYZ_cms):
+  counts, isvalids = _pool_binner(XYZ_cms)
+  return counts, isvalids
+
+class PointBinner():
+  """Bins stacks of point clouds into xy-z bins, see bin_points.
+
+  Points are binned a block of images at a time: they are copied into
+  contiguous coordinate buffers, turned into bin indices with in-place ufuncs
+  and counted with one flat bincount over the block, in which every image has
+  a bin per xy cell and z bin plus one for its invalid points. Blocks hold
+  about block_size points so that the buffers stay in cache. The buffers and
+  the outputs are allocated once per input shape and reused, so the outputs of
+  a call are only valid until the next call.
+
+  Arithmetic is done in dtype, which is also the type of the counts. float32
+  is faster, but can round points on cell boundaries differently than the
+  default float64. If num_processes > 0, stacks of more than one image are
+  split across a pool of that many processes. That only pays off if binning
+  costs more than sending the points to the pool and the counts back.
+  z_bins must be increasing.
+  """
+  def __init__(self, map_size, z_bins, xy_resolution, dtype=np.float64,
+               num_processes=0, block_size=65536):
+    global _pool_binner
+    self.map_size = map_size
+    self.z_bins = np.array(z_bins, dtype=dtype)
+    self.n_z_bins = len(z_bins)+1
+    self.n_bins = map_size*map_size*self.n_z_bins
+    self.xy_resolution = xy_resolution
+    self.map_center = (map_size-1.)/2.
+    self.dtype = dtype
+    self.block_size = block_size
+    self.num_processes = num_processes
+    assert(self.n_bins < 2**np.finfo(dtype).nmant), \
+      'bin indices are not exact in {:s}.'.format(np.dtype(dtype).name)
+    self.shape = None
+    self.pool = None
+    if num_processes > 0:
+      _pool_binner = PointBinner(map_size, z_bins, xy_resolution, dtype=dtype,
+                                 block_size=block_size)
+      self.pool = multiprocessing.Pool(num_processes)
+      _pool_binner = None
+
+  def _allocate(self, sh):
+    n_images = int(np.prod(sh[:-3]))
+    n_pixels = sh[-3]*sh[-2]
+    self.shape = sh
+    self.block_images = max(1, min(n_images, self.block_size // n_pixels))
+    n = self.block_images*n_pixels
+    self.xyz = np.zeros((3, n), dtype=self.dtype)
+    self.ind = np.zeros(n, dtype=np.int64)
+    self.mask = np.zeros(n, dtype=np.bool)
+    # Offsets of the invalid point bin of each image of a block.
+    self.image_offsets = np.repeat(
+        np.arange(self.block_images)*(self.n_bins+1) + self.n_bins, n_pixels)
+    self.isvalid = np.zeros(n_images*n_pixels, dtype=np.bool)
+    self.counts = np.zeros(
+        list(sh[:-3]) + [self.map_size, self.map_size, self.n_z_bins],
+        dtype=self.dtype)
+
+  def __call__(self, XYZ_cms):
+    """Returns the counts, ... x map_size x map_size x (len(z_bins)+1), and
+    whether each point is valid, ... x H x W x 1."""
+    sh = XYZ_cms.shape
+    if sh != self.shape:
+      self._allocate(sh)
+    n_images = int(np.prod(sh[:-3]))
+    if self.pool is not None and n_images > 1:
+      return self._bin_in_pool(XYZ_cms)
+
+    XYZ_cms = np.reshape(XYZ_cms, [n_images, -1, 3])
+    counts = self.counts.reshape([n_images, -1])
+    isvalid = self.isvalid.reshape([n_images, -1])
+    for i in range(0, n_images, self.block_images):
+      j = min(i+self.block_images, n_images)
+      self._bin_block(XYZ_cms[i:j].reshape([-1, 3]), counts[i:j],
+                      isvalid[i:j].reshape([-1]))
+    return self.counts, self.isvalid.reshape(list(sh[:-1]) + [1])
+
+  def _bin_block(self, XYZ, counts, isvalid):
+    n = XYZ.shape[0]
+    xyz = self.xyz[:,:n]; ind = self.ind[:n]; mask = self.mask[:n];
+    x, y, z = xyz[0], xyz[1], xyz[2]
+    xy = xyz[:2]
+    np.copyto(xyz, XYZ.T, casting='unsafe')
+    np.divide(xy, self.xy_resolution, out=xy)
+    np.add(xy, self.map_center, out=xy)
+    np.round(xy, out=xy)
+    # Clipping to [-1, map_size] also maps nan to -1, which keeps the indices
+    # of invalid points finite.
+    np.fmax(xy, -1, out=xy)
+    np.fmin(xy, self.map_size, out=xy)
+    np.greater_equal(x, 0, out=isvalid)
+    isvalid &= np.less(x, self.map_size, out=mask)
+    isvalid &= np.greater_equal(y, 0, out=mask)
+    isvalid &= np.less(y, self.map_size, out=mask)
+
+    # y <- (y*map_size + x)*n_z_bins + z_bin - n_bins, where z_bin is the
+    # number of z_bins <= z, as from np.digitize.
+    np.multiply(y, self.map_size, out=y)
+    y += x
+    y *= self.n_z_bins
+    y += self.n_z_bins-1-self.n_bins
+    for z_bin in self.z_bins:
+      np.subtract(y, np.less(z, z_bin, out=mask), out=y)
+    # Move invalid points to the last bin of their image.
+    np.multiply(y, isvalid, out=y)
+    np.add(self.image_offsets[:n], y, out=ind, casting='unsafe')
+
+    block_counts = np.bincount(ind, minlength=counts.shape[0]*(self.n_bins+1))
+    block_counts = np.reshape(block_counts, [counts.shape[0], self.n_bins+1])
+    np.copyto(counts, block_counts[:,:-1], casting='unsafe')
+
+  def _bin_in_pool(self, XYZ_cms):
+    sh = XYZ_cms.shape
+    XYZ_cms = XYZ_cms.reshape([-1] + list(sh[-3:]))
+    counts = self.counts.reshape([-1, self.map_size, self.map_size,
+                                  self.n_z_bins])
+    isvalid = self.isvalid.reshape([-1, sh[-3], sh[-2], 1])
+    chunks = np.array_split(np.arange(XYZ_cms.shape[0]), self.num_processes)
+    chunks = [c for c in chunks if len(c) > 0]
+    outs = self.pool.map(_bin_points_worker,
+                         [XYZ_cms[c[0]:c[-1]+1] for c in chunks])
+    for c, (counts_, isvalid_) in zip(chunks, outs):
+      counts[c[0]:c[-1]+1] = counts_
+      isvalid[c[0]:c[-1]+1] = isvalid_
+    return self.counts, self.isvalid.reshape(list(sh[:-1]) + [1])
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+
+def bin_points(XYZ_cms, map_size, z_bins, xy_resolution, dtype=np.float64):
   """Bins points into xy-z bins
   XYZ_cms is ... x H x W x3
   Outputs is ... x map_size x map_size x (len(z_bins)+1)
+  Use a PointBinner to reuse buffers or a process pool across calls.
   """
-  sh = XYZ_cms.shape
-  XYZ_cms = XYZ_cms.reshape([-1, sh[-3], sh[-2], sh[-1]])
-  n_z_bins = len(z_bins)+1
-  map_center = (map_size-1.)/2.
-  counts = []
-  isvalids = []
-  for XYZ_cm in XYZ_cms:
-    isnotnan = np.logical_not(np.isnan(XYZ_cm[:,:,0]))
-    X_bin = np.round(XYZ_cm[:,:,0] / xy_resolution + map_center).astype(np.int32)
-    Y_bin = np.round(XYZ_cm[:,:,1] / xy_resolution + map_center).astype(np.int32)
-    Z_bin = np.digitize(XYZ_cm[:,:,2], bins=z_bins).astype(np.int32)
-
-    isvalid = np.array([X_bin >= 0, X_bin < map_size, Y_bin >= 0, Y_bin < map_size,
-                        Z_bin >= 0, Z_bin < n_z_bins, isnotnan])
-    isvalid = np.all(isvalid, axis=0)
-
-    ind = (Y_bin * map_size + X_bin) * n_z_bins + Z_bin
-    ind[np.logical_not(isvalid)] = 0
-    count = np.bincount(ind.ravel(), isvalid.ravel().astype(np.int32),
-                         minlength=map_size*map_size*n_z_bins)
-    count = np.reshape(count, [map_size, map_size, n_z_bins])
-    counts.append(count)
-    isvalids.append(isvalid)
-  counts = np.array(counts).reshape(list(sh[:-3]) + [map_size, map_size, n_z_bins])
-  isvalids = np.array(isvalids).reshape(list(sh[:-3]) + [sh[-3], sh[-2], 1])
-  return counts, isvalids
+  binner = PointBinner(map_size, z_bins, xy_resolution, dtype=dtype)
+  return binner(XYZ_cms)
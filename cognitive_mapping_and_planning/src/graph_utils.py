@@ -15,101 +15,229 @@
 
 """Various function to manipulate graphs for computing distances.
 """
+import collections
+import hashlib
+import multiprocessing
+import os
 import skimage.morphology
 import numpy as np
 import networkx as nx
 import itertools
+import scipy.sparse
+import scipy.sparse.csgraph
 import graph_tool as gt
 import graph_tool.topology
 import graph_tool.generation 
 import src.utils as utils
+import src.file_utils as fu
 
 # Compute shortest path from all nodes to or from all source nodes
 def get_distance_node_list(gtG, source_nodes, direction, weights=None):
-  gtG_ = gt.Graph(gtG)
-  v = gtG_.add_vertex()
-  
-  if weights is not None:
-    weights = gtG_.edge_properties[weights]
-  
-  for s in source_nodes:
-    e = gtG_.add_edge(s, int(v))
-    if weights is not None:
-      weights[e] = 0.
+  """Returns the distance of every node to (or from) the nearest source node.
 
+  Runs a single search on a sparse matrix of the edges, from a virtual vertex
+  that is added as an extra row with edges to the source nodes, instead of
+  adding it to a copy of the graph. Unreachable nodes get the largest int32
+  distance less one if weights is None, and inf otherwise.
+  """
+  num_nodes = gtG.num_vertices()
+  edges = gtG.get_edges()
+  if weights is not None:
+    if edges.shape[1] < 3:
+      edges = gtG.get_edges([gtG.edge_index])
+    wts = gtG.edge_properties[weights].get_array()[edges[:,2]]
+  else:
+    wts = np.ones(edges.shape[0])
   if direction == 'to':
-    dist = gt.topology.shortest_distance(
-        gt.GraphView(gtG_, reversed=True), source=gtG_.vertex(int(v)),
-        target=None, weights=weights)
-  elif direction == 'from':
-    dist = gt.topology.shortest_distance(
-        gt.GraphView(gtG_, reversed=False), source=gtG_.vertex(int(v)),
-        target=None, weights=weights)
-  dist = np.array(dist.get_array())
-  dist = dist[:-1]
+    edges = edges[:,[1,0]]
+  # Keep the cheapest of parallel edges, which the sparse matrix would sum.
+  order = np.lexsort((wts, edges[:,1], edges[:,0]))
+  edges = edges[order,:2]; wts = wts[order];
+  first = np.ones(edges.shape[0], dtype=np.bool)
+  first[1:] = np.any(edges[1:,:] != edges[:-1,:], axis=1)
+  edges = edges[first,:]; wts = wts[first];
+
+  source_nodes = np.unique(np.asarray(source_nodes, dtype=np.int64))
+  if source_nodes.size == 0:
+    dist = np.inf*np.ones(num_nodes)
+  else:
+    # The virtual vertex num_nodes has edges of cost 0 to the source nodes.
+    # Without weights, every edge costs 1, so one is subtracted below.
+    rows = np.concatenate((edges[:,0], num_nodes*np.ones_like(source_nodes)))
+    cols = np.concatenate((edges[:,1], source_nodes))
+    wts = np.concatenate((wts, np.zeros(source_nodes.size)))
+    graph = scipy.sparse.csr_matrix((wts, (rows, cols)),
+                                    shape=(num_nodes+1, num_nodes+1))
+    dist = scipy.sparse.csgraph.dijkstra(graph,
+                                         directed=gtG.is_directed(),
+                                         indices=num_nodes,
+                                         unweighted=weights is None)
+    dist = dist[:-1]
+    if weights is None:
+      dist = dist-1
   if weights is None:
-    dist = dist-1
+    dist[np.isinf(dist)] = np.iinfo(np.int32).max - 1
+    dist = dist.astype(np.int32)
   return dist
 
+def _compute_distance_field(gtG, node_id, direction, max_dist):
+  dist, pred_map = gt.topology.shortest_distance(
+      gt.GraphView(gtG, reversed=(direction == 'to')),
+      source=gtG.vertex(node_id), target=None, max_dist=max_dist,
+      pred_map=True)
+  return np.array(dist.get_array()), np.array(pred_map.get_array())
+
+# Graph of the DistanceFieldCache whose pool is being started; its worker
+# processes inherit it when they are forked.
+_pool_gtG = None
+
+def _distance_field_worker(key):
+  return _compute_distance_field(_pool_gtG, *key)
+
+class DistanceFieldCache(object):
+  """LRU cache of the distance fields of the nodes of a graph.
+
+  The distance field of a node holds the shortest distance to every node from
+  it (direction 'from') or to it (direction 'to'), up to max_dist, along with
+  the predecessor map of the shortest paths. Fields are keyed by (node,
+  direction, max_dist), and are read-only. Misses are computed in a pool of
+  num_processes processes, or in the calling process if num_processes is 0.
+  """
+  def __init__(self, gtG, max_size=1024, num_processes=0):
+    global _pool_gtG
+    self.gtG = gtG
+    self.max_size = max_size
+    self.fields = collections.OrderedDict()
+    self.pool = None
+    if num_processes > 0:
+      _pool_gtG = gtG
+      self.pool = multiprocessing.Pool(num_processes)
+      _pool_gtG = None
+
+  def get(self, node_ids, direction, max_dist=None):
+    """Returns lists of the distance and predecessor maps of node_ids."""
+    keys = [(int(n), direction, max_dist) for n in node_ids]
+    misses = [k for k in collections.OrderedDict.fromkeys(keys)
+              if k not in self.fields]
+    if self.pool is not None and len(misses) > 1:
+      fields = self.pool.map(_distance_field_worker, misses)
+    else:
+      fields = [_compute_distance_field(self.gtG, *k) for k in misses]
+    for k, field in zip(misses, fields):
+      for a in field:
+        a.flags.writeable = False
+      self.fields[k] = field
+
+    dists = []; pred_maps = [];
+    for k in keys:
+      # Move the field to the most recently used end.
+      field = self.fields.pop(k)
+      self.fields[k] = field
+      dists.append(field[0]); pred_maps.append(field[1]);
+    while len(self.fields) > self.max_size:
+      self.fields.popitem(last=False)
+    return dists, pred_maps
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool = None
+
+def get_distance_fields(gtG, node_ids, direction, max_dist=None,
+                        dist_cache=None):
+  """Returns lists of the distance and predecessor maps of node_ids, from
+  dist_cache if it is given."""
+  if dist_cache is not None:
+    return dist_cache.get(node_ids, direction, max_dist)
+  fields = [_compute_distance_field(gtG, n, direction, max_dist)
+            for n in node_ids]
+  return [f[0] for f in fields], [f[1] for f in fields]
+
 # Functions for semantically labelling nodes in the traversal graph.
+def _lattice_nodes(sz_x, sz_y):
+  x, y = np.meshgrid(np.arange(sz_x), np.arange(sz_y))
+  x = np.reshape(x, [-1,1]); y = np.reshape(y, [-1,1]);
+  return np.concatenate((x,y), axis=1)
+
 def generate_lattice(sz_x, sz_y):
   """Generates a lattice with sz_x vertices along x and sz_y vertices along y
   direction Each of these vertices is step_size distance apart. Origin is at
   (0,0).  """
   g = gt.generation.lattice([sz_x, sz_y])
-  x, y = np.meshgrid(np.arange(sz_x), np.arange(sz_y))
-  x = np.reshape(x, [-1,1]); y = np.reshape(y, [-1,1]);
-  nodes = np.concatenate((x,y), axis=1)
+  nodes = _lattice_nodes(sz_x, sz_y)
   return g, nodes
 
+def _lattice_edges(sz_x, sz_y, diagonal=False):
+  """Returns the edges of the lattice from generate_lattice as an array of
+  node id pairs, or the diagonal edges between its nodes if diagonal is set."""
+  ids = np.reshape(np.arange(sz_x*sz_y), [sz_y, sz_x])
+  if diagonal:
+    pairs = [(ids[:-1,:-1], ids[1:,1:]), (ids[:-1,1:], ids[1:,:-1])]
+  else:
+    pairs = [(ids[:,:-1], ids[:,1:]), (ids[:-1,:], ids[1:,:])]
+  return np.concatenate([np.stack((s.ravel(), t.ravel()), axis=1)
+                         for s, t in pairs], axis=0)
+
 def add_diagonal_edges(g, nodes, sz_x, sz_y, edge_len):
-  offset = [sz_x+1, sz_x-1]
-  for o in offset:
-    s = np.arange(nodes.shape[0]-o-1)
-    t = s + o
-    ind = np.all(np.abs(nodes[s,:] - nodes[t,:]) == np.array([[1,1]]), axis=1)
-    s = s[ind][:,np.newaxis]
-    t = t[ind][:,np.newaxis]
-    st = np.concatenate((s,t), axis=1)
-    for i in range(st.shape[0]):
-      e = g.add_edge(st[i,0], st[i,1], add_missing=False)
-      g.ep['wts'][e] = edge_len
+  st = _lattice_edges(sz_x, sz_y, diagonal=True)
+  g.add_edge_list(st)
+  g.ep['wts'].get_array()[-st.shape[0]:] = edge_len
+
+def _traversible_graph_edges(traversible, ff_cost, fo_cost, oo_cost,
+                             connectivity):
+  sz_x = traversible.shape[1]
+  sz_y = traversible.shape[0]
+  edges = _lattice_edges(sz_x, sz_y)
+  edge_lens = np.ones(edges.shape[0])
+  if connectivity == 8:
+    diagonal_edges = _lattice_edges(sz_x, sz_y, diagonal=True)
+    edges = np.concatenate((edges, diagonal_edges), axis=0)
+    edge_lens = np.concatenate(
+        (edge_lens, np.sqrt(2.)*np.ones(diagonal_edges.shape[0])))
+  t = traversible.ravel().astype(np.bool)[edges]
+  wts = np.zeros(edges.shape[0], dtype=np.float64)
+  wts[np.logical_and(t[:,0], t[:,1])] = ff_cost
+  wts[np.logical_and(np.logical_not(t[:,0]), np.logical_not(t[:,1]))] = oo_cost
+  wts[np.logical_xor(t[:,0], t[:,1])] = fo_cost
+  return edges.astype(np.int32), wts*edge_lens
 
 def convert_traversible_to_graph(traversible, ff_cost=1., fo_cost=1.,
-                                 oo_cost=1., connectivity=4):
+                                 oo_cost=1., connectivity=4, cache_dir=None):
+  """Returns the lattice graph of the traversible map, with edge weights 'wts'
+  set by the traversibility of the end points, and the (x, y) of its nodes.
+  If cache_dir is given, the edges are cached there, keyed by a hash of the
+  map and of the costs."""
   assert(connectivity == 4 or connectivity == 8)
 
   sz_x = traversible.shape[1]
   sz_y = traversible.shape[0]
-  g, nodes = generate_lattice(sz_x, sz_y)
-
-  # Assign costs.
+  nodes = _lattice_nodes(sz_x, sz_y)
+
+  cache_file = None
+  if cache_dir is not None:
+    key = hashlib.md5(np.ascontiguousarray(traversible.astype(np.bool)))
+    key.update(repr((traversible.shape, float(ff_cost), float(fo_cost),
+                     float(oo_cost), int(connectivity))))
+    cache_file = os.path.join(cache_dir,
+                              'lattice_{:s}.pkl'.format(key.hexdigest()))
+
+  if cache_file is not None and fu.exists(cache_file):
+    tt = utils.load_variables(cache_file)
+    edges, wts = tt['edges'], tt['wts']
+  else:
+    edges, wts = _traversible_graph_edges(traversible, ff_cost, fo_cost,
+                                          oo_cost, connectivity)
+    if cache_file is not None:
+      utils.mkdir_if_missing(cache_dir)
+      utils.save_variables(cache_file, [edges, wts], ['edges', 'wts'],
+                           overwrite=True)
+
+  g = gt.Graph(directed=False)
+  g.add_vertex(sz_x*sz_y)
+  g.add_edge_list(edges)
   edge_wts = g.new_edge_property('float')
   g.edge_properties['wts'] = edge_wts
-  wts = np.ones(g.num_edges(), dtype=np.float32)
   edge_wts.get_array()[:] = wts
-
-  if connectivity == 8:
-    add_diagonal_edges(g, nodes, sz_x, sz_y, np.sqrt(2.))
-
-  se = np.array([[int(e.source()), int(e.target())] for e in g.edges()])
-  s_xy = nodes[se[:,0]]
-  t_xy = nodes[se[:,1]]
-  s_t = np.ravel_multi_index((s_xy[:,1], s_xy[:,0]), traversible.shape)
-  t_t = np.ravel_multi_index((t_xy[:,1], t_xy[:,0]), traversible.shape)
-  s_t = traversible.ravel()[s_t]
-  t_t = traversible.ravel()[t_t]
-
-  wts = np.zeros(g.num_edges(), dtype=np.float32)
-  wts[np.logical_and(s_t == True, t_t == True)] = ff_cost
-  wts[np.logical_and(s_t == False, t_t == False)] = oo_cost
-  wts[np.logical_xor(s_t, t_t)] = fo_cost
-
-  edge_wts = g.edge_properties['wts']
-  for i, e in enumerate(g.edges()):
-    edge_wts[e] = edge_wts[e] * wts[i]
-  # d = edge_wts.get_array()*1.
-  # edge_wts.get_array()[:] = d*wts 
   return g, nodes
 
 def label_nodes_with_class(nodes_xyt, class_maps, pix):
@@ -142,7 +270,7 @@ def label_nodes_with_class(nodes_xyt, class_maps, pix):
 
 def label_nodes_with_class_geodesic(nodes_xyt, class_maps, pix, traversible,
                                     ff_cost=1., fo_cost=1., oo_cost=1.,
-                                    connectivity=4):
+                                    connectivity=4, cache_dir=None):
   """Labels nodes in nodes_xyt with class labels using geodesic distance as
   defined by traversible from class_maps.
   Inputs:
@@ -150,13 +278,15 @@ def label_nodes_with_class_geodesic(nodes_xyt, class_maps, pix, traversible,
     class_maps: counts for each class.
     pix: distance threshold to consider close enough to target.
     traversible: binary map of whether traversible or not.
+    cache_dir: directory to cache the graph of traversible in, if given.
   Output:
     labels: For each node in nodes_xyt returns a label of the class or -1 is
     unlabelled.
   """
   g, nodes = convert_traversible_to_graph(traversible, ff_cost=ff_cost,
                                           fo_cost=fo_cost, oo_cost=oo_cost,
-                                          connectivity=connectivity)
+                                          connectivity=connectivity,
+                                          cache_dir=cache_dir)
 
   class_dist = np.zeros_like(class_maps*1.)
   n_classes = class_maps.shape[2]
@@ -370,11 +500,15 @@ def get_hardness_distribution(gtG, max_dist, min_dist, rng, trials, bins, nodes,
 def rng_next_goal_rejection_sampling(start_node_ids, batch_size, gtG, rng,
                                      max_dist, min_dist, max_dist_to_compute,
                                      sampling_d, target_d,
-                                     nodes, n_ori, step_size, bins, M):
+                                     nodes, n_ori, step_size, bins, M,
+                                     dist_cache=None):
   sample_start_nodes = start_node_ids is None
-  dists = []; pred_maps = []; end_node_ids = []; start_node_ids_ = [];
+  end_node_ids = []; start_node_ids_ = [];
   hardnesss = []; gt_dists = [];
   num_nodes = gtG.num_vertices()
+  if not sample_start_nodes and dist_cache is not None:
+    # Compute the distance fields from all the given start nodes at once.
+    dist_cache.get(start_node_ids[:batch_size], 'from', max_dist)
   for i in range(batch_size):
     done = False
     while not done:
@@ -383,10 +517,8 @@ def rng_next_goal_rejection_sampling(start_node_ids, batch_size, gtG, rng,
       else:
         start_node_id = start_node_ids[i]
 
-      gt_dist = gt.topology.shortest_distance(
-          gt.GraphView(gtG, reversed=False), source=start_node_id, target=None,
-          max_dist=max_dist)
-      gt_dist = np.array(gt_dist.get_array())
+      gt_dist = get_distance_fields(gtG, [start_node_id], 'from', max_dist,
+                                    dist_cache)[0][0]
       ind = np.where(np.logical_and(gt_dist <= max_dist, gt_dist >= min_dist))[0]
       ind = rng.permutation(ind)
       gt_dist = gt_dist[ind]*1.
@@ -402,37 +534,32 @@ def rng_next_goal_rejection_sampling(start_node_ids, batch_size, gtG, rng,
         gt_dist = gt_dist[sampled_ind]
         done = True
 
-    # Compute distance from end node to all nodes, to return.
-    dist, pred_map = gt.topology.shortest_distance(
-        gt.GraphView(gtG, reversed=True), source=end_node_id, target=None,
-        max_dist=max_dist_to_compute, pred_map=True)
-    dist = np.array(dist.get_array())
-    pred_map = np.array(pred_map.get_array())
-
-    hardnesss.append(hardness); dists.append(dist); pred_maps.append(pred_map);
+    hardnesss.append(hardness);
     start_node_ids_.append(start_node_id); end_node_ids.append(end_node_id);
     gt_dists.append(gt_dist);
     paths = None
+
+  # Compute distance from end nodes to all nodes, to return.
+  dists, pred_maps = get_distance_fields(gtG, end_node_ids, 'to',
+                                         max_dist_to_compute, dist_cache)
   return start_node_ids_, end_node_ids, dists, pred_maps, paths, hardnesss, gt_dists
 
 
 def rng_next_goal(start_node_ids, batch_size, gtG, rng, max_dist,
                   max_dist_to_compute, node_room_ids, nodes=None,
-                  compute_path=False, dists_from_start_node=None):
+                  compute_path=False, dists_from_start_node=None,
+                  dist_cache=None):
   # Compute the distance field from the starting location, and then pick a
   # destination in another room if possible otherwise anywhere outside this
   # room.
-  dists = []; pred_maps = []; paths = []; end_node_ids = [];
+  paths = []; end_node_ids = [];
+  if dists_from_start_node is None:
+    dists_from_start_node, _ = get_distance_fields(
+        gtG, start_node_ids[:batch_size], 'from', max_dist_to_compute,
+        dist_cache)
   for i in range(batch_size):
     room_id = node_room_ids[start_node_ids[i]]
-    # Compute distances.
-    if dists_from_start_node == None:
-      dist, pred_map = gt.topology.shortest_distance(
-        gt.GraphView(gtG, reversed=False), source=gtG.vertex(start_node_ids[i]),
-        target=None, max_dist=max_dist_to_compute, pred_map=True)
-      dist = np.array(dist.get_array())
-    else:
-      dist = dists_from_start_node[i]
+    dist = dists_from_start_node[i]
 
     # Randomly sample nodes which are within max_dist.
     near_ids = dist <= max_dist
@@ -451,28 +578,23 @@ def rng_next_goal(start_node_ids, batch_size, gtG, rng, max_dist,
       end_node_id = rng.choice(np.where(good3_ids)[0])
     else:
       logging.error('Did not find any good nodes.')
-
-    # Compute distance to this new goal for doing distance queries.
-    dist, pred_map = gt.topology.shortest_distance(
-        gt.GraphView(gtG, reversed=True), source=gtG.vertex(end_node_id),
-        target=None, max_dist=max_dist_to_compute, pred_map=True)
-    dist = np.array(dist.get_array())
-    pred_map = np.array(pred_map.get_array())
-
-    dists.append(dist)
-    pred_maps.append(pred_map)
     end_node_ids.append(end_node_id)
 
+  # Compute distance to the new goals for doing distance queries.
+  dists, pred_maps = get_distance_fields(gtG, end_node_ids, 'to',
+                                         max_dist_to_compute, dist_cache)
+  for i in range(batch_size):
     path = None
     if compute_path:
-      path = get_path_ids(start_node_ids[i], end_node_ids[i], pred_map)
+      path = get_path_ids(start_node_ids[i], end_node_ids[i], pred_maps[i])
     paths.append(path)
   
   return start_node_ids, end_node_ids, dists, pred_maps, paths
 
 
 def rng_room_to_room(batch_size, gtG, rng, max_dist, max_dist_to_compute,
-                     node_room_ids, nodes=None, compute_path=False):
+                     node_room_ids, nodes=None, compute_path=False,
+                     dist_cache=None):
   # Sample one of the rooms, compute the distance field. Pick a destination in
   # another room if possible otherwise anywhere outside this room.
   dists = []; pred_maps = []; paths = []; start_node_ids = []; end_node_ids = [];
@@ -483,11 +605,8 @@ def rng_room_to_room(batch_size, gtG, rng, max_dist, max_dist_to_compute,
     end_node_ids.append(end_node_id)
 
     # Compute distances.
-    dist, pred_map = gt.topology.shortest_distance(
-        gt.GraphView(gtG, reversed=True), source=gtG.vertex(end_node_id),
-        target=None, max_dist=max_dist_to_compute, pred_map=True)
-    dist = np.array(dist.get_array())
-    pred_map = np.array(pred_map.get_array())
+    [dist], [pred_map] = get_distance_fields(gtG, [end_node_id], 'to',
+                                             max_dist_to_compute, dist_cache)
     dists.append(dist)
     pred_maps.append(pred_map)
 
@@ -521,21 +640,17 @@ def rng_room_to_room(batch_size, gtG, rng, max_dist, max_dist_to_compute,
 
 
 def rng_target_dist_field(batch_size, gtG, rng, max_dist, max_dist_to_compute,
-                          nodes=None, compute_path=False):
+                          nodes=None, compute_path=False, dist_cache=None):
   # Sample a single node, compute distance to all nodes less than max_dist,
   # sample nodes which are a particular distance away.
-  dists = []; pred_maps = []; paths = []; start_node_ids = []
+  paths = []; start_node_ids = []
   end_node_ids = rng.choice(gtG.num_vertices(), size=(batch_size,),
                             replace=False).tolist()
 
+  dists, pred_maps = get_distance_fields(gtG, end_node_ids, 'to',
+                                         max_dist_to_compute, dist_cache)
   for i in range(batch_size):
-    dist, pred_map = gt.topology.shortest_distance(
-        gt.GraphView(gtG, reversed=True), source=gtG.vertex(end_node_ids[i]),
-        target=None, max_dist=max_dist_to_compute, pred_map=True)
-    dist = np.array(dist.get_array())
-    pred_map = np.array(pred_map.get_array())
-    dists.append(dist)
-    pred_maps.append(pred_map)
+    dist = dists[i]; pred_map = pred_maps[i];
 
     # Randomly sample nodes which are withing max_dist
     near_ids = np.where(dist <= max_dist)[0]
@@ -34,22 +34,25 @@ def _get_xy_bounding_box(vertex, padding):
 def _project_to_map(map, vertex, wt=None, ignore_points_outside_map=False):
   """Projects points to map, returns how many points are present at each
   location."""
-  num_points = np.zeros((map.size[1], map.size[0]))
   vertex_ = vertex[:, :2] - map.origin
   vertex_ = np.round(vertex_ / map.resolution).astype(np.int)
+  if wt is not None:
+    wt = np.reshape(wt, [-1])
+    assert(wt.shape[0] == vertex.shape[0]), \
+      'number of weights should be same as vertices.'
   if ignore_points_outside_map:
     good_ind = np.all(np.array([vertex_[:,1] >= 0, vertex_[:,1] < map.size[1],
                                 vertex_[:,0] >= 0, vertex_[:,0] < map.size[0]]),
                       axis=0)
     vertex_ = vertex_[good_ind, :]
     if wt is not None:
-      wt = wt[good_ind, :]
-  if wt is None:
-    np.add.at(num_points, (vertex_[:, 1], vertex_[:, 0]), 1)
-  else:
-    assert(wt.shape[0] == vertex.shape[0]), \
-      'number of weights should be same as vertices.'
-    np.add.at(num_points, (vertex_[:, 1], vertex_[:, 0]), wt)
+      wt = wt[good_ind]
+  # One flat bincount is much faster than np.add.at on the 2D map.
+  ind = np.ravel_multi_index((vertex_[:, 1], vertex_[:, 0]),
+                             (map.size[1], map.size[0]))
+  num_points = np.bincount(ind, weights=wt, minlength=map.size[1]*map.size[0])
+  num_points = np.reshape(num_points.astype(np.float64),
+                          (map.size[1], map.size[0]))
   return num_points
 
 def make_map(padding, resolution, vertex=None, sc=1.):
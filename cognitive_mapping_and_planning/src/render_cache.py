@@ -0,0 +1,124 @@
+# Copyright 2016 The TensorFlow Authors All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+r"""Disk backed cache of rendered images.
+"""
+import collections
+import logging
+import os
+import numpy as np
+import src.utils as utils
+
+class RenderCache():
+  """LRU cache of images keyed by tuples of key_size ints.
+
+  Images are stored in max_size slots of a memory-mapped .npy file in
+  cache_dir, whose shape and dtype are set by the first image put in the
+  cache. A second memory-mapped table holds the key in each slot and whether
+  the slot is filled, so the cache can be reopened by later runs. The order of
+  use is not saved, so eviction after reopening starts with the lowest slots.
+  A cache_dir should only be written by one process at a time, other
+  processes should open it with read_only set, in which case put does not
+  store images.
+  """
+  def __init__(self, cache_dir, max_size, key_size=3, read_only=False):
+    self.cache_dir = cache_dir
+    self.key_size = key_size
+    self.read_only = read_only
+    self.images_file = os.path.join(cache_dir, 'images.npy')
+    self.keys_file = os.path.join(cache_dir, 'keys.npy')
+    self.images = None
+    self.slots = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+    mode = 'r' if read_only else 'r+'
+    if read_only and not (os.path.exists(self.keys_file) and
+                          os.path.exists(self.images_file)):
+      logging.error('RenderCache: %s is empty, and opened read-only.',
+                    cache_dir)
+      self.keys = np.zeros((0, key_size+1), dtype=np.int64)
+    elif os.path.exists(self.keys_file):
+      self.keys = np.lib.format.open_memmap(self.keys_file, mode=mode)
+      assert(self.keys.shape[1] == key_size+1), \
+        'keys in {:s} do not have {:d} entries.'.format(cache_dir, key_size)
+      if self.keys.shape[0] != max_size:
+        logging.error('RenderCache: using %d slots of %s instead of %d.',
+                      self.keys.shape[0], cache_dir, max_size)
+      if os.path.exists(self.images_file):
+        self.images = np.lib.format.open_memmap(self.images_file, mode=mode)
+      else:
+        self.keys[:,-1] = 0
+      for slot in np.where(self.keys[:,-1])[0]:
+        self.slots[tuple(self.keys[slot,:-1].tolist())] = slot
+    else:
+      utils.mkdir_if_missing(cache_dir)
+      self.keys = np.lib.format.open_memmap(
+          self.keys_file, mode='w+', dtype=np.int64,
+          shape=(max_size, key_size+1))
+    self.max_size = self.keys.shape[0]
+    self.free_slots = sorted(set(range(self.keys.shape[0])) -
+                             set(self.slots.values()), reverse=True)
+    logging.info('RenderCache: %d images in %s.', len(self.slots), cache_dir)
+
+  def __len__(self):
+    return len(self.slots)
+
+  def __contains__(self, key):
+    return key in self.slots
+
+  def get(self, key):
+    """Returns a copy of the image for key, or None if it is not cached."""
+    slot = self.slots.pop(key, None)
+    if slot is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.slots[key] = slot
+    return np.array(self.images[slot])
+
+  def put(self, key, img):
+    """Caches img for key, evicting the least recently used image if the
+    cache is full. Does nothing if the cache is read-only."""
+    assert(len(key) == self.key_size)
+    if self.read_only:
+      return
+    if self.images is None:
+      self.images = np.lib.format.open_memmap(
+          self.images_file, mode='w+', dtype=img.dtype,
+          shape=(self.keys.shape[0],) + img.shape)
+    if img.shape != self.images.shape[1:] or img.dtype != self.images.dtype:
+      raise ValueError('Image of shape {:s} and type {:s} does not match the '
+                       'cache in {:s}.'.format(str(img.shape), str(img.dtype),
+                                               self.cache_dir))
+    slot = self.slots.pop(key, None)
+    if slot is None:
+      if len(self.free_slots) > 0:
+        slot = self.free_slots.pop()
+      else:
+        _, slot = self.slots.popitem(last=False)
+    # Invalidate the slot while its image is overwritten.
+    self.keys[slot,-1] = 0
+    self.images[slot] = img
+    self.keys[slot,:-1] = key
+    self.keys[slot,-1] = 1
+    self.slots[key] = slot
+
+  def flush(self):
+    if self.read_only:
+      return
+    if self.images is not None:
+      self.images.flush()
+    self.keys.flush()
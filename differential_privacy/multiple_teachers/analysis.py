@@ -40,6 +40,7 @@ python analysis.py
 """
 import os
 import math
+import multiprocessing
 import numpy as np
 import tensorflow as tf
 
@@ -62,6 +63,8 @@ tf.flags.DEFINE_integer("max_examples",1000,
     " or indices_file to do the privacy cost estimate")
 tf.flags.DEFINE_float("too_small", 1e-10, "Small threshold to avoid log of 0")
 tf.flags.DEFINE_bool("input_is_counts", False, "False if labels, True if counts")
+tf.flags.DEFINE_integer("num_processes", multiprocessing.cpu_count(),
+    "Number of processes used to analyze the queries.")
 
 FLAGS = tf.flags.FLAGS
 
@@ -211,6 +214,146 @@ def smoothed_sens(counts, noise_eps, l, beta):
   return smoothed_sensitivity
 
 
+def compute_q_noisy_max_batch(counts, noise_eps):
+  """Computes compute_q_noisy_max for many queries at once.
+
+  Args:
+    counts: an array of scores, with the classes along the last axis
+    noise_eps: privacy parameter for noisy_max
+  Returns:
+    q: array with the probability that outcome is different from true winner,
+      for each query.
+  """
+  counts = np.asarray(counts, dtype=np.float64)
+  num_classes = counts.shape[-1]
+  winner = np.argmax(counts, axis=-1)
+  gap = -(noise_eps * (counts - np.max(counts, axis=-1)[..., None]))
+  terms = (gap + 2.0) / (4.0 * np.exp(gap))
+  # Sum the terms of the other classes in order, like compute_q_noisy_max.
+  q = np.zeros(counts.shape[:-1])
+  for i in xrange(num_classes):
+    q += np.where(winner == i, 0.0, terms[..., i])
+  return np.minimum(q, 1.0 - (1.0/num_classes))
+
+
+def logmgf_exact_batch(q, priv_eps, l_list):
+  """Computes logmgf_exact for an array of q and all moments at once.
+
+  Args:
+    q: array of pr of non-optimal outcome
+    priv_eps: eps parameter for DP
+    l_list: moments to compute.
+  Returns:
+    Upper bounds on logmgf, with shape q.shape + l_list.shape.
+  """
+  q = np.asarray(q, dtype=np.float64)[..., None]
+  l = np.asarray(l_list, dtype=np.float64)
+  with np.errstate(all="ignore"):
+    t_one = (1-q) * np.power((1-q) / (1 - math.exp(priv_eps) * q), l)
+    t_two = q * np.exp(priv_eps * l)
+    t = t_one + t_two
+    log_t = np.log(t)
+  log_t = np.where((q < 0.5) & (t > 0), log_t, priv_eps * l)
+  return np.minimum(np.minimum(0.5 * priv_eps * priv_eps * l * (l + 1), log_t),
+                    priv_eps * l)
+
+
+def logmgf_from_counts_batch(counts, noise_eps, l_list):
+  """Computes logmgf_from_counts for many queries and all moments at once."""
+  q = compute_q_noisy_max_batch(counts, noise_eps)
+  return logmgf_exact_batch(q, 2.0 * noise_eps, l_list)
+
+
+def smoothed_sens_batch(counts, noise_eps, l_list, beta):
+  """Computes smoothed_sens for many queries and all moments at once.
+
+  The sensitivities at all distances k are computed together, rather than
+  one k at a time.
+
+  Args:
+    counts: [num_queries, num_classes] matrix of scores
+    noise_eps: noise parameter
+    l_list: moments of interest
+    beta: smoothness parameter
+  Returns:
+    [num_queries, len(l_list)] matrix of beta smooth upper bounds
+  """
+  counts = np.asarray(counts, dtype=np.float64)
+  l_list = np.asarray(l_list, dtype=np.float64)
+  for l in l_list[0.5 * noise_eps * l_list > 1]:
+    print "l too large to compute sensitivity: " + str(l)
+
+  # smoothed_sens stops at k = max(counts), or earlier at the first zero
+  # sensitivity, which occurs at the latest once k exceeds the gap between
+  # the first two counts. All the (query, k) pairs up to there are computed
+  # together.
+  gap = counts[:, 0] - counts[:, 1]
+  max_k = np.minimum(np.max(counts, axis=1), np.maximum(gap + 1, 1))
+  num_k = np.maximum(max_k, 0).astype(np.int64) + 1
+  starts = np.cumsum(num_k) - num_k
+  query = np.repeat(np.arange(len(counts)), num_k)
+  k = np.arange(np.sum(num_k)) - np.repeat(starts, num_k)
+
+  counts_at_k = -np.sort(-counts, axis=1)[query]
+  counts_at_k[:, 0] -= k
+  counts_at_k[:, 1] += k
+  val = logmgf_from_counts_batch(counts_at_k, noise_eps, l_list)
+  counts_at_k[:, 0] -= 1
+  counts_at_k[:, 1] += 1
+  val_changed = logmgf_from_counts_batch(counts_at_k, noise_eps, l_list)
+  sens = val_changed - val
+  sens[counts[query, 0] < counts[query, 1] + k] = 0
+  sens[:, 0.5 * noise_eps * l_list > 1] = 0
+
+  # Drop the pairs after the first zero sensitivity for k > 0 of each query.
+  zero = (sens == 0.0) & (k > 0)[:, None]
+  num_zero = np.cumsum(zero, axis=0) - zero
+  past_zero = num_zero > num_zero[starts[query]]
+  smoothed = np.exp(-beta * k)[:, None] * sens
+  smoothed[k == 0] = sens[k == 0]
+  smoothed[past_zero] = -np.inf
+  return np.maximum.reduceat(smoothed, starts, axis=0)
+
+
+def _analyze_queries(args):
+  """Returns the logmgf and smooth sensitivity of a block of queries."""
+  counts, noise_eps, l_list, beta = args
+  return (logmgf_from_counts_batch(counts, noise_eps, l_list),
+          smoothed_sens_batch(counts, noise_eps, l_list, beta))
+
+
+def analyze_queries(counts, noise_eps, l_list, beta, num_processes=1,
+                    block_size=256):
+  """Computes the total logmgf and smooth sensitivity of many queries.
+
+  Blocks of queries are analyzed in parallel by a pool of processes.
+
+  Args:
+    counts: [num_queries, num_classes] matrix of scores
+    noise_eps: noise parameter used
+    l_list: moments to compute
+    beta: smoothness parameter
+    num_processes: number of processes to use
+    block_size: number of queries analyzed by a process at once
+  Returns:
+    total_log_mgf: logmgf summed over the queries, for each moment
+    total_ss: smooth sensitivity summed over the queries, for each moment
+  """
+  blocks = [(counts[start:start + block_size], noise_eps, l_list, beta)
+            for start in xrange(0, len(counts), block_size)]
+  if num_processes > 1 and len(blocks) > 1:
+    pool = multiprocessing.Pool(num_processes)
+    results = pool.map(_analyze_queries, blocks)
+    pool.close()
+    pool.join()
+  else:
+    results = map(_analyze_queries, blocks)
+
+  log_mgf = np.concatenate([log_mgf for log_mgf, _ in results])
+  ss = np.concatenate([ss for _, ss in results])
+  return np.sum(log_mgf, axis=0), np.sum(ss, axis=0)
+
+
 def main(unused_argv):
   ##################################################################
   # If we are reproducing results from paper https://arxiv.org/abs/1610.05755,
@@ -237,9 +380,8 @@ def main(unused_argv):
     # In this case, the input is the raw predictions. Transform
     num_teachers, n = input_mat.shape
     counts_mat = np.zeros((n, 10)).astype(np.int32)
-    for i in range(n):
-      for j in range(num_teachers):
-        counts_mat[i, input_mat[j, i]] += 1
+    for j in range(num_teachers):
+      counts_mat[np.arange(n), input_mat[j]] += 1
   n = counts_mat.shape[0]
   num_examples = min(n, FLAGS.max_examples)
 
@@ -251,17 +393,11 @@ def main(unused_argv):
 
   l_list = 1.0 + np.array(xrange(FLAGS.moments))
   beta = FLAGS.beta
-  total_log_mgf_nm = np.array([0.0 for _ in l_list])
-  total_ss_nm = np.array([0.0 for _ in l_list])
   noise_eps = FLAGS.noise_eps
 
-  for i in indices:
-    total_log_mgf_nm += np.array(
-        [logmgf_from_counts(counts_mat[i], noise_eps, l)
-         for l in l_list])
-    total_ss_nm += np.array(
-        [smoothed_sens(counts_mat[i], noise_eps, l, beta)
-         for l in l_list])
+  total_log_mgf_nm, total_ss_nm = analyze_queries(
+      counts_mat[indices], noise_eps, l_list, beta,
+      num_processes=FLAGS.num_processes)
   delta = FLAGS.delta
 
   # We want delta = exp(alpha - eps l).
@@ -36,15 +36,28 @@ delta. The example code would be:
     log_moments.append((lmbd, log_moment))
   eps, delta = get_privacy_spent(log_moments, target_delta=delta)
 
+compute_log_moments computes all the moment orders at once, and can look them
+up in a LogMomentTable that is kept on disk across runs:
+
+  table = LogMomentTable("log_moments.npz")
+  lmbds = np.arange(1, max_lmbd + 1)
+  log_moment = 0
+  for q, sigma, T in parameters:
+    log_moment += compute_log_moments(q, sigma, T, lmbds, table=table)
+  table.save()
+  eps, delta = get_privacy_spent(zip(lmbds, log_moment), target_delta=delta)
+
 To verify that the I1 >= I2 (see comments in GaussianMomentsAccountant in
-accountant.py for the context), run the same loop above with verify=True
+accountant.py for the context), run the first loop above with verify=True
 passed to compute_log_moment.
 """
 import math
+import os
 import sys
 
 import numpy as np
 import scipy.integrate as integrate
+import scipy.special
 import scipy.stats
 from sympy.mpmath import mp
 
@@ -115,6 +128,86 @@ def compute_a(sigma, q, lmbd, verbose=False):
   return _to_np_float64(a_lambda_exact)
 
 
+def _log_sum_exp(x):
+  """Computes log(sum(exp(x))) along the last axis without overflow."""
+  x_max = np.max(x, axis=-1)
+  x_max = np.where(np.isfinite(x_max), x_max, 0.0)
+  with np.errstate(divide="ignore"):
+    return x_max + np.log(np.sum(np.exp(x - x_max[..., None]), axis=-1))
+
+
+def compute_log_a(sigma, q, lmbds):
+  """Computes log(A) for several moment orders at once, in log space.
+
+  The binomial expansion of compute_a is regrouped into sums of positive terms,
+    A = (1 - q) * sum_k (L choose k) (1 - q)^(L - k) q^k exp((k^2 - k) / 2s^2)
+        + q * sum_k (L choose k) (1 - q)^(L - k) q^k exp((k^2 + k) / 2s^2),
+  which are evaluated with log-sum-exp, so that large orders don't overflow.
+
+  Args:
+    sigma: the noise sigma.
+    q: the sampling ratio.
+    lmbds: array of moment orders.
+  Returns:
+    array of log(A) with the shape of lmbds.
+  """
+  lmbds = np.ceil(np.asarray(lmbds, dtype=np.float64))
+  max_lmbd = int(np.max(lmbds)) if lmbds.size else 0
+  k = np.arange(max_lmbd + 1, dtype=np.float64)
+  l = lmbds[..., None]
+  with np.errstate(divide="ignore", invalid="ignore"):
+    log_terms = (scipy.special.gammaln(l + 1) - scipy.special.gammaln(k + 1) -
+                 scipy.special.gammaln(l - k + 1) +
+                 np.where(k == 0, 0.0, k * np.log(q)) +
+                 np.where(l == k, 0.0, (l - k) * np.log1p(-q)))
+    log_terms = np.where(k <= l, log_terms, -np.inf)
+    log_first_term = _log_sum_exp(log_terms + (k * k - k) / (2.0 * sigma ** 2))
+    log_second_term = _log_sum_exp(log_terms + (k * k + k) / (2.0 * sigma ** 2))
+    log_a = np.logaddexp(np.log1p(-q) + log_first_term,
+                         np.log(q) + log_second_term)
+  return np.where(lmbds == 0, 0.0, log_a)
+
+
+class LogMomentTable(object):
+  """Memo table of log(A), keyed by (sigma, q, lmbd).
+
+  If a filename is given, the table is loaded from it and save() writes it
+  back, so that the moments computed in one run are reused by the next.
+  """
+
+  def __init__(self, filename=None):
+    self._filename = filename
+    self._table = {}
+    if filename and os.path.exists(filename):
+      data = np.load(filename)
+      for key, value in zip(data["keys"], data["values"]):
+        self._table[tuple(float(x) for x in key)] = float(value)
+
+  def __len__(self):
+    return len(self._table)
+
+  def log_a(self, sigma, q, lmbds):
+    """Returns log(A) for the moment orders, computing only missing entries."""
+    sigma, q = float(sigma), float(q)
+    lmbds = np.ceil(np.asarray(lmbds, dtype=np.float64))
+    missing = sorted(set(lmbd for lmbd in lmbds.flat
+                         if (sigma, q, lmbd) not in self._table))
+    if missing:
+      for lmbd, log_a in zip(missing, compute_log_a(sigma, q, missing)):
+        self._table[(sigma, q, lmbd)] = float(log_a)
+
+    return np.array([self._table[(sigma, q, lmbd)]
+                     for lmbd in lmbds.flat]).reshape(lmbds.shape)
+
+  def save(self, filename=None):
+    """Saves the table, by default to the file it was loaded from."""
+    filename = filename or self._filename
+    keys = sorted(self._table)
+    with open(filename, "wb") as f:
+      np.savez(f, keys=np.array(keys, dtype=np.float64).reshape(-1, 3),
+               values=np.array([self._table[key] for key in keys]))
+
+
 def compute_b(sigma, q, lmbd, verbose=False):
   mu0, _, mu = distributions(sigma, q)
 
@@ -287,6 +380,9 @@ def compute_log_moment(q, sigma, steps, lmbd, verify=False, verbose=False):
   Returns:
     the log moment with type np.float64, could be np.inf.
   """
+  if not (verify or verbose):
+    return compute_log_moments(q, sigma, steps, lmbd)
+
   moment = compute_a(sigma, q, lmbd, verbose=verbose)
   if verify:
     mp.dps = 50
@@ -302,6 +398,25 @@ def compute_log_moment(q, sigma, steps, lmbd, verify=False, verbose=False):
     return np.log(moment) * steps
 
 
+def compute_log_moments(q, sigma, steps, lmbds, table=None):
+  """Compute the log moments of Gaussian mechanism for several moment orders.
+
+  Args:
+    q: the sampling ratio.
+    sigma: the noise sigma.
+    steps: the number of steps.
+    lmbds: the moment orders, a number or an array.
+    table: optional LogMomentTable to look up and store the moments in.
+  Returns:
+    the log moments with type np.float64 and the shape of lmbds.
+  """
+  if table is not None:
+    log_a = table.log_a(sigma, q, lmbds)
+  else:
+    log_a = compute_log_a(sigma, q, lmbds)
+  return log_a * steps
+
+
 def get_privacy_spent(log_moments, target_eps=None, target_delta=None):
   """Compute delta (or eps) for given eps (or delta) from log moments.
 
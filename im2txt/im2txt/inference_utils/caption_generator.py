@@ -209,3 +209,137 @@ class CaptionGenerator(object):
       complete_captions = partial_captions
 
     return complete_captions.extract(sort=True)
+
+  def beam_search_batch(self, sess, encoded_images):
+    """Runs beam search caption generation on a batch of images.
+
+    This performs the same search as beam_search(), but the partial captions of
+    all images are kept in arrays of shape [num_images * beam_size, ...] and
+    extended by a single call to inference_step() per time step. Images whose
+    search has finished are dropped from subsequent steps.
+
+    Args:
+      sess: TensorFlow Session object.
+      encoded_images: A list of encoded image strings.
+
+    Returns:
+      A list with one entry per image: a list of Caption sorted by descending
+      score.
+    """
+    num_images = len(encoded_images)
+    beam_size = self.beam_size
+    num_slots = num_images * beam_size
+    if not num_images:
+      return []
+
+    # Feed in the images to get the initial states.
+    initial_states = np.concatenate(
+        [self.model.feed_image(sess, image) for image in encoded_images])
+
+    # Each image has beam_size slots for partial captions, of which only the
+    # first is live initially.
+    sentences = np.full([num_slots, 1], self.vocab.start_id, dtype=np.int64)
+    states = np.repeat(initial_states, beam_size, axis=0)
+    logprobs = np.zeros([num_slots])
+    live = np.zeros([num_images, beam_size], dtype=bool)
+    live[:, 0] = True
+    slot_metadata = [[""]] * num_slots
+
+    complete_captions = [TopN(beam_size) for _ in range(num_images)]
+    active = np.ones([num_images], dtype=bool)
+    image_index = np.arange(num_images)[:, None]
+
+    # Run beam search.
+    for _ in range(self.max_caption_length - 1):
+      live &= active[:, None]
+      rows = np.flatnonzero(live)
+      if not rows.size:
+        break
+
+      softmax, new_states, metadata = self.model.inference_step(
+          sess, sentences[rows, -1], states[rows])
+
+      # For each partial caption, get the beam_size most probable next words.
+      num_words = min(beam_size, softmax.shape[1])
+      # They are ordered by descending probability, with ties broken by word id.
+      row_index = np.arange(len(rows))[:, None]
+      words = np.argpartition(-softmax, num_words - 1, axis=1)[:, :num_words]
+      words = words[row_index, np.lexsort((words, -softmax[row_index, words]))]
+      probs = softmax[row_index, words]
+      valid = probs >= 1e-12  # Avoid log(0).
+      cand_logprobs = (logprobs[rows][:, None] +
+                       np.log(np.where(valid, probs, 1.0)))
+
+      # Candidates that end the caption are complete captions.
+      ended = valid & (words == self.vocab.end_id)
+      for r, j in zip(*np.nonzero(ended)):
+        sentence = sentences[rows[r]].tolist() + [self.vocab.end_id]
+        score = cand_logprobs[r, j]
+        if self.length_normalization_factor > 0:
+          score /= len(sentence)**self.length_normalization_factor
+        if metadata:
+          metadata_list = slot_metadata[rows[r]] + [metadata[r]]
+        else:
+          metadata_list = None
+        complete_captions[rows[r] // beam_size].push(
+            Caption(sentence, new_states[r], cand_logprobs[r, j], score,
+                    metadata_list))
+
+      # The other candidates of an image compete for its beam_size slots. They
+      # are laid out as a [num_images, beam_size * num_words] table.
+      num_cands = beam_size * num_words
+      cand_table = np.full([num_images, num_cands], -np.inf)
+      cand_table_rows = np.zeros([num_images, num_cands], dtype=np.int64)
+      cand_table_index = (rows // beam_size)[:, None], (
+          (rows % beam_size)[:, None] * num_words + np.arange(num_words))
+      cand_table[cand_table_index] = np.where(
+          valid & ~ended, cand_logprobs, -np.inf)
+      cand_table_rows[cand_table_index] = np.arange(len(rows))[:, None]
+
+      # The table is small, so a stable sort is cheap; it keeps the slots in
+      # descending order and breaks ties in favor of better partial captions.
+      best = np.argsort(-cand_table, axis=1, kind="mergesort")[:, :beam_size]
+      best_logprobs = cand_table[image_index, best]
+
+      # Each slot continues the partial caption of its best candidate.
+      parent = cand_table_rows[image_index, best].reshape(-1)
+      new_words = words[parent, best.reshape(-1) % num_words]
+      sentences = np.concatenate(
+          [sentences[rows[parent]], new_words[:, None]], axis=1)
+      states = new_states[parent]
+      logprobs = best_logprobs.reshape(-1)
+      live = np.isfinite(best_logprobs)
+      if metadata:
+        slot_metadata = [
+            slot_metadata[rows[r]] + [metadata[r]] for r in parent]
+      else:
+        slot_metadata = [None] * num_slots
+
+      # An image is finished when it runs out of partial captions. Without
+      # length normalization, scores can only decrease as captions grow, so an
+      # image is also finished once its best partial caption can no longer
+      # displace any of beam_size complete captions.
+      for i in np.flatnonzero(active):
+        if not live[i].any():
+          active[i] = False
+        elif (self.length_normalization_factor == 0 and
+              complete_captions[i].size() == beam_size and
+              best_logprobs[i].max() <= complete_captions[i]._data[0].score):
+          active[i] = False
+
+    results = []
+    for i in range(num_images):
+      # As in beam_search(), fall back to the partial captions if there are no
+      # complete captions, but never output a mixture of both.
+      if complete_captions[i].size():
+        results.append(complete_captions[i].extract(sort=True))
+        continue
+
+      partial_captions = TopN(beam_size)
+      for row in i * beam_size + np.flatnonzero(live[i]):
+        partial_captions.push(
+            Caption(sentences[row].tolist(), states[row], logprobs[row],
+                    logprobs[row], slot_metadata[row]))
+      results.append(partial_captions.extract(sort=True))
+
+    return results
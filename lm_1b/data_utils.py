@@ -15,9 +15,14 @@
 
 """A library for loading 1B word benchmark dataset."""
 
+import bisect
+import itertools
+import os
 import random
+import threading
 
 import numpy as np
+from six.moves import queue as Queue
 import tensorflow as tf
 
 
@@ -161,15 +166,117 @@ class CharsVocabulary(Vocabulary):
     return np.vstack([self.bos_chars] + chars_ids + [self.eos_chars])
 
 
-def get_batch(generator, batch_size, num_steps, max_word_length, pad=False):
-  """Read batches of input."""
-  cur_stream = [None] * batch_size
+class _StepBlock(object):
+  """Consecutive sentences flattened into arrays of language model steps.
+
+  A sentence of n ids contributes n - 1 steps: step j has input ids[j] and
+  target ids[j + 1]. The steps of all sentences in the block are numbered
+  consecutively.
+  """
+
+  def __init__(self, ids, offsets, char_ids, global_word_ids=None):
+    """Initialize the block.
+
+    Args:
+      ids: flat word ids of the sentences.
+      offsets: offset of each sentence in ids, followed by len(ids).
+      char_ids: function mapping an array of indices into ids to char ids.
+      global_word_ids: global word id of each step; defaults to the step.
+    """
+    offsets = np.asarray(offsets)
+    lengths = np.maximum(np.diff(offsets) - 1, 0)
+    sentence_ends = np.cumsum(lengths)
+    self._ids = ids
+    self._char_ids = char_ids
+    self._global_word_ids = global_word_ids
+    self._sentence_ends = sentence_ends.tolist()
+    self.num_steps = self._sentence_ends[-1] if len(lengths) else 0
+    # Index into ids of the input of each step.
+    self._step_ids = np.arange(self.num_steps) + np.repeat(
+        offsets[:-1] - (sentence_ends - lengths), lengths)
+
+  @classmethod
+  def from_sentences(cls, sentences):
+    """Creates a block from (id, char_id, global_word_id) tuples."""
+    ids, char_ids, global_word_ids = zip(*sentences)
+    offsets = np.cumsum([0] + [len(x) for x in ids])
+    char_ids = np.concatenate(char_ids)
+    return cls(np.concatenate(ids), offsets, lambda index: char_ids[index],
+               np.concatenate(global_word_ids))
+
+  @classmethod
+  def from_cached_shard(cls, shard):
+    """Creates a block from all sentences of a CachedShard."""
+    return cls(shard.ids, shard.offsets, shard.char_ids)
+
+  def sentence_end(self, step):
+    """Returns the end of the sentence that contains step."""
+    return self._sentence_ends[bisect.bisect_right(self._sentence_ends, step)]
+
+  def fill(self, starts, lengths, dests, inputs, char_inputs, global_word_ids,
+           targets, weights):
+    """Copies runs of steps into the batch.
+
+    Args:
+      starts: first step of each run.
+      lengths: number of steps of each run.
+      dests: flat position in the batch of the first step of each run.
+      inputs, char_inputs, global_word_ids, targets, weights: batch arrays.
+    """
+    if len(starts) == 1:
+      # A single run is copied with slices.
+      steps = slice(starts[0], starts[0] + lengths[0])
+      dests = slice(dests[0], dests[0] + lengths[0])
+    else:
+      total = sum(lengths)
+      shift = np.arange(total) - np.repeat(
+          np.cumsum(lengths) - lengths, lengths)
+      steps = np.repeat(starts, lengths) + shift
+      dests = np.repeat(dests, lengths) + shift
+    step_ids = self._step_ids[steps]
+    inputs.flat[dests] = self._ids[step_ids]
+    char_inputs.reshape(-1, char_inputs.shape[-1])[dests] = (
+        self._char_ids(step_ids))
+    if self._global_word_ids is None:
+      if isinstance(steps, slice):
+        global_word_ids.flat[dests] = np.arange(steps.start, steps.stop)
+      else:
+        global_word_ids.flat[dests] = steps
+    else:
+      global_word_ids.flat[dests] = self._global_word_ids[steps]
+    targets.flat[dests] = self._ids[step_ids + 1]
+    weights.flat[dests] = 1.0
 
+
+def _sentence_blocks(generator, block_size=1024):
+  """Groups the sentences of a generator into _StepBlocks."""
+  while True:
+    sentences = list(itertools.islice(generator, block_size))
+    if not sentences:
+      return
+    yield _StepBlock.from_sentences(sentences)
+
+
+def _pack_batches(blocks, batch_size, num_steps, max_word_length, pad=False):
+  """Packs the steps of a stream of _StepBlocks into batches.
+
+  Each row of the batch continues the sentence it left off in the previous
+  batch, and then takes the next unread sentences. Sentences are read from a
+  shared cursor in the same order as rows request them, so the batches are
+  the same as when copying one sentence at a time. The runs of steps of a
+  batch are planned first and then copied with one gather per block. The
+  yielded arrays are reused for every batch.
+  """
   inputs = np.zeros([batch_size, num_steps], np.int32)
   char_inputs = np.zeros([batch_size, num_steps, max_word_length], np.int32)
   global_word_ids = np.zeros([batch_size, num_steps], np.int32)
   targets = np.zeros([batch_size, num_steps], np.int32)
   weights = np.ones([batch_size, num_steps], np.float32)
+  outputs = (inputs, char_inputs, global_word_ids, targets, weights)
+
+  # The unread rest of each row's current sentence: (block, start, end).
+  cur_stream = [None] * batch_size
+  block, block_pos = None, 0
 
   no_more_data = False
   while True:
@@ -179,62 +286,205 @@ def get_batch(generator, batch_size, num_steps, max_word_length, pad=False):
     targets[:] = 0
     weights[:] = 0.0
 
+    # Runs of steps to copy, as block -> (starts, lengths, dests).
+    runs = {}
+
+    def add_run(run_block, start, length, dest):
+      if run_block not in runs:
+        runs[run_block] = ([], [], [])
+      run_starts, run_lengths, run_dests = runs[run_block]
+      run_starts.append(start)
+      run_lengths.append(length)
+      run_dests.append(dest)
+
     for i in range(batch_size):
       cur_pos = 0
 
+      if cur_stream[i] is not None and cur_stream[i][1] < cur_stream[i][2]:
+        stream_block, start, end = cur_stream[i]
+        cur_pos = min(end - start, num_steps)
+        add_run(stream_block, start, cur_pos, i * num_steps)
+        cur_stream[i] = (stream_block, start + cur_pos, end)
+        if pad:
+          continue
+
       while cur_pos < num_steps:
-        if cur_stream[i] is None or len(cur_stream[i][0]) <= 1:
-          try:
-            cur_stream[i] = list(generator.next())
-          except StopIteration:
-            # No more data, exhaust current streams and quit
-            no_more_data = True
+        while block is None or block_pos >= block.num_steps:
+          block = next(blocks, None)
+          block_pos = 0
+          if block is None:
             break
 
-        how_many = min(len(cur_stream[i][0]) - 1, num_steps - cur_pos)
-        next_pos = cur_pos + how_many
+        if block is None:
+          # No more data, exhaust current streams and quit
+          no_more_data = True
+          break
 
-        inputs[i, cur_pos:next_pos] = cur_stream[i][0][:how_many]
-        char_inputs[i, cur_pos:next_pos] = cur_stream[i][1][:how_many]
-        global_word_ids[i, cur_pos:next_pos] = cur_stream[i][2][:how_many]
-        targets[i, cur_pos:next_pos] = cur_stream[i][0][1:how_many+1]
-        weights[i, cur_pos:next_pos] = 1.0
+        how_many = min(block.num_steps - block_pos, num_steps - cur_pos)
+        if pad:
+          how_many = min(how_many, block.sentence_end(block_pos) - block_pos)
+        next_pos = block_pos + how_many
+        add_run(block, block_pos, how_many, i * num_steps + cur_pos)
 
-        cur_pos = next_pos
-        cur_stream[i][0] = cur_stream[i][0][how_many:]
-        cur_stream[i][1] = cur_stream[i][1][how_many:]
-        cur_stream[i][2] = cur_stream[i][2][how_many:]
+        # The row owns the rest of the last sentence it read from.
+        cur_pos += how_many
+        end = block.sentence_end(next_pos - 1)
+        cur_stream[i] = (block, next_pos, end)
+        block_pos = end
 
         if pad:
           break
 
+    for run_block, (starts, lengths, dests) in runs.items():
+      run_block.fill(starts, lengths, dests, *outputs)
+
     if no_more_data and np.sum(weights) == 0:
       # There is no more data and this is an empty batch. Done!
       break
-    yield inputs, char_inputs, global_word_ids, targets, weights
+    yield outputs
+
+
+def get_batch(generator, batch_size, num_steps, max_word_length, pad=False):
+  """Read batches of input."""
+  return _pack_batches(_sentence_blocks(generator), batch_size, num_steps,
+                       max_word_length, pad=pad)
+
+
+def _save_array(filename, array):
+  """Saves an array as .npy, atomically replacing filename."""
+  with tf.gfile.Open(filename + '.tmp', 'wb') as f:
+    np.save(f, array)
+  tf.gfile.Rename(filename + '.tmp', filename, overwrite=True)
+
+
+def convert_shard(shard_name, vocab, cache_prefix):
+  """Converts a tokenized text shard into the pre-tokenized cache format.
+
+  The cache consists of four .npy files, which are memory-mapped by
+  CachedShard:
+
+    <cache_prefix>.ids.npy: int32 word ids of all sentences, concatenated,
+      each with its <S> and </S> ids as produced by Vocabulary.encode.
+    <cache_prefix>.offsets.npy: int64 offset of each sentence in the ids,
+      followed by the total number of ids.
+    <cache_prefix>.char_index.npy: int32 row of the char ids of each word.
+      Rows below vocab.size index vocab.word_char_ids; the others index the
+      extra chars.
+    <cache_prefix>.extra_chars.npy: int32 char ids of the begin and end of
+      sentence markers, followed by those of the out-of-vocabulary words.
+
+  Args:
+    shard_name: file path.
+    vocab: CharsVocabulary.
+    cache_prefix: path prefix of the cache files.
+  """
+  tf.logging.info('Converting %s to %s', shard_name, cache_prefix)
+  with tf.gfile.Open(shard_name) as f:
+    sentences = f.readlines()
+
+  bos_row, eos_row = vocab.size, vocab.size + 1
+  extra_chars = [vocab.bos_chars, vocab.eos_chars]
+  oov_rows = {}
+
+  ids = []
+  char_index = []
+  offsets = [0]
+  for sentence in sentences:
+    ids.append(vocab.encode(sentence))
+    char_index.append(bos_row)
+    for word, word_id in zip(sentence.split(), ids[-1][1:-1]):
+      if word_id < 0 or vocab.id_to_word(word_id) != word:
+        if word not in oov_rows:
+          oov_rows[word] = vocab.size + len(extra_chars)
+          extra_chars.append(vocab.word_to_char_ids(word))
+        char_index.append(oov_rows[word])
+      else:
+        char_index.append(word_id)
+    char_index.append(eos_row)
+    offsets.append(offsets[-1] + len(ids[-1]))
+
+  _save_array(cache_prefix + '.ids.npy',
+              np.concatenate(ids) if ids else np.zeros([0], np.int32))
+  _save_array(cache_prefix + '.char_index.npy',
+              np.array(char_index, dtype=np.int32))
+  _save_array(cache_prefix + '.extra_chars.npy', np.vstack(extra_chars))
+  # The offsets are written last, so that their presence marks a complete
+  # cache.
+  _save_array(cache_prefix + '.offsets.npy', np.array(offsets, dtype=np.int64))
+
+
+class CachedShard(object):
+  """A shard in the pre-tokenized cache format written by convert_shard.
+
+  The arrays are memory-mapped; sentences are returned as (id, char_id,
+  global_word_id) tuples just like LM1BDataset._load_shard returns them, with
+  the ids being zero-copy slices of the mapped file.
+  """
+
+  def __init__(self, cache_prefix, vocab):
+    self._vocab = vocab
+    self.ids = np.load(cache_prefix + '.ids.npy', mmap_mode='r')
+    self.offsets = np.load(cache_prefix + '.offsets.npy', mmap_mode='r')
+    self.char_index = np.load(cache_prefix + '.char_index.npy', mmap_mode='r')
+    self.extra_chars = np.load(cache_prefix + '.extra_chars.npy')
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def char_ids(self, index):
+    """Returns the char ids of the words at an index (slice or array) of ids."""
+    rows = np.asarray(self.char_index[index])
+    word_char_ids = self._vocab.word_char_ids
+    chars = word_char_ids[np.minimum(rows, len(word_char_ids) - 1)]
+    extra = rows >= len(word_char_ids)
+    chars[extra] = self.extra_chars[rows[extra] - len(word_char_ids)]
+    return chars
+
+  def __iter__(self):
+    for i in range(len(self)):
+      start, end = self.offsets[i], self.offsets[i + 1]
+      # Global word ids count the words of the shard without <BOS> symbols.
+      yield (self.ids[start:end], self.char_ids(slice(start, end)),
+             np.arange(start - i, end - i - 1))
 
 
 class LM1BDataset(object):
   """Utility class for 1B word benchmark dataset.
 
   The current implementation reads the data from the tokenized text files.
+  If a cache directory is given, each shard is converted once into a compact
+  pre-tokenized format (see convert_shard) that is memory-mapped on later
+  loads.
   """
 
-  def __init__(self, filepattern, vocab):
+  def __init__(self, filepattern, vocab, cache_dir=None, prefetch=False):
     """Initialize LM1BDataset reader.
 
     Args:
       filepattern: Dataset file pattern.
       vocab: Vocabulary.
+      cache_dir: Optional directory for pre-tokenized shards.
+      prefetch: Whether to load the next random shard in a background thread
+        while the current one is read.
     """
     self._vocab = vocab
     self._all_shards = tf.gfile.Glob(filepattern)
+    self._cache_dir = cache_dir
+    self._prefetch = prefetch
     tf.logging.info('Found %d shards at %s', len(self._all_shards), filepattern)
+    if cache_dir and not tf.gfile.Exists(cache_dir):
+      tf.gfile.MakeDirs(cache_dir)
 
   def _load_random_shard(self):
     """Randomly select a file and read it."""
     return self._load_shard(random.choice(self._all_shards))
 
+  def _cache_prefix(self, shard_name):
+    """Returns the cache path prefix of a shard for the current vocabulary."""
+    return os.path.join(self._cache_dir, '%s.v%d.w%d' % (
+        os.path.basename(shard_name), self.vocab.size,
+        self.vocab.max_word_length))
+
   def _load_shard(self, shard_name):
     """Read one file and convert to ids.
 
@@ -242,8 +492,16 @@ class LM1BDataset(object):
       shard_name: file path.
 
     Returns:
-      list of (id, char_id, global_word_id) tuples.
+      list of (id, char_id, global_word_id) tuples, or a CachedShard with the
+      same contents if a cache directory is used.
     """
+    if self._cache_dir:
+      cache_prefix = self._cache_prefix(shard_name)
+      if not tf.gfile.Exists(cache_prefix + '.offsets.npy'):
+        convert_shard(shard_name, self.vocab, cache_prefix)
+      tf.logging.info('Loading cached data from: %s', cache_prefix)
+      return CachedShard(cache_prefix, self.vocab)
+
     tf.logging.info('Loading data from: %s', shard_name)
     with tf.gfile.Open(shard_name) as f:
       sentences = f.readlines()
@@ -262,15 +520,38 @@ class LM1BDataset(object):
     tf.logging.info('Finished loading')
     return zip(ids, chars_ids, global_word_ids)
 
-  def _get_sentence(self, forever=True):
+  def _get_shards(self, forever=True):
+    """Yields random shards, prefetching the next one if enabled."""
+    if not (forever and self._prefetch):
+      while True:
+        yield self._load_random_shard()
+        if not forever:
+          return
+
+    shards = Queue.Queue(maxsize=1)
+
+    def _load_shards():
+      while True:
+        shards.put(self._load_random_shard())
+
+    loader = threading.Thread(target=_load_shards)
+    loader.daemon = True
+    loader.start()
     while True:
-      ids = self._load_random_shard()
+      yield shards.get()
+
+  def _get_sentence(self, forever=True):
+    for ids in self._get_shards(forever):
       for current_ids in ids:
         yield current_ids
-      if not forever:
-        break
 
   def get_batch(self, batch_size, num_steps, pad=False, forever=True):
+    if self._cache_dir:
+      # Cached shards are packed directly, without splitting into sentences.
+      blocks = (_StepBlock.from_cached_shard(shard)
+                for shard in self._get_shards(forever))
+      return _pack_batches(blocks, batch_size, num_steps,
+                           self.vocab.max_word_length, pad=pad)
     return get_batch(self._get_sentence(forever), batch_size, num_steps,
                      self.vocab.max_word_length, pad=pad)
 
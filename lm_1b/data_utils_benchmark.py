@@ -0,0 +1,67 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Benchmark the batch input pipeline of the 1 billion word language model.
+
+Reports how many batches per second LM1BDataset.get_batch produces, without
+running the model.
+"""
+from datetime import datetime
+import time
+
+import tensorflow as tf
+
+import data_utils
+
+FLAGS = tf.flags.FLAGS
+tf.flags.DEFINE_string('vocab_file', '', 'Vocabulary file.')
+tf.flags.DEFINE_string('input_data', '', 'Input data files.')
+tf.flags.DEFINE_string('cache_dir', '',
+                       'If set, directory where the input data shards are '
+                       'cached in pre-tokenized form.')
+tf.flags.DEFINE_integer('batch_size', 128, 'Batch size.')
+tf.flags.DEFINE_integer('num_steps', 20, 'Number of time steps per batch.')
+tf.flags.DEFINE_integer('num_batches', 1000, 'Number of batches to time.')
+tf.flags.DEFINE_integer('max_word_length', 50, 'Maximum word length.')
+tf.flags.DEFINE_bool('pad', False, 'Whether to pad batches at sentence ends.')
+tf.flags.DEFINE_bool('prefetch', False,
+                     'Whether to load the next shard in the background.')
+
+
+def main(unused_argv):
+  vocab = data_utils.CharsVocabulary(FLAGS.vocab_file, FLAGS.max_word_length)
+  dataset = data_utils.LM1BDataset(FLAGS.input_data, vocab,
+                                   cache_dir=FLAGS.cache_dir or None,
+                                   prefetch=FLAGS.prefetch)
+  data_gen = dataset.get_batch(FLAGS.batch_size, FLAGS.num_steps,
+                               pad=FLAGS.pad)
+
+  # The first batch includes loading (and possibly caching) the first shard.
+  num_steps_burn_in = 10
+  for _ in xrange(num_steps_burn_in):
+    data_gen.next()
+
+  start_time = time.time()
+  for _ in xrange(FLAGS.num_batches):
+    data_gen.next()
+  duration = time.time() - start_time
+
+  print ('%s: %d batches of %d x %d, %.1f batches / sec' %
+         (datetime.now(), FLAGS.num_batches, FLAGS.batch_size,
+          FLAGS.num_steps, FLAGS.num_batches / duration))
+
+
+if __name__ == '__main__':
+  tf.app.run()
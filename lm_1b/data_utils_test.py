@@ -0,0 +1,149 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for the lm_1b batch input pipeline."""
+
+import os
+import random
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+import data_utils
+
+
+def _reference_get_batch(generator, batch_size, num_steps, max_word_length,
+                         pad=False):
+  """data_utils.get_batch before it was vectorized, one sentence at a time."""
+  cur_stream = [None] * batch_size
+
+  inputs = np.zeros([batch_size, num_steps], np.int32)
+  char_inputs = np.zeros([batch_size, num_steps, max_word_length], np.int32)
+  global_word_ids = np.zeros([batch_size, num_steps], np.int32)
+  targets = np.zeros([batch_size, num_steps], np.int32)
+  weights = np.ones([batch_size, num_steps], np.float32)
+
+  no_more_data = False
+  while True:
+    inputs[:] = 0
+    char_inputs[:] = 0
+    global_word_ids[:] = 0
+    targets[:] = 0
+    weights[:] = 0.0
+
+    for i in range(batch_size):
+      cur_pos = 0
+
+      while cur_pos < num_steps:
+        if cur_stream[i] is None or len(cur_stream[i][0]) <= 1:
+          try:
+            cur_stream[i] = list(next(generator))
+          except StopIteration:
+            # No more data, exhaust current streams and quit
+            no_more_data = True
+            break
+
+        how_many = min(len(cur_stream[i][0]) - 1, num_steps - cur_pos)
+        next_pos = cur_pos + how_many
+
+        inputs[i, cur_pos:next_pos] = cur_stream[i][0][:how_many]
+        char_inputs[i, cur_pos:next_pos] = cur_stream[i][1][:how_many]
+        global_word_ids[i, cur_pos:next_pos] = cur_stream[i][2][:how_many]
+        targets[i, cur_pos:next_pos] = cur_stream[i][0][1:how_many+1]
+        weights[i, cur_pos:next_pos] = 1.0
+
+        cur_pos = next_pos
+        cur_stream[i][0] = cur_stream[i][0][how_many:]
+        cur_stream[i][1] = cur_stream[i][1][how_many:]
+        cur_stream[i][2] = cur_stream[i][2][how_many:]
+
+        if pad:
+          break
+
+    if no_more_data and np.sum(weights) == 0:
+      # There is no more data and this is an empty batch. Done!
+      break
+    yield inputs, char_inputs, global_word_ids, targets, weights
+
+
+class GetBatchTest(tf.test.TestCase):
+
+  def setUp(self):
+    self._tmpdir = tempfile.mkdtemp(dir=tf.test.get_temp_dir())
+    words = ['the', 'cat', 'sat', 'on', 'a', 'mat', 'supercalifragilistic']
+    self._vocab_file = os.path.join(self._tmpdir, 'vocab.txt')
+    with tf.gfile.Open(self._vocab_file, 'w') as f:
+      f.write('\n'.join(['<S>', '</S>', '<UNK>'] + words) + '\n')
+
+    # Sentences of 0 to 12 words, including some out of the vocabulary.
+    rng = random.Random(0)
+    oovs = ['dog', 'ran', 'extraordinarily']
+    sentences = []
+    for _ in range(40):
+      sentence = [rng.choice(words + oovs) for _ in range(rng.randint(0, 12))]
+      sentences.append(' '.join(sentence) + '\n')
+    self._shard = os.path.join(self._tmpdir, 'shard-00000')
+    with tf.gfile.Open(self._shard, 'w') as f:
+      f.write(''.join(sentences))
+
+    self._vocab = data_utils.CharsVocabulary(self._vocab_file, 10)
+
+  def _dataset(self, cache_dir=None):
+    return data_utils.LM1BDataset(self._shard, self._vocab,
+                                  cache_dir=cache_dir)
+
+  def _assertSameBatches(self, expected, actual):
+    # Both generators reuse their arrays, so batches are compared one by one.
+    num_batches = 0
+    for expected_batch, actual_batch in zip(expected, actual):
+      for expected_array, actual_array in zip(expected_batch, actual_batch):
+        self.assertAllEqual(expected_array, actual_array)
+      num_batches += 1
+    self.assertGreater(num_batches, 0)
+    self.assertIsNone(next(expected, None))
+    self.assertIsNone(next(actual, None))
+
+  def _testGetBatch(self, dataset):
+    for batch_size, num_steps in [(1, 5), (3, 4), (4, 7), (5, 1), (8, 30)]:
+      for pad in [False, True]:
+        expected = _reference_get_batch(
+            self._dataset()._get_sentence(forever=False), batch_size,
+            num_steps, self._vocab.max_word_length, pad=pad)
+        actual = dataset.get_batch(batch_size, num_steps, pad=pad,
+                                   forever=False)
+        self._assertSameBatches(expected, actual)
+
+  def testGetBatch(self):
+    self._testGetBatch(self._dataset())
+
+  def testGetBatchCached(self):
+    cache_dir = os.path.join(self._tmpdir, 'cache')
+    # The first batches convert the shard, later ones read the cache.
+    self._testGetBatch(self._dataset(cache_dir))
+
+  def testCachedShard(self):
+    cache_dir = os.path.join(self._tmpdir, 'cache')
+    sentences = list(self._dataset()._load_shard(self._shard))
+    cached = self._dataset(cache_dir)._load_shard(self._shard)
+    self.assertTrue(isinstance(cached, data_utils.CachedShard))
+    self.assertEqual(len(sentences), len(cached))
+    for expected, actual in zip(sentences, cached):
+      for expected_array, actual_array in zip(expected, actual):
+        self.assertAllEqual(expected_array, actual_array)
+
+
+if __name__ == '__main__':
+  tf.test.main()
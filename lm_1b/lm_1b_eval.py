@@ -62,6 +62,9 @@ tf.flags.DEFINE_string('input_data', '',
                        'Input data files for eval model.')
 tf.flags.DEFINE_integer('max_eval_steps', 1000000,
                         'Maximum mumber of steps to run "eval" mode.')
+tf.flags.DEFINE_string('cache_dir', '',
+                       'If set, directory where the input data shards are '
+                       'cached in pre-tokenized form for "eval" mode.')
 
 
 # For saving demo resources, use batch size 1 and step 1.
@@ -291,7 +294,8 @@ def main(unused_argv):
   vocab = data_utils.CharsVocabulary(FLAGS.vocab_file, MAX_WORD_LEN)
 
   if FLAGS.mode == 'eval':
-    dataset = data_utils.LM1BDataset(FLAGS.input_data, vocab)
+    dataset = data_utils.LM1BDataset(FLAGS.input_data, vocab,
+                                     cache_dir=FLAGS.cache_dir or None)
     _EvalModel(dataset)
   elif FLAGS.mode == 'sample':
     _SampleModel(FLAGS.prefix, vocab)
@@ -15,8 +15,15 @@
 """Functions for constructing vocabulary, converting the examples to integer format and building the required masks for batch computation Author: aneelakantan (Arvind Neelakantan)
 """
 
+import collections
 import copy
+import cPickle
+import hashlib
+import multiprocessing
 import numbers
+import os
+import Queue
+import threading
 import numpy as np
 import wiki_data
 
@@ -118,83 +125,99 @@ def convert_to_bool_and_pad(a, utility):
 seen_tables = {}
 
 
-def partial_match(question, table, number):
-  answer = []
-  match = {}
-  for i in range(len(table)):
-    temp = []
-    for j in range(len(table[i])):
-      temp.append(0)
-    answer.append(temp)
-  for i in range(len(table)):
-    for j in range(len(table[i])):
-      for word in question:
+class TableIndex(object):
+  #inverted index from the entries of a table to their positions. table is a
+  #list of columns whose entries are numbers if number is set and lists of
+  #words otherwise. positions are offsets in the concatenated columns.
+
+  def __init__(self, table, number):
+    self.number = number
+    lengths = [len(column) for column in table]
+    self.offsets = np.cumsum([0] + lengths)
+    self.columns = np.repeat(np.arange(len(table)), lengths)
+    entries = collections.defaultdict(list)
+    words = collections.defaultdict(list)
+    position = 0
+    for column in table:
+      for entry in column:
         if (number):
-          if (word == table[i][j]):
-            answer[i][j] = 1.0
-            match[i] = 1.0
+          #nan is not equal to any question word
+          if (entry == entry):
+            entries[entry].append(position)
         else:
-          if (word in table[i][j]):
-            answer[i][j] = 1.0
-            match[i] = 1.0
-  return answer, match
+          entries[tuple(entry)].append(position)
+          for word in entry:
+            words[word].append(position)
+        position += 1
+    self.entries = dict((k, np.array(v)) for k, v in entries.items())
+    self.words = dict((k, np.unique(v)) for k, v in words.items())
+    self.entry_lengths = sorted(set(len(k) for k in entries)) if (
+        not (number)) else []
+
+  def split(self, answer):
+    #splits an answer over positions into a list per column
+    return [
+        answer[start:end].tolist()
+        for (start, end) in zip(self.offsets[:-1], self.offsets[1:])
+    ]
+
+  def matched_columns(self, answer):
+    return dict.fromkeys(np.unique(self.columns[answer > 0]).tolist(), 1.0)
+
+  def exact_match(self, question):
+    #returns the answer over positions and the (start, length) of the
+    #question n-grams equal to an entry, in the order of their entries
+    answer = np.zeros(self.offsets[-1])
+    if (self.number):
+      for word in question:
+        positions = self.entries.get(word)
+        if (positions is not None):
+          answer[positions] = 1.0
+      return answer, []
+    hits = []
+    for length in self.entry_lengths:
+      for k in range(len(question) - max(length, 1) + 1):
+        positions = self.entries.get(tuple(question[k:(k + length)]))
+        if (positions is not None):
+          answer[positions] = 1.0
+          hits += [(position, k, length) for position in positions.tolist()]
+    hits.sort()
+    return answer, [(k, length) for (position, k, length) in hits]
+
+  def partial_match(self, question):
+    #returns the answer over positions of the entries containing a question
+    #word
+    if (self.number):
+      return self.exact_match(question)[0]
+    answer = np.zeros(self.offsets[-1])
+    for word in question:
+      positions = self.words.get(word)
+      if (positions is not None):
+        answer[positions] = 1.0
+    return answer
+
+
+def partial_match(question, table, number):
+  index = TableIndex(table, number)
+  answer = index.partial_match(question)
+  return index.split(answer), index.matched_columns(answer)
 
 
 def exact_match(question, table, number):
   #performs exact match operation
-  answer = []
-  match = {}
-  matched_indices = []
-  for i in range(len(table)):
-    temp = []
-    for j in range(len(table[i])):
-      temp.append(0)
-    answer.append(temp)
-  for i in range(len(table)):
-    for j in range(len(table[i])):
-      if (number):
-        for word in question:
-          if (word == table[i][j]):
-            match[i] = 1.0
-            answer[i][j] = 1.0
-      else:
-        table_entry = table[i][j]
-        for k in range(len(question)):
-          if (k + len(table_entry) <= len(question)):
-            if (table_entry == question[k:(k + len(table_entry))]):
-              #if(len(table_entry) == 1):
-              #print "match: ", table_entry, question
-              match[i] = 1.0
-              answer[i][j] = 1.0
-              matched_indices.append((k, len(table_entry)))
-  return answer, match, matched_indices
+  index = TableIndex(table, number)
+  answer, matched_indices = index.exact_match(question)
+  return index.split(answer), index.matched_columns(answer), matched_indices
 
 
 def partial_column_match(question, table, number):
-  answer = []
-  for i in range(len(table)):
-    answer.append(0)
-  for i in range(len(table)):
-    for word in question:
-      if (word in table[i]):
-        answer[i] = 1.0
-  return answer
+  return TableIndex([table], False).partial_match(question).tolist()
 
 
 def exact_column_match(question, table, number):
   #performs exact match on column names
-  answer = []
-  matched_indices = []
-  for i in range(len(table)):
-    answer.append(0)
-  for i in range(len(table)):
-    table_entry = table[i]
-    for k in range(len(question)):
-      if (k + len(table_entry) <= len(question)):
-        if (table_entry == question[k:(k + len(table_entry))]):
-          answer[i] = 1.0
-          matched_indices.append((k, len(table_entry)))
-  return answer, matched_indices
+  answer, matched_indices = TableIndex([table], False).exact_match(question)
+  return answer.tolist(), matched_indices
 
 
 def get_max_entry(a):
@@ -252,6 +275,100 @@ def pick_one(a):
   return False
 
 
+class TableMatcher(object):
+  #indexes of the entries and column names of the table of an example, to
+  #match the questions asked about the table
+
+  def __init__(self, example):
+    self.word_index = TableIndex(example.original_wc, False)
+    self.number_index = TableIndex(example.original_nc, True)
+    self.word_column_index = TableIndex([example.original_wc_names], False)
+    self.number_column_index = TableIndex([example.original_nc_names], False)
+    #group by max only depends on the table
+    self.word_group_by_max = group_by_max(example.original_wc, False)
+    self.number_group_by_max = group_by_max(example.original_nc, True)
+    self.digest = hashlib.md5(
+        repr((example.original_wc, example.original_nc,
+              example.original_wc_names, example.original_nc_names))).digest()
+
+  def cache_key(self, question):
+    return hashlib.md5(self.digest + repr(question)).hexdigest()
+
+  def match(self, question):
+    #entry match, falls back to partial match if no entry matches exactly
+    word_match, matched_indices = self.word_index.exact_match(question)
+    number_match, _ = self.number_index.exact_match(question)
+    if (not (word_match.any()) and not (number_match.any())):
+      word_match = self.word_index.partial_match(question)
+    #column name match
+    word_column_match, _ = self.word_column_index.exact_match(question)
+    number_column_match, _ = self.number_column_index.exact_match(question)
+    if (not (word_column_match.any()) and not (number_column_match.any())):
+      word_column_match = self.word_column_index.partial_match(question)
+      number_column_match = self.number_column_index.partial_match(question)
+    return (word_match > 0, number_match > 0, matched_indices,
+            word_column_match > 0, number_column_match > 0)
+
+
+_pool_matchers = None
+
+
+def _match_question_worker(args):
+  table_key, question = args
+  return _pool_matchers[table_key].match(question)
+
+
+def match_questions(data, utility):
+  #matches the questions of the good examples in data with their tables, in a
+  #pool of FLAGS.num_processes processes. the matches are cached on disk in
+  #FLAGS.match_cache_dir, keyed by the table and question. returns the table
+  #matchers and the matches of each example (None for bad examples)
+  global _pool_matchers
+  matchers = {}
+  keys = []
+  for example in data:
+    if (example.is_bad_example):
+      keys.append(None)
+      continue
+    if (not (matchers.has_key(example.table_key))):
+      matchers[example.table_key] = TableMatcher(example)
+    keys.append(matchers[example.table_key].cache_key(example.question))
+  cache = {}
+  cache_file = None
+  if (utility.FLAGS.match_cache_dir):
+    cache_file = os.path.join(utility.FLAGS.match_cache_dir, "matches.pkl")
+    if (os.path.exists(cache_file)):
+      with open(cache_file, "rb") as f:
+        cache = cPickle.load(f)
+  todo = {}
+  for example, key in zip(data, keys):
+    if (key is not None and not (cache.has_key(key))):
+      todo[key] = (example.table_key, example.question)
+  if (len(todo) > 0):
+    if (utility.FLAGS.num_processes > 0):
+      _pool_matchers = matchers
+      pool = multiprocessing.Pool(utility.FLAGS.num_processes)
+      _pool_matchers = None
+      matches = pool.map(_match_question_worker, todo.values(), chunksize=64)
+      pool.close()
+      pool.join()
+    else:
+      matches = [
+          matchers[table_key].match(question)
+          for (table_key, question) in todo.values()
+      ]
+    cache.update(zip(todo.keys(), matches))
+    if (cache_file is not None):
+      if (not (os.path.isdir(utility.FLAGS.match_cache_dir))):
+        os.makedirs(utility.FLAGS.match_cache_dir)
+      with open(cache_file + ".tmp", "wb") as f:
+        cPickle.dump(cache, f, cPickle.HIGHEST_PROTOCOL)
+      os.rename(cache_file + ".tmp", cache_file)
+  print "matched questions: ", len(todo), " cached: ", len(
+      [key for key in keys if key is not None]) - len(todo)
+  return matchers, [cache.get(key) for key in keys]
+
+
 def check_processed_cols(col, utility):
   return True in [
       True for y in col
@@ -264,7 +381,8 @@ def complete_wiki_processing(data, utility, train=True):
   #convert to integers and padding
   processed_data = []
   num_bad_examples = 0
-  for example in data:
+  matchers, example_matches = match_questions(data, utility)
+  for example, matches in zip(data, example_matches):
     number_found = 0
     if (example.is_bad_example):
       num_bad_examples += 1
@@ -273,34 +391,28 @@ def complete_wiki_processing(data, utility, train=True):
       #entry match
       example.processed_number_columns = example.processed_number_columns[:]
       example.processed_word_columns = example.processed_word_columns[:]
-      example.word_exact_match, word_match, matched_indices = exact_match(
-          example.string_question, example.original_wc, number=False)
-      example.number_exact_match, number_match, _ = exact_match(
-          example.string_question, example.original_nc, number=True)
-      if (not (pick_one(example.word_exact_match)) and not (
-          pick_one(example.number_exact_match))):
-        assert len(word_match) == 0
-        assert len(number_match) == 0
-        example.word_exact_match, word_match = partial_match(
-            example.string_question, example.original_wc, number=False)
+      (word_match, number_match, matched_indices, word_column_match,
+       number_column_match) = matches
+      matcher = matchers[example.table_key]
+      example.word_exact_match = matcher.word_index.split(
+          word_match.astype(np.float64))
+      example.number_exact_match = matcher.number_index.split(
+          number_match.astype(np.float64))
       #group by max
-      example.word_group_by_max = group_by_max(example.original_wc, False)
-      example.number_group_by_max = group_by_max(example.original_nc, True)
+      example.word_group_by_max = [
+          column[:] for column in matcher.word_group_by_max
+      ]
+      example.number_group_by_max = [
+          column[:] for column in matcher.number_group_by_max
+      ]
       #column name match
-      example.word_column_exact_match, wcol_matched_indices = exact_column_match(
-          example.string_question, example.original_wc_names, number=False)
-      example.number_column_exact_match, ncol_matched_indices = exact_column_match(
-          example.string_question, example.original_nc_names, number=False)
-      if (not (1.0 in example.word_column_exact_match) and not (
-          1.0 in example.number_column_exact_match)):
-        example.word_column_exact_match = partial_column_match(
-            example.string_question, example.original_wc_names, number=False)
-        example.number_column_exact_match = partial_column_match(
-            example.string_question, example.original_nc_names, number=False)
-      if (len(word_match) > 0 or len(number_match) > 0):
+      example.word_column_exact_match = word_column_match.astype(
+          np.float64).tolist()
+      example.number_column_exact_match = number_column_match.astype(
+          np.float64).tolist()
+      if (word_match.any() or number_match.any()):
         example.question.append(utility.entry_match_token)
-      if (1.0 in example.word_column_exact_match or
-          1.0 in example.number_column_exact_match):
+      if (word_column_match.any() or number_column_match.any()):
         example.question.append(utility.column_match_token)
       example.string_question = example.question[:]
       example.number_lookup_matrix = np.transpose(
@@ -581,84 +693,152 @@ def word_dropout(question, utility):
     return question
 
 
-def generate_feed_dict(data, curr, batch_size, gr, train=False, utility=None):
-  #prepare feed dict dictionary
-  feed_dict = {}
-  feed_examples = []
-  for j in range(batch_size):
-    feed_examples.append(data[curr + j])
-  if (train):
-    feed_dict[gr.batch_question] = [
-        word_dropout(feed_examples[j].question, utility)
-        for j in range(batch_size)
-    ]
+def batch_word_dropout(questions, utility):
+  #word dropout on an array of questions
+  if (utility.FLAGS.word_dropout_prob > 0.0):
+    dropped = np.logical_and(
+        questions != utility.dummy_token_id,
+        utility.np_random.random_sample(questions.shape) >
+        utility.FLAGS.word_dropout_prob)
+    return np.where(dropped, utility.word_ids[utility.unk_token], questions)
   else:
-    feed_dict[gr.batch_question] = [
-        feed_examples[j].question for j in range(batch_size)
-    ]
-  feed_dict[gr.batch_question_attention_mask] = [
-      feed_examples[j].question_attention_mask for j in range(batch_size)
-  ]
-  feed_dict[
-      gr.batch_answer] = [feed_examples[j].answer for j in range(batch_size)]
-  feed_dict[gr.batch_number_column] = [
-      feed_examples[j].columns for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_processed_number_column] = [
-      feed_examples[j].processed_number_columns for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_processed_sorted_index_number_column] = [
-      feed_examples[j].sorted_number_index for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_processed_sorted_index_word_column] = [
-      feed_examples[j].sorted_word_index for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_question_number] = np.array(
-      [feed_examples[j].question_number for j in range(batch_size)]).reshape(
-          (batch_size, 1))
-  feed_dict[gr.batch_question_number_one] = np.array(
-      [feed_examples[j].question_number_1 for j in range(batch_size)]).reshape(
-          (batch_size, 1))
-  feed_dict[gr.batch_question_number_mask] = [
-      feed_examples[j].question_number_mask for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_question_number_one_mask] = np.array(
-      [feed_examples[j].question_number_one_mask for j in range(batch_size)
-      ]).reshape((batch_size, 1))
-  feed_dict[gr.batch_print_answer] = [
-      feed_examples[j].print_answer for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_exact_match] = [
-      feed_examples[j].exact_match for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_group_by_max] = [
-      feed_examples[j].group_by_max for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_column_exact_match] = [
-      feed_examples[j].exact_column_match for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_ordinal_question] = [
-      feed_examples[j].ordinal_question for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_ordinal_question_one] = [
-      feed_examples[j].ordinal_question_one for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_number_column_mask] = [
-      feed_examples[j].column_mask for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_number_column_names] = [
-      feed_examples[j].column_ids for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_processed_word_column] = [
-      feed_examples[j].processed_word_columns for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_word_column_mask] = [
-      feed_examples[j].word_column_mask for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_word_column_names] = [
-      feed_examples[j].word_column_ids for j in range(batch_size)
-  ]
-  feed_dict[gr.batch_word_column_entry_mask] = [
-      feed_examples[j].word_column_entry_mask for j in range(batch_size)
-  ]
-  return feed_dict
+    return questions
+
+
+#feeds of the graph, the attributes of the processed examples that they are
+#built from and their type (None for the data type of the graph)
+FEEDS = [
+    ("batch_question", "question", np.int32),
+    ("batch_question_attention_mask", "question_attention_mask", None),
+    ("batch_answer", "answer", None),
+    ("batch_number_column", "columns", None),
+    ("batch_processed_number_column", "processed_number_columns", None),
+    ("batch_processed_sorted_index_number_column", "sorted_number_index",
+     np.int32),
+    ("batch_processed_sorted_index_word_column", "sorted_word_index",
+     np.int32),
+    ("batch_question_number", "question_number", None),
+    ("batch_question_number_one", "question_number_1", None),
+    ("batch_question_number_mask", "question_number_mask", None),
+    ("batch_question_number_one_mask", "question_number_one_mask", None),
+    ("batch_print_answer", "print_answer", None),
+    ("batch_exact_match", "exact_match", None),
+    ("batch_group_by_max", "group_by_max", None),
+    ("batch_column_exact_match", "exact_column_match", None),
+    ("batch_ordinal_question", "ordinal_question", None),
+    ("batch_ordinal_question_one", "ordinal_question_one", None),
+    ("batch_number_column_mask", "column_mask", None),
+    ("batch_number_column_names", "column_ids", np.int32),
+    ("batch_processed_word_column", "processed_word_columns", None),
+    ("batch_word_column_mask", "word_column_mask", None),
+    ("batch_word_column_names", "word_column_ids", np.int32),
+    ("batch_word_column_entry_mask", "word_column_entry_mask", np.int32),
+]
+#feeds with a trailing dimension of size 1
+SCALAR_FEEDS = [
+    "batch_question_number", "batch_question_number_one",
+    "batch_question_number_one_mask"
+]
+
+
+def feed_array(data, name, attribute, dtype, utility):
+  array = np.array(
+      [getattr(example, attribute) for example in data],
+      dtype=dtype or utility.np_data_type[utility.FLAGS.data_type])
+  if (name in SCALAR_FEEDS):
+    array = array.reshape((len(data), 1))
+  return array
+
+
+class FeedArrays(object):
+  #the processed examples as one padded array per feed of the graph, whose
+  #first dimension is the example. if cache_dir is set, the arrays are saved
+  #there as .npy files, keyed by the examples, vocabulary and padding flags,
+  #and memory-mapped
+
+  def __init__(self, data, utility, cache_dir=""):
+    self.num_examples = len(data)
+    if (not (cache_dir)):
+      self.arrays = dict((name, feed_array(data, name, attribute, dtype,
+                                           utility))
+                         for (name, attribute, dtype) in FEEDS)
+      return
+    FLAGS = utility.FLAGS
+    key = repr(([example.question_id for example in data],
+                sorted(utility.word_ids.items()), FLAGS.data_type,
+                FLAGS.max_elements, FLAGS.max_number_cols, FLAGS.max_word_cols,
+                FLAGS.question_length, FLAGS.max_entry_length, FLAGS.pad_int))
+    cache_path = os.path.join(cache_dir, hashlib.md5(key).hexdigest())
+    if (not (os.path.isdir(cache_path))):
+      temp_path = cache_path + ".tmp"
+      if (not (os.path.isdir(temp_path))):
+        os.makedirs(temp_path)
+      for (name, attribute, dtype) in FEEDS:
+        np.save(
+            os.path.join(temp_path, name + ".npy"),
+            feed_array(data, name, attribute, dtype, utility))
+      os.rename(temp_path, cache_path)
+      print "feeds saved to ", cache_path
+    self.arrays = dict(
+        (name, np.load(os.path.join(cache_path, name + ".npy"), mmap_mode="r"))
+        for (name, attribute, dtype) in FEEDS)
+
+  def __len__(self):
+    return self.num_examples
+
+  def feed_dict(self, indices, gr, train=False, utility=None):
+    #gathers the examples at indices into a feed dict
+    feed_dict = {}
+    for (name, attribute, dtype) in FEEDS:
+      feed_dict[getattr(gr, name)] = self.arrays[name][indices]
+    if (train):
+      feed_dict[gr.batch_question] = batch_word_dropout(
+          feed_dict[gr.batch_question], utility)
+    return feed_dict
+
+
+def generate_feed_dict(data, curr, batch_size, gr, train=False, utility=None):
+  #prepare feed dict dictionary from the FeedArrays data
+  return data.feed_dict(
+      np.arange(curr, curr + batch_size), gr, train=train, utility=utility)
+
+
+def generate_train_feed_dicts(data, num_steps, batch_size, gr, utility):
+  #feed dicts of num_steps training batches, reshuffling data once all
+  #batches have been fed
+  order = range(len(data))
+  curr = 0
+  utility.random.shuffle(order)
+  for i in range(num_steps):
+    if curr + batch_size >= len(data):
+      curr = 0
+      utility.random.shuffle(order)
+    yield data.feed_dict(
+        order[curr:curr + batch_size], gr, train=True, utility=utility)
+    curr = curr + batch_size
+
+
+def prefetch(generator, num_in_flight):
+  #yields the items of generator, computed in a background thread up to
+  #num_in_flight items ahead
+  queue = Queue.Queue(max(num_in_flight, 1))
+  done = object()
+
+  def produce():
+    try:
+      for item in generator:
+        queue.put(item)
+    except Exception as e:
+      queue.put(e)
+    queue.put(done)
+
+  thread = threading.Thread(target=produce)
+  thread.daemon = True
+  thread.start()
+  while True:
+    item = queue.get()
+    if (item is done):
+      return
+    if (isinstance(item, Exception)):
+      raise item
+    yield item
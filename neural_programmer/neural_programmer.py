@@ -75,6 +75,18 @@ tf.flags.DEFINE_float(
 tf.flags.DEFINE_float("max_math_error", 3.0,
                       "max square loss error that is considered")
 tf.flags.DEFINE_float("soft_min_value", 5.0, "")
+tf.flags.DEFINE_integer("num_processes", 0,
+                        "number of processes that match the questions with "
+                        "their tables, 0 to match in the main process")
+tf.flags.DEFINE_string("match_cache_dir", "",
+                       "directory where the matches of questions and tables "
+                       "are cached, no caching if empty")
+tf.flags.DEFINE_string("feed_cache_dir", "",
+                       "directory where the padded feeds of the processed "
+                       "examples are cached, no caching if empty")
+tf.flags.DEFINE_integer("prefetch_batches", 2,
+                        "number of training batches prepared ahead in a "
+                        "background thread")
 FLAGS = tf.flags.FLAGS
 
 
@@ -101,6 +113,7 @@ class Utility:
     self.reverse_word_ids = {}
     self.word_count = {}
     self.random = Random(FLAGS.python_seed)
+    self.np_random = np.random.RandomState(FLAGS.python_seed)
 
 
 def evaluate(sess, data, batch_size, graph, i):
@@ -121,23 +134,19 @@ def evaluate(sess, data, batch_size, graph, i):
 def Train(graph, utility, batch_size, train_data, sess, model_dir,
           saver):
   #performs training
-  curr = 0
   train_set_loss = 0.0
-  utility.random.shuffle(train_data)
+  feed_dicts = data_utils.prefetch(
+      data_utils.generate_train_feed_dicts(
+          train_data, utility.FLAGS.train_steps, batch_size, graph, utility),
+      utility.FLAGS.prefetch_batches)
   start = time.time()
   for i in range(utility.FLAGS.train_steps):
     curr_step = i
     if (i > 0 and i % FLAGS.write_every == 0):
       model_file = model_dir + "/model_" + str(i)
       saver.save(sess, model_file)
-    if curr + batch_size >= len(train_data):
-      curr = 0
-      utility.random.shuffle(train_data)
     step, cost_value = sess.run(
-        [graph.step, graph.total_cost],
-        feed_dict=data_utils.generate_feed_dict(
-            train_data, curr, batch_size, graph, train=True, utility=utility))
-    curr = curr + batch_size
+        [graph.step, graph.total_cost], feed_dict=next(feed_dicts))
     train_set_loss += cost_value
     if (i > 0 and i % FLAGS.eval_cycle == 0):
       end = time.time()
@@ -225,6 +234,10 @@ def main(args):
   train_data = data_utils.complete_wiki_processing(train_data, utility, True)
   dev_data = data_utils.complete_wiki_processing(dev_data, utility, False)
   test_data = data_utils.complete_wiki_processing(test_data, utility, False)
+  #convert to padded arrays to feed the graph
+  train_data = data_utils.FeedArrays(train_data, utility, FLAGS.feed_cache_dir)
+  dev_data = data_utils.FeedArrays(dev_data, utility, FLAGS.feed_cache_dir)
+  test_data = data_utils.FeedArrays(test_data, utility, FLAGS.feed_cache_dir)
   print "# train examples ", len(train_data)
   print "# dev examples ", len(dev_data)
   print "# test examples ", len(test_data)
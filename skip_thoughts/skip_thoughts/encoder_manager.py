@@ -47,7 +47,7 @@ class EncoderManager(object):
     self.sessions = []
 
   def load_model(self, model_config, vocabulary_file, embedding_matrix_file,
-                 checkpoint_path):
+                 checkpoint_path, num_processes=0):
     """Loads a skip-thoughts model.
 
     Args:
@@ -59,6 +59,8 @@ class EncoderManager(object):
         [vocab_size, embedding_dim].
       checkpoint_path: SkipThoughtsModel checkpoint file or a directory
         containing a checkpoint file.
+      num_processes: Number of processes to tokenize input strings in. If 0,
+        they are tokenized in the calling process.
     """
     tf.logging.info("Reading vocabulary from %s", vocabulary_file)
     with tf.gfile.GFile(vocabulary_file, mode="r") as f:
@@ -79,7 +81,12 @@ class EncoderManager(object):
 
     g = tf.Graph()
     with g.as_default():
-      encoder = skip_thoughts_encoder.SkipThoughtsEncoder(word_embeddings)
+      # Duplicate words leave the dictionary shorter than the matrix.
+      if len(word_embeddings) != embedding_matrix.shape[0]:
+        embedding_matrix = None
+      encoder = skip_thoughts_encoder.SkipThoughtsEncoder(
+          word_embeddings, embedding_matrix=embedding_matrix,
+          num_processes=num_processes)
       restore_model = encoder.build_graph_from_config(model_config,
                                                       checkpoint_path)
 
@@ -129,6 +136,8 @@ class EncoderManager(object):
     return np.concatenate(encoded, axis=1)
 
   def close(self):
-    """Closes the active TensorFlow Sessions."""
+    """Closes the active TensorFlow Sessions and the encoders."""
     for sess in self.sessions:
       sess.close()
+    for encoder in self.encoders:
+      encoder.close()
@@ -29,6 +29,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import multiprocessing
+import multiprocessing.pool
 import os.path
 
 
@@ -41,67 +44,99 @@ from skip_thoughts import skip_thoughts_model
 from skip_thoughts.data import special_words
 
 
-def _pad(seq, target_len):
-  """Pads a sequence of word embeddings up to the target length.
+def _batch_and_pad(embedding_matrix, sequences):
+  """Batches and pads sequences of word ids into a 3D array of embeddings.
+
+  The embeddings of all words in the batch are gathered from the embedding
+  matrix in a single indexing operation.
 
   Args:
-    seq: Sequence of word embeddings.
-    target_len: Desired padded sequence length.
+    embedding_matrix: A numpy array with shape [vocab_size, emb_dim].
+    sequences: A list of batch_size 1D numpy arrays of word ids.
 
   Returns:
-    embeddings: Input sequence padded with zero embeddings up to the target
-      length.
-    mask: A 0/1 vector with zeros corresponding to padded embeddings.
+    embeddings: A numpy array with shape [batch_size, padded_length, emb_dim].
+    mask: A numpy 0/1 array with shape [batch_size, padded_length] with zeros
+      corresponding to padded elements.
 
   Raises:
-    ValueError: If len(seq) is not in the interval (0, target_len].
+    ValueError: If any sequence is empty.
   """
-  seq_len = len(seq)
-  if seq_len <= 0 or seq_len > target_len:
-    raise ValueError("Expected 0 < len(seq) <= %d, got %d" % (target_len,
-                                                              seq_len))
+  lengths = np.array([len(seq) for seq in sequences])
+  if np.any(lengths <= 0):
+    raise ValueError("Expected all sequences to be non-empty, got lengths %s" %
+                     lengths)
 
-  emb_dim = seq[0].shape[0]
-  padded_seq = np.zeros(shape=(target_len, emb_dim), dtype=seq[0].dtype)
-  mask = np.zeros(shape=(target_len,), dtype=np.int8)
-  for i in range(seq_len):
-    padded_seq[i] = seq[i]
-    mask[i] = 1
-  return padded_seq, mask
+  batch_len = np.max(lengths)
+  mask = (np.arange(batch_len) < lengths[:, np.newaxis]).astype(np.int8)
+  embeddings = np.zeros(
+      shape=(len(sequences), batch_len, embedding_matrix.shape[1]),
+      dtype=embedding_matrix.dtype)
+  embeddings[mask.astype(bool)] = embedding_matrix[np.concatenate(sequences)]
+  return embeddings, mask
 
 
-def _batch_and_pad(sequences):
-  """Batches and pads sequences of word embeddings into a 2D array.
+def _prefetch(fn, args, num_in_flight):
+  """Yields fn(arg) for each of args, in order.
 
-  Args:
-    sequences: A list of batch_size sequences of word embeddings.
-
-  Returns:
-    embeddings: A numpy array with shape [batch_size, padded_length, emb_dim].
-    mask: A numpy 0/1 array with shape [batch_size, padded_length] with zeros
-      corresponding to padded elements.
+  Up to num_in_flight results are computed ahead in a background thread.
   """
-  batch_embeddings = []
-  batch_mask = []
-  batch_len = max([len(seq) for seq in sequences])
-  for seq in sequences:
-    embeddings, mask = _pad(seq, batch_len)
-    batch_embeddings.append(embeddings)
-    batch_mask.append(mask)
-  return np.array(batch_embeddings), np.array(batch_mask)
+  pool = multiprocessing.pool.ThreadPool(1)
+  try:
+    pending = collections.deque()
+    for arg in args:
+      pending.append(pool.apply_async(fn, (arg,)))
+      if len(pending) >= num_in_flight:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+  finally:
+    pool.close()
+
+
+# The encoder whose vocabulary is used by the tokenizer processes. It is set
+# while the process pool is forked, so the processes inherit it.
+_pool_encoder = None
+
+
+def _pool_word_ids(args):
+  item, use_eos = args
+  return _pool_encoder._word_ids(item, use_eos)
 
 
 class SkipThoughtsEncoder(object):
   """Skip-thoughts sentence encoder."""
 
-  def __init__(self, embeddings):
+  def __init__(self, embeddings, embedding_matrix=None, num_processes=0):
     """Initializes the encoder.
 
     Args:
       embeddings: Dictionary of word to embedding vector (1D numpy array).
+      embedding_matrix: Optional numpy array with shape [vocab_size, emb_dim]
+        whose rows are the vectors in embeddings, in the iteration order of
+        embeddings. If None, it is built from embeddings.
+      num_processes: Number of processes to tokenize input strings in. If 0,
+        they are tokenized in the calling process.
     """
+    global _pool_encoder
     self._sentence_detector = nltk.data.load("tokenizers/punkt/english.pickle")
     self._embeddings = embeddings
+    self._vocab = dict((w, i) for i, w in enumerate(embeddings))
+    self._unk_id = self._vocab[special_words.UNK]
+    if embedding_matrix is None:
+      embedding_matrix = np.array(list(embeddings.values()))
+    if embedding_matrix.shape[0] != len(embeddings):
+      raise ValueError("Expected %d rows in the embedding matrix, got %d" %
+                       (len(embeddings), embedding_matrix.shape[0]))
+    self._embedding_matrix = embedding_matrix
+
+    # Fork the pool now, before the encoder's session starts any threads.
+    self._num_processes = num_processes
+    self._pool = None
+    if num_processes > 0:
+      _pool_encoder = self
+      self._pool = multiprocessing.Pool(num_processes)
+      _pool_encoder = None
 
   def _create_restore_fn(self, checkpoint_path, saver):
     """Creates a function that restores a model from checkpoint.
@@ -190,9 +225,13 @@ class SkipThoughtsEncoder(object):
 
     return tokenized
 
-  def _word_to_embedding(self, w):
-    """Returns the embedding of a word."""
-    return self._embeddings.get(w, self._embeddings[special_words.UNK])
+  def _word_ids(self, item, use_eos):
+    """Tokenizes an input string into a 1D numpy array of word ids."""
+    tokenized = self._tokenize(item)
+    if use_eos:
+      tokenized.append(special_words.EOS)
+    return np.array([self._vocab.get(w, self._unk_id) for w in tokenized],
+                    dtype=np.int32)
 
   def _preprocess(self, data, use_eos):
     """Preprocesses text for the encoder.
@@ -202,16 +241,13 @@ class SkipThoughtsEncoder(object):
       use_eos: Whether to append the end-of-sentence word to each sentence.
 
     Returns:
-      embeddings: A list of word embedding sequences corresponding to the input
-        strings.
+      word_ids: A list of 1D numpy arrays of the word ids of the input strings.
     """
-    preprocessed_data = []
-    for item in data:
-      tokenized = self._tokenize(item)
-      if use_eos:
-        tokenized.append(special_words.EOS)
-      preprocessed_data.append([self._word_to_embedding(w) for w in tokenized])
-    return preprocessed_data
+    if self._pool is not None:
+      chunksize = max(1, len(data) // (8 * self._num_processes))
+      return self._pool.map(_pool_word_ids, [(item, use_eos) for item in data],
+                            chunksize=chunksize)
+    return [self._word_ids(item, use_eos) for item in data]
 
   def encode(self,
              sess,
@@ -219,9 +255,14 @@ class SkipThoughtsEncoder(object):
              use_norm=True,
              verbose=True,
              batch_size=128,
-             use_eos=False):
+             use_eos=False,
+             num_batches_in_flight=2):
     """Encodes a sequence of sentences as skip-thought vectors.
 
+    Sentences are sorted by length and batched in that order, so that batches
+    need little padding. Batches are assembled in a background thread while
+    the encoder runs on earlier ones.
+
     Args:
       sess: TensorFlow Session.
       data: A list of input strings.
@@ -230,29 +271,43 @@ class SkipThoughtsEncoder(object):
       batch_size: Batch size for the encoder.
       use_eos: Whether to append the end-of-sentence word to each input
         sentence.
+      num_batches_in_flight: Maximum number of assembled batches waiting for
+        the encoder.
 
     Returns:
       thought_vectors: A list of numpy arrays corresponding to the skip-thought
         encodings of sentences in 'data'.
     """
     data = self._preprocess(data, use_eos)
-    thought_vectors = []
+    order = np.argsort([len(seq) for seq in data], kind="mergesort")
+    batch_indices = [order[i:i + batch_size]
+                     for i in range(0, len(data), batch_size)]
 
-    batch_indices = np.arange(0, len(data), batch_size)
-    for batch, start_index in enumerate(batch_indices):
+    def _make_batch(indices):
+      return _batch_and_pad(self._embedding_matrix, [data[i] for i in indices])
+
+    thought_vectors = [None] * len(data)
+    batches = _prefetch(_make_batch, batch_indices, num_batches_in_flight)
+    for batch, (embeddings, mask) in enumerate(batches):
       if verbose:
         tf.logging.info("Batch %d / %d.", batch, len(batch_indices))
 
-      embeddings, mask = _batch_and_pad(
-          data[start_index:start_index + batch_size])
       feed_dict = {
           "encode_emb:0": embeddings,
           "encode_mask:0": mask,
       }
-      thought_vectors.extend(
-          sess.run("encoder/thought_vectors:0", feed_dict=feed_dict))
+      vectors = sess.run("encoder/thought_vectors:0", feed_dict=feed_dict)
+      for i, v in zip(batch_indices[batch], vectors):
+        thought_vectors[i] = v
 
     if use_norm:
       thought_vectors = [v / np.linalg.norm(v) for v in thought_vectors]
 
     return thought_vectors
+
+  def close(self):
+    """Stops the tokenizer processes, if any."""
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
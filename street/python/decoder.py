@@ -22,9 +22,11 @@ Sequence Data with Recurrent Neural Networks.
 http://www.cs.toronto.edu/~graves/icml_2006.pdf
 """
 import collections
+from multiprocessing import pool
 import re
 
 import errorcounter as ec
+import numpy as np
 import tensorflow as tf
 
 # Named tuple Part describes a part of a multi (1 or more) part code that
@@ -56,10 +58,25 @@ class Decoder(object):
     # self.decoder[42] = [..., (utf8='x', index=1, num_codes3), ...] where ...
     # means all other uses of the code 42.
     self.decoder = []
+    # self._transitions is self.decoder compiled into an automaton, whose
+    # states are the Parts. For each code, it is a list of
+    # (state, prev_state, utf8, index, num_codes), where state is the id of the
+    # Part and prev_state the id of the Part that it continues, or -1.
+    self._transitions = []
+    # The code sequences of the decoder file are also compiled into an
+    # automaton that restricts the beam search to valid sequences. Its states
+    # are the sets of trie nodes that a prefix can be in, as a complete
+    # sequence can either be continued or followed by a new one.
+    # self._lexicon_next[state, code] is the state after code, or -1 if code
+    # can't follow state, and self._lexicon_final[state] is True if state can
+    # be at the end of a complete sequence. State 0 is the root.
+    self._code_sequences = []
+    self._lexicon_next = np.zeros((1, 0), dtype=np.int64)
+    self._lexicon_final = np.ones(1, dtype=bool)
     if filename:
       self._InitializeDecoder(filename)
 
-  def SoftmaxEval(self, sess, model, num_steps):
+  def SoftmaxEval(self, sess, model, num_steps, beam_width=0):
     """Evaluate a model in softmax mode.
 
     Adds char, word recall and sequence error rate events to the sw summary
@@ -71,6 +88,8 @@ class Decoder(object):
         other class that has a using_ctc attribute and a RunAStep(sess) method
         that reurns a softmax result with corresponding labels.
       num_steps: Number of steps to evaluate for.
+      beam_width: If > 0, CTC outputs are decoded with a prefix beam search of
+        this width, instead of just taking the top choices.
     Returns:
       ErrorRates named tuple.
     Raises:
@@ -79,46 +98,199 @@ class Decoder(object):
     coord = tf.train.Coordinator()
     threads = tf.train.start_queue_runners(sess=sess, coord=coord)
     # Run the requested number of evaluation steps, gathering the outputs of the
-    # softmax and the true labels of the evaluation examples.
+    # softmax and the true labels of the evaluation examples. Each batch is
+    # decoded and counted by a worker thread while the next step runs.
+    workers = pool.ThreadPool(1)
+    batch_results = []
+    for _ in xrange(num_steps):
+      softmax_result, labels = model.RunAStep(sess)
+      # Exclude batch and classes from num_dims.
+      num_dims = len(softmax_result.shape) - 2
+      if num_dims == 2:
+        # TODO(rays) Support 2-d data.
+        raise ValueError('2-d label data not supported yet!')
+      batch_results.append(workers.apply_async(
+          self._CountBatchErrors,
+          (softmax_result, labels, model.using_ctc, beam_width)))
+    workers.close()
+
     total_label_counts = ec.ErrorCounts(0, 0, 0, 0)
     total_word_counts = ec.ErrorCounts(0, 0, 0, 0)
     sequence_errors = 0
-    for _ in xrange(num_steps):
-      softmax_result, labels = model.RunAStep(sess)
-      # Collapse softmax to same shape as labels.
-      predictions = softmax_result.argmax(axis=-1)
-      # Exclude batch from num_dims.
-      num_dims = len(predictions.shape) - 1
-      batch_size = predictions.shape[0]
-      null_label = softmax_result.shape[-1] - 1
-      for b in xrange(batch_size):
-        if num_dims == 2:
-          # TODO(rays) Support 2-d data.
-          raise ValueError('2-d label data not supported yet!')
-        else:
-          if num_dims == 1:
-            pred_batch = predictions[b, :]
-            labels_batch = labels[b, :]
-          else:
-            pred_batch = [predictions[b]]
-            labels_batch = [labels[b]]
-          text = self.StringFromCTC(pred_batch, model.using_ctc, null_label)
-          truth = self.StringFromCTC(labels_batch, False, null_label)
-          # Note that recall_errs is false negatives (fn) aka drops/deletions.
-          # Actual recall would be 1-fn/truth_words.
-          # Likewise precision_errs is false positives (fp) aka adds/insertions.
-          # Actual precision would be 1-fp/ocr_words.
-          total_word_counts = ec.AddErrors(total_word_counts,
-                                           ec.CountWordErrors(text, truth))
-          total_label_counts = ec.AddErrors(total_label_counts,
-                                            ec.CountErrors(text, truth))
-          if text != truth:
-            sequence_errors += 1
+    num_sequences = 0
+    for result in batch_results:
+      label_counts, word_counts, batch_errors, batch_size = result.get()
+      total_label_counts = ec.AddErrors(total_label_counts, label_counts)
+      total_word_counts = ec.AddErrors(total_word_counts, word_counts)
+      sequence_errors += batch_errors
+      num_sequences += batch_size
+    workers.join()
 
     coord.request_stop()
     coord.join(threads)
     return ec.ComputeErrorRates(total_label_counts, total_word_counts,
-                                sequence_errors, num_steps * batch_size)
+                                sequence_errors, num_sequences)
+
+  def _CountBatchErrors(self, softmax_result, labels, using_ctc, beam_width):
+    """Decodes a batch and counts its errors against the labels.
+
+    Args:
+      softmax_result: [batch, width, classes] or [batch, classes] array of
+        softmax outputs.
+      labels:         [batch, width] or [batch] array of true labels.
+      using_ctc:      If True, the outputs are CTC outputs.
+      beam_width:     If > 0, width of the beam search for CTC outputs.
+    Returns:
+      label ErrorCounts, word ErrorCounts, sequence errors, batch size.
+    """
+    null_label = softmax_result.shape[-1] - 1
+    if len(softmax_result.shape) == 2:
+      softmax_result = softmax_result[:, None, :]
+      labels = labels[:, None]
+    if using_ctc and beam_width > 0:
+      texts = self.BeamSearchFromSoftmax(softmax_result, beam_width,
+                                         null_label)
+    else:
+      # Collapse softmax to same shape as labels.
+      predictions = softmax_result.argmax(axis=-1)
+      texts = self.StringsFromCTC(predictions, using_ctc, null_label)
+    truths = self.StringsFromCTC(labels, False, null_label)
+    # Note that recall_errs is false negatives (fn) aka drops/deletions.
+    # Actual recall would be 1-fn/truth_words.
+    # Likewise precision_errs is false positives (fp) aka adds/insertions.
+    # Actual precision would be 1-fp/ocr_words.
+    sequence_errors = sum(text != truth for text, truth in zip(texts, truths))
+    return (ec.CountErrorsBatch(texts, truths),
+            ec.CountWordErrorsBatch(texts, truths), sequence_errors,
+            len(texts))
+
+  def StringsFromCTC(self, ctc_labels, merge_dups, null_label):
+    """Decodes a batch of CTC outputs to strings.
+
+    Args:
+      ctc_labels: [batch, width] array of class labels including null
+        characters to remove.
+      merge_dups: If True, Duplicate labels will be merged
+      null_label: Label value to ignore.
+
+    Returns:
+      List of the labels of each batch element decoded to a string.
+    """
+    return [self._StringFromCodes(codes.tolist())
+            for codes in self._CodesFromCTCBatch(ctc_labels, merge_dups,
+                                                 null_label)]
+
+  def BeamSearchFromSoftmax(self, softmax, beam_width, null_label):
+    """Decodes a batch of CTC softmax outputs with a prefix beam search.
+
+    All the prefixes (code sequences) that the CTC outputs can collapse to are
+    searched, keeping the beam_width most probable ones, after merging the
+    probabilities of the paths that give the same prefix. Prefixes are only
+    extended by codes that keep them in a valid sequence of the decoder file,
+    so the parts of a multi-code sequence are decoded together.
+    Args:
+      softmax:    [batch, width, num_classes] array of softmax outputs.
+      beam_width: Number of prefixes kept for each batch element.
+      null_label: Class of the CTC null character.
+
+    Returns:
+      List of the best string of each batch element.
+    """
+    batch_size, width, num_classes = softmax.shape
+    log_probs = np.log(np.maximum(softmax, 1e-30))
+    # The lexicon state after each class; the null and unknown codes are never
+    # appended to a prefix.
+    num_codes = min(num_classes, self._lexicon_next.shape[1])
+    next_states = np.full((len(self._lexicon_next), num_classes), -1,
+                          dtype=np.int64)
+    next_states[:, :num_codes] = self._lexicon_next[:, :num_codes]
+    next_states[:, null_label] = -1
+
+    # The prefixes form a tree with the empty prefix at node 0. Each prefix in
+    # the beam has its node, the node of its parent, its last code, its
+    # lexicon state, and the log probabilities of the paths giving it that end
+    # with a null (log_pb) or not (log_pnb). Empty beam entries have node -2.
+    node_parents = [np.array([-1])]
+    node_codes = [np.array([-1])]
+    num_nodes = 1
+    rows = np.arange(batch_size)[:, None]
+    nodes = np.full((batch_size, beam_width), -2, dtype=np.int64)
+    nodes[:, 0] = 0
+    parents = np.full((batch_size, beam_width), -1, dtype=np.int64)
+    last = np.full((batch_size, beam_width), -1, dtype=np.int64)
+    states = np.zeros((batch_size, beam_width), dtype=np.int64)
+    log_pb = np.full((batch_size, beam_width), -np.inf)
+    log_pb[:, 0] = 0.0
+    log_pnb = np.full((batch_size, beam_width), -np.inf)
+    for t in xrange(width):
+      y = log_probs[:, t, :]
+      log_p = np.logaddexp(log_pb, log_pnb)
+      # A prefix stays the same with a null, or with a repeat of its last code.
+      stay_pb = log_p + y[:, null_label, None]
+      stay_pnb = np.where(last >= 0, log_pnb + y[rows, np.maximum(last, 0)],
+                          -np.inf)
+      # A prefix is extended by a code, which must follow a null if it repeats
+      # the last code.
+      repeat = np.arange(num_classes) == last[:, :, None]
+      extend = (np.where(repeat, log_pb[:, :, None], log_p[:, :, None]) +
+                y[:, None, :])
+      extend[next_states[states] < 0] = -np.inf
+      # Merge the extensions that give a prefix that is already in the beam.
+      match = parents[:, :, None] == nodes[:, None, :]
+      match_b, match_j = np.nonzero(match.any(axis=2))
+      match_i = match[match_b, match_j].argmax(axis=1)
+      match_code = last[match_b, match_j]
+      stay_pnb[match_b, match_j] = np.logaddexp(
+          stay_pnb[match_b, match_j], extend[match_b, match_i, match_code])
+      extend[match_b, match_i, match_code] = -np.inf
+
+      # Keep the best of the prefixes and their best extensions.
+      extend = extend.reshape(batch_size, -1)
+      top = np.argpartition(-extend, beam_width - 1, axis=1)[:, :beam_width]
+      cand_pb = np.concatenate(
+          [stay_pb, np.full((batch_size, beam_width), -np.inf)], axis=1)
+      cand_pnb = np.concatenate([stay_pnb, extend[rows, top]], axis=1)
+      cand_p = np.logaddexp(cand_pb, cand_pnb)
+      best = np.argsort(-cand_p, axis=1, kind='mergesort')[:, :beam_width]
+      log_pb = cand_pb[rows, best]
+      log_pnb = cand_pnb[rows, best]
+      valid = np.isfinite(cand_p[rows, best])
+      is_stay = best < beam_width
+      stay = np.minimum(best, beam_width - 1)
+      ext = top[rows, np.maximum(best - beam_width, 0)]
+      ext_beam, ext_code = ext // num_classes, ext % num_classes
+      new_b, new_j = np.nonzero(~is_stay & valid)
+      new_nodes = num_nodes + np.arange(len(new_b))
+      num_nodes += len(new_b)
+      node_parents.append(nodes[new_b, ext_beam[new_b, new_j]])
+      node_codes.append(ext_code[new_b, new_j])
+
+      new_states = next_states[states[rows, ext_beam], ext_code]
+      parents = np.where(is_stay, parents[rows, stay], nodes[rows, ext_beam])
+      last = np.where(is_stay, last[rows, stay], ext_code)
+      states = np.where(is_stay, states[rows, stay], np.maximum(new_states, 0))
+      nodes = np.where(is_stay, nodes[rows, stay], -2)
+      nodes[new_b, new_j] = new_nodes
+      nodes[~valid] = -2
+      parents[~valid] = -1
+      last[~valid] = -1
+
+    # Pick the best prefix that ends with a complete code sequence.
+    log_p = np.logaddexp(log_pb, log_pnb)
+    final = np.where(self._lexicon_final[states] & (nodes >= 0), log_p,
+                     -np.inf)
+    final = np.where(np.isfinite(final).any(axis=1)[:, None], final, log_p)
+    best_nodes = nodes[np.arange(batch_size), final.argmax(axis=1)]
+    node_parents = np.concatenate(node_parents)
+    node_codes = np.concatenate(node_codes)
+    texts = []
+    for node in best_nodes:
+      codes = []
+      while node > 0:
+        codes.append(node_codes[node])
+        node = node_parents[node]
+      texts.append(self._StringFromCodes(codes[::-1]))
+    return texts
 
   def StringFromCTC(self, ctc_labels, merge_dups, null_label):
     """Decodes CTC output to a string.
@@ -138,44 +310,56 @@ class Decoder(object):
       Labels decoded to a string.
     """
     # Run regular ctc on the labels, extracting a list of codes.
-    codes = self._CodesFromCTC(ctc_labels, merge_dups, null_label)
-    length = len(codes)
-    if length == 0:
-      return ''
-    # strings and partials are both indexed by the same index as codes.
-    # strings[i] is the best completed string upto position i, and
-    # partials[i] is a list of partial code sequences at position i.
-    # Warning: memory is squared-order in length.
+    return self._StringFromCodes(
+        self._CodesFromCTC(ctc_labels, merge_dups, null_label))
+
+  def _StringFromCodes(self, codes):
+    """Decodes a list of codes to a string, dropping illegal code sequences.
+
+    Args:
+      codes: List of codes, without nulls.
+
+    Returns:
+      Codes decoded to a string.
+    """
+    # best[i] is the best completed string upto position i, as an index into
+    # strings, or -1 for the empty string. strings is a list of
+    # (prefix, utf8), where prefix is the index of the rest of the string.
+    # partials is the set of states of partial code sequences at the previous
+    # position.
     strings = []
-    partials = []
-    for pos in xrange(length):
-      code = codes[pos]
-      parts = self.decoder[code]
-      partials.append([])
-      strings.append('')
+    best = []
+    partials = set()
+    for pos, code in enumerate(codes):
+      new_partials = set()
+      best.append(-1)
       # Iterate over the parts that this code can represent.
-      for utf8, index, num_codes in parts:
+      for state, prev_state, utf8, index, num_codes in self._transitions[code]:
         if index > pos:
           continue
         # We can use code if it is an initial code (index==0) or continues a
-        # sequence in the partials list at the previous position.
-        if index == 0 or partials[pos - 1].count(
-            Part(utf8, index - 1, num_codes)) > 0:
+        # sequence in the partials at the previous position.
+        if index == 0 or prev_state in partials:
           if index < num_codes - 1:
             # Save the partial sequence.
-            partials[-1].append(Part(utf8, index, num_codes))
-          elif not strings[-1]:
+            new_partials.add(state)
+          elif best[-1] < 0:
             # A code sequence is completed. Append to the best string that we
             # had where it started.
-            if pos >= num_codes:
-              strings[-1] = strings[pos - num_codes] + utf8
-            else:
-              strings[-1] = utf8
-      if not strings[-1] and pos > 0:
+            prefix = best[pos - num_codes] if pos >= num_codes else -1
+            strings.append((prefix, utf8))
+            best[-1] = len(strings) - 1
+      if best[-1] < 0 and pos > 0:
         # We didn't get anything here so copy the previous best string, skipping
         # the current code, but it may just be a partial anyway.
-        strings[-1] = strings[-2]
-    return strings[-1]
+        best[-1] = best[-2]
+      partials = new_partials
+    pieces = []
+    string = best[-1] if best else -1
+    while string >= 0:
+      string, utf8 = strings[string]
+      pieces.append(utf8)
+    return ''.join(reversed(pieces))
 
   def _InitializeDecoder(self, filename):
     """Reads the decoder file and initializes self.decoder from it.
@@ -197,11 +381,69 @@ class Decoder(object):
         for code in str_codes:
           codes.append(int(code))
         utf8 = m.groupdict()['utf8']
+        self._code_sequences.append(codes)
         num_codes = len(codes)
         for index, code in enumerate(codes):
           while code >= len(self.decoder):
             self.decoder.append([])
           self.decoder[code].append(Part(utf8, index, num_codes))
+    self._CompileDecoder()
+
+  def _CompileDecoder(self):
+    """Compiles self.decoder into the automaton in self._transitions."""
+    states = {}
+    self._transitions = []
+    for parts in self.decoder:
+      transitions = []
+      for part in parts:
+        state = states.setdefault(part, len(states))
+        prev_state = -1
+        if part.index > 0:
+          prev_part = Part(part.utf8, part.index - 1, part.num_codes)
+          prev_state = states.setdefault(prev_part, len(states))
+        transitions.append((state, prev_state) + tuple(part))
+      self._transitions.append(transitions)
+
+    # Build the trie of the code sequences.
+    children = [{}]
+    final = [True]
+    for codes in self._code_sequences:
+      state = 0
+      for code in codes:
+        if code not in children[state]:
+          children[state][code] = len(children)
+          children.append({})
+          final.append(False)
+        state = children[state][code]
+      final[state] = True
+    # A complete sequence can also be followed by the start of a new one, so
+    # the automaton is built over the sets of trie nodes reached from the
+    # root, like a subset construction.
+    lexicon_states = {(0,): 0}
+    queue = [(0,)]
+    lexicon_next = []
+    lexicon_final = []
+    while len(lexicon_next) < len(queue):
+      trie_states = queue[len(lexicon_next)]
+      is_final = any(final[state] for state in trie_states)
+      next_trie_states = collections.defaultdict(set)
+      for state in trie_states:
+        for code, child in children[state].items():
+          next_trie_states[code].add(child)
+      if is_final:
+        for code, child in children[0].items():
+          next_trie_states[code].add(child)
+      row = np.full(len(self.decoder), -1, dtype=np.int64)
+      for code, next_states in next_trie_states.items():
+        key = tuple(sorted(next_states))
+        if key not in lexicon_states:
+          lexicon_states[key] = len(queue)
+          queue.append(key)
+        row[code] = lexicon_states[key]
+      lexicon_next.append(row)
+      lexicon_final.append(is_final)
+    self._lexicon_next = np.array(lexicon_next)
+    self._lexicon_final = np.array(lexicon_final)
 
   def _CodesFromCTC(self, ctc_labels, merge_dups, null_label):
     """Collapses CTC output to regular output.
@@ -241,3 +483,34 @@ class Decoder(object):
           out_labels.append(label)
         prev_label = label
     return out_labels
+
+  def _CodesFromCTCBatch(self, ctc_labels, merge_dups, null_label):
+    """Collapses a batch of CTC outputs to regular outputs at once.
+
+    Gives the same result as _CodesFromCTC on each batch element.
+    Args:
+      ctc_labels: [batch, width] array of class labels including null
+        characters to remove.
+      merge_dups: If True, Duplicate labels will be merged.
+      null_label: Label value to ignore.
+
+    Returns:
+      List of arrays of labels with null characters removed.
+    """
+    ctc_labels = np.asarray(ctc_labels)
+    emitted = ctc_labels != null_label
+    if merge_dups:
+      emitted[:, 1:] &= ctc_labels[:, 1:] != ctc_labels[:, :-1]
+    rows = np.nonzero(emitted)[0]
+    labels = ctc_labels[emitted]
+    # Zeros are kept only if there is a non-zero after them.
+    non_zero = labels != 0
+    last_non_zero = np.full(len(ctc_labels), -1, dtype=np.int64)
+    np.maximum.at(last_non_zero, rows[non_zero], np.nonzero(non_zero)[0])
+    keep = non_zero | (np.arange(len(labels)) < last_non_zero[rows])
+    if merge_dups:
+      # Only the first of a run of zeros is kept.
+      keep[1:] &= ~((labels[1:] == 0) & (labels[:-1] == 0) &
+                    (rows[1:] == rows[:-1]))
+    lengths = np.bincount(rows[keep], minlength=len(ctc_labels))
+    return np.split(labels[keep], np.cumsum(lengths)[:-1])
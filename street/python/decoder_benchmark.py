@@ -0,0 +1,121 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Compares the accuracy and speed of the greedy and beam search decoders.
+
+Generates noisy CTC softmax outputs for random text from a charset, and
+reports the label and sequence error rates and the decoding time per batch of
+the top-choice decoder and of beam searches of several widths.
+"""
+import time
+
+import numpy as np
+from tensorflow import app
+from tensorflow.python.platform import flags
+
+import decoder
+import errorcounter as ec
+
+flags.DEFINE_string('decoder', '../testdata/charset_size_10.txt',
+                    'Charset decoder')
+flags.DEFINE_string('beam_widths', '1,2,4,8,16',
+                    'Comma-separated beam widths to compare.')
+flags.DEFINE_integer('batch_size', 32, 'Batch size.')
+flags.DEFINE_integer('width', 30, 'Number of CTC output steps.')
+flags.DEFINE_integer('num_batches', 20, 'Number of batches to decode.')
+flags.DEFINE_float('min_confidence', 0.3,
+                   'Minimum probability of the label at each output step.')
+flags.DEFINE_integer('seed', 0, 'Random seed.')
+
+FLAGS = flags.FLAGS
+
+
+def _RandomBatch(decode, rng):
+  """Returns noisy softmax outputs [batch, width, classes] and their truths.
+
+  Each step of the outputs gives its label a random probability of at least
+  min_confidence, and splits the rest between a random class and the null.
+  """
+  num_classes = len(decode.decoder)
+  null_label = num_classes - 1
+  sequences = [codes for codes in decode._code_sequences
+               if null_label not in codes]
+  steps = np.arange(FLAGS.width)
+  softmax = np.zeros((FLAGS.batch_size, FLAGS.width, num_classes))
+  truths = []
+  for b in xrange(FLAGS.batch_size):
+    # Lay out random code sequences, each code for 1-3 steps and followed by
+    # 0-2 nulls, until the output is full.
+    labels = []
+    codes = []
+    while True:
+      sequence = sequences[rng.randint(len(sequences))]
+      sequence_labels = []
+      for code in sequence:
+        # A repeated code must be separated by a null.
+        if (labels + sequence_labels)[-1:] == [code]:
+          sequence_labels.append(null_label)
+        sequence_labels += ([code] * rng.randint(1, 4) +
+                            [null_label] * rng.randint(3))
+      if len(labels) + len(sequence_labels) > FLAGS.width:
+        break
+      labels += sequence_labels
+      codes += sequence
+    labels += [null_label] * (FLAGS.width - len(labels))
+    truths.append(decode._StringFromCodes(codes))
+
+    confidence = rng.uniform(FLAGS.min_confidence, 1.0, size=FLAGS.width)
+    split = rng.uniform(size=FLAGS.width)
+    softmax[b, steps, labels] += confidence
+    softmax[b, steps, rng.randint(num_classes, size=FLAGS.width)] += (
+        (1 - confidence) * split)
+    softmax[b, :, null_label] += (1 - confidence) * (1 - split)
+  return softmax, truths
+
+
+def main(argv):
+  del argv
+  decode = decoder.Decoder(FLAGS.decoder)
+  rng = np.random.RandomState(FLAGS.seed)
+  batches = [_RandomBatch(decode, rng) for _ in xrange(FLAGS.num_batches)]
+  null_label = len(decode.decoder) - 1
+
+  beam_widths = [0] + [int(w) for w in FLAGS.beam_widths.split(',')]
+  for beam_width in beam_widths:
+    label_counts = ec.ErrorCounts(0, 0, 0, 0)
+    sequence_errors = 0
+    duration = 0.0
+    for softmax, truths in batches:
+      start_time = time.time()
+      if beam_width:
+        texts = decode.BeamSearchFromSoftmax(softmax, beam_width, null_label)
+      else:
+        texts = decode.StringsFromCTC(softmax.argmax(axis=-1), True,
+                                      null_label)
+      duration += time.time() - start_time
+      label_counts = ec.AddErrors(label_counts,
+                                  ec.CountErrorsBatch(texts, truths))
+      sequence_errors += sum(text != truth
+                             for text, truth in zip(texts, truths))
+    rates = ec.ComputeErrorRates(label_counts, label_counts, sequence_errors,
+                                 FLAGS.num_batches * FLAGS.batch_size)
+    name = 'beam %d' % beam_width if beam_width else 'greedy'
+    print ('%-8s label error %6.2f%%, sequence error %6.2f%%, %8.2f ms / batch'
+           % (name, rates.label_error, rates.sequence_error,
+              1000.0 * duration / FLAGS.num_batches))
+
+
+if __name__ == '__main__':
+  app.run()
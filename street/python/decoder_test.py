@@ -15,6 +15,7 @@
 """Tests for decoder."""
 import os
 
+import numpy as np
 import tensorflow as tf
 import decoder
 
@@ -52,6 +53,74 @@ class DecoderTest(tf.test.TestCase):
     text = decode.StringFromCTC(ctc_labels, merge_dups=True, null_label=9)
     self.assertEqual(text, 'farm barn')
 
+  def testCodesFromCTCBatch(self):
+    """Tests that the batch CTC decoder matches the simple CTC decoder.
+    """
+    ctc_labels = np.array(
+        [[9, 9, 9, 1, 9, 2, 2, 3, 9, 9, 0, 0, 1, 9, 1, 9, 9, 9],
+         [0, 0, 9, 0, 1, 1, 9, 0, 9, 0, 2, 0, 0, 9, 0, 0, 9, 0],
+         [9] * 18,
+         [0] * 18])
+    decode = decoder.Decoder(filename=None)
+    for merge_dups in [False, True]:
+      batch_labels = decode._CodesFromCTCBatch(
+          ctc_labels, merge_dups=merge_dups, null_label=9)
+      self.assertEqual(len(batch_labels), len(ctc_labels))
+      for labels, codes in zip(ctc_labels, batch_labels):
+        self.assertEqual(
+            codes.tolist(),
+            decode._CodesFromCTC(labels, merge_dups=merge_dups, null_label=9))
+
+  def testStringsFromCTC(self):
+    """Tests that the batch decoder decodes each batch element.
+    """
+    ctc_labels = np.array(
+        [[9, 6, 9, 1, 3, 9, 4, 9, 5, 5, 9, 5, 0, 2, 1, 3, 9, 4, 9],
+         [9, 5, 5, 4, 5, 9, 6, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9],
+         [9] * 19])
+    decode = decoder.Decoder(filename=_testdata('charset_size_10.txt'))
+    texts = decode.StringsFromCTC(ctc_labels, merge_dups=True, null_label=9)
+    self.assertEqual(texts, ['farm barn', 'mf', ''])
+
+  def testBeamSearchFromSoftmax(self):
+    """Tests that the beam search sums paths and respects multi-codes.
+    """
+    decode = decoder.Decoder(filename=_testdata('charset_size_10.txt'))
+    # Peaky outputs decode the same as the top choices.
+    ctc_labels = [9, 6, 9, 1, 3, 9, 4, 9, 5, 5, 9, 5, 0, 2, 1, 3, 9, 4, 9]
+    softmax = np.full((1, len(ctc_labels), 10), 0.01)
+    softmax[0, np.arange(len(ctc_labels)), ctc_labels] = 0.91
+    texts = decode.BeamSearchFromSoftmax(softmax, beam_width=4, null_label=9)
+    self.assertEqual(texts, ['farm barn'])
+    # The top choice is null at each step, but 'a' is more probable overall.
+    softmax = np.zeros((2, 2, 10))
+    softmax[:, :, 9] = 0.6
+    softmax[:, :, 1] = 0.4
+    self.assertEqual(
+        decode.StringsFromCTC(softmax.argmax(axis=-1), True, 9), ['', ''])
+    # 5 is only the second part of 'm', so it can't be decoded after 'a'.
+    softmax[1, 1, 5] = 0.5
+    softmax[1, 1, 9] = 0.3
+    softmax[1, 1, 1] = 0.2
+    texts = decode.BeamSearchFromSoftmax(softmax, beam_width=4, null_label=9)
+    self.assertEqual(texts, ['a', 'a'])
+
+  def testBeamSearchFromSoftmaxOverlappingCodes(self):
+    """Tests that a complete code sequence that prefixes another can restart.
+    """
+    filename = os.path.join(tf.test.get_temp_dir(), 'charset_overlap.txt')
+    with tf.gfile.GFile(filename, 'w') as f:
+      f.write('1\ta\n1,5,7\tx\n5,6\ty\n')
+    decode = decoder.Decoder(filename=filename)
+    #             -  a  -  y(1/2)y  -
+    ctc_labels = [8, 1, 8, 5, 8, 6, 8]
+    softmax = np.full((1, len(ctc_labels), 9), 0.01)
+    softmax[0, np.arange(len(ctc_labels)), ctc_labels] = 0.92
+    self.assertEqual(
+        decode.StringsFromCTC(softmax.argmax(axis=-1), True, 8), ['ay'])
+    texts = decode.BeamSearchFromSoftmax(softmax, beam_width=4, null_label=8)
+    self.assertEqual(texts, ['ay'])
+
 
 if __name__ == '__main__':
   tf.test.main()
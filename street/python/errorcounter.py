@@ -18,6 +18,8 @@
 """
 import collections
 
+import numpy as np
+
 # Named tuple Error counts describes the counts needed to accumulate errors
 # over multiple trials:
 #   false negatives (aka drops or deletions),
@@ -70,6 +72,55 @@ def CountErrors(ocr_text, truth_text):
   return ErrorCounts(drops, adds, len(truth_text), len(ocr_text))
 
 
+def CountErrorsBatch(ocr_texts, truth_texts):
+  """Counts the drops and adds between many pairs of bags of iterables.
+
+  Gives the same result as summing CountErrors over the pairs, but counts the
+  elements of all the pairs at once with bincounts.
+  Args:
+    ocr_texts:   List of OCR text iterables.
+    truth_texts: List of truth text iterables, same length as ocr_texts.
+
+  Returns:
+    ErrorCounts named tuple, summed over the pairs.
+  """
+  truth_lists = [list(text) for text in truth_texts]
+  ocr_lists = [list(text) for text in ocr_texts]
+  truth_lens = [len(text) for text in truth_lists]
+  ocr_lens = [len(text) for text in ocr_lists]
+  elements = [element for text in truth_lists + ocr_lists for element in text]
+  if not elements:
+    return ErrorCounts(0, 0, 0, 0)
+  # Give each (pair index, element) a unique key, and compare the number of
+  # times each key occurs in the truth and the OCR texts.
+  _, element_ids = np.unique(np.array(elements), return_inverse=True)
+  pair_ids = np.concatenate([
+      np.repeat(np.arange(len(truth_lens)), truth_lens),
+      np.repeat(np.arange(len(ocr_lens)), ocr_lens)])
+  keys, key_ids = np.unique(
+      pair_ids * (np.max(element_ids) + 1) + element_ids, return_inverse=True)
+  num_truth = sum(truth_lens)
+  counts = (np.bincount(key_ids[:num_truth], minlength=len(keys)) -
+            np.bincount(key_ids[num_truth:], minlength=len(keys)))
+  return ErrorCounts(int(np.sum(counts[counts > 0])),
+                     int(-np.sum(counts[counts < 0])), num_truth,
+                     sum(ocr_lens))
+
+
+def CountWordErrorsBatch(ocr_texts, truth_texts):
+  """Counts the word drop and add errors of many pairs of strings.
+
+  Args:
+    ocr_texts:   List of OCR text strings.
+    truth_texts: List of truth text strings.
+
+  Returns:
+    ErrorCounts named tuple, summed over the pairs.
+  """
+  return CountErrorsBatch([text.split() for text in ocr_texts],
+                          [text.split() for text in truth_texts])
+
+
 def AddErrors(counts1, counts2):
   """Adds the counts and returns a new sum tuple.
 
@@ -119,6 +119,24 @@ class ErrorcounterTest(tf.test.TestCase):
         counts, ec.ErrorCounts(
             fn=2, fp=1, truth_count=3, test_count=2))
 
+  def testCountErrorsBatch(self):
+    """Tests that the batch counts are the sum of the individual counts.
+    """
+    ocr_strs = ['farm barn', 'farm barn.', '', 'farmbarn', 'farm ba rn', 'aa']
+    truth_strs = ['farm barn', 'farm barn', 'farm barn', '', 'farm barn', 'a']
+    char_counts = ec.ErrorCounts(0, 0, 0, 0)
+    word_counts = ec.ErrorCounts(0, 0, 0, 0)
+    for ocr_str, truth_str in zip(ocr_strs, truth_strs):
+      char_counts = ec.AddErrors(char_counts,
+                                 ec.CountErrors(ocr_str, truth_str))
+      word_counts = ec.AddErrors(word_counts,
+                                 ec.CountWordErrors(ocr_str, truth_str))
+    self.assertEqual(ec.CountErrorsBatch(ocr_strs, truth_strs), char_counts)
+    self.assertEqual(
+        ec.CountWordErrorsBatch(ocr_strs, truth_strs), word_counts)
+    self.assertEqual(
+        ec.CountErrorsBatch(['', ''], ['', '']), ec.ErrorCounts(0, 0, 0, 0))
+
 
 if __name__ == '__main__':
   tf.test.main()
@@ -34,6 +34,9 @@ flags.DEFINE_integer('eval_interval_secs', 60,
                      'Time interval between eval runs.')
 flags.DEFINE_string('eval_data', None, 'Evaluation data filepattern')
 flags.DEFINE_string('decoder', None, 'Charset decoder')
+flags.DEFINE_integer('beam_width', 0,
+                     'If > 0, decode CTC outputs with a prefix beam search of '
+                     'this width instead of taking the top choices.')
 
 FLAGS = flags.FLAGS
 
@@ -42,7 +45,8 @@ def main(argv):
   del argv
   vgsl_model.Eval(FLAGS.train_dir, FLAGS.eval_dir, FLAGS.model_str,
                   FLAGS.eval_data, FLAGS.decoder, FLAGS.num_steps,
-                  FLAGS.graph_def_file, FLAGS.eval_interval_secs)
+                  FLAGS.graph_def_file, FLAGS.eval_interval_secs,
+                  beam_width=FLAGS.beam_width)
 
 
 if __name__ == '__main__':
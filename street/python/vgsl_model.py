@@ -116,7 +116,8 @@ def Eval(train_dir,
          num_steps,
          graph_def_file=None,
          eval_interval_secs=0,
-         reader=None):
+         reader=None,
+         beam_width=0):
   """Restores a model from a checkpoint and evaluates it.
 
   Args:
@@ -130,6 +131,7 @@ def Eval(train_dir,
     eval_interval_secs: How often to run evaluations, or once if 0.
     reader: Function that returns an actual reader to read Examples from input
       files. If None, uses tf.TFRecordReader().
+    beam_width: If > 0, decode CTC outputs with a beam search of this width.
   Returns:
     (char error rate, word recall error rate, sequence error rate) as percent.
   Raises:
@@ -161,7 +163,8 @@ def Eval(train_dir,
       if ckpt and ckpt.model_checkpoint_path:
         step = model.Restore(ckpt.model_checkpoint_path, sess)
         if decode:
-          rates = decode.SoftmaxEval(sess, model, num_steps)
+          rates = decode.SoftmaxEval(sess, model, num_steps,
+                                     beam_width=beam_width)
           _AddRateToSummary('Label error rate', rates.label_error, step, sw)
           _AddRateToSummary('Word recall error rate', rates.word_recall_error,
                             step, sw)
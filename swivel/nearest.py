@@ -23,21 +23,27 @@ from getopt import GetoptError, getopt
 from vecs import Vecs
 
 try:
-  opts, args = getopt(sys.argv[1:], 'v:e:', ['vocab=', 'embeddings='])
+  opts, args = getopt(sys.argv[1:], 'v:e:i', ['vocab=', 'embeddings=', 'index'])
 except GetoptError, e:
   print >> sys.stderr, e
   sys.exit(2)
 
 opt_vocab = 'vocab.txt'
 opt_embeddings = None
+opt_index = False
 
 for o, a in opts:
   if o in ('-v', '--vocab'):
     opt_vocab = a
   if o in ('-e', '--embeddings'):
     opt_embeddings = a
+  if o in ('-i', '--index'):
+    opt_index = True
 
-vecs = Vecs(opt_vocab, opt_embeddings)
+# With --index, use an approximate nearest neighbor index that is stored next
+# to the embeddings, building it on first use.
+vecs = Vecs(opt_vocab, opt_embeddings,
+            index_filename=opt_index and opt_embeddings + '.ivf.npz')
 
 while True:
   sys.stdout.write('query> ')
@@ -50,7 +56,7 @@ while True:
   parts = re.split(r'\s+', query)
 
   if len(parts) == 1:
-    res = vecs.neighbors(parts[0])
+    res = vecs.neighbors(parts[0], k=20)
 
   elif len(parts) == 3:
     vs = [vecs.lookup(w) for w in parts]
@@ -60,7 +66,7 @@ while True:
 
       continue
 
-    res = vecs.neighbors(vs[2] - vs[0] + vs[1])
+    res = vecs.neighbors(vs[2] - vs[0] + vs[1], k=20)
 
   else:
     print 'use a single word to query neighbors, or three words for analogy'
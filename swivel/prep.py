@@ -53,14 +53,27 @@ Options:
   --bufsz <int>
       The number of co-occurrences that are buffered; default 16M.
 
+  --num_workers <int>
+      The number of processes used to count co-occurrences; default is the
+      number of CPUs.  With 1, counting runs in the main process.
+
+  --chunk_size <int>
+      The number of bytes of input text handed to a worker at a time;
+      default 16M.
+
+  --shard_memory <int>
+      The number of bytes of temporary co-occurrence data that are sorted in
+      memory; bigger shards are sorted in runs and merged; default 1G.
+
 """
 
 import itertools
 import math
+import multiprocessing
 import os
-import struct
 import sys
 
+import numpy as np
 import tensorflow as tf
 
 flags = tf.app.flags
@@ -77,10 +90,26 @@ flags.DEFINE_string('vocab', '', 'Vocabulary to use instead of generating one')
 flags.DEFINE_integer('window_size', 10, 'The window size')
 flags.DEFINE_integer('bufsz', 16 * 1024 * 1024,
                      'The number of co-occurrences to buffer')
+flags.DEFINE_integer('num_workers', multiprocessing.cpu_count(),
+                     'The number of processes used to count co-occurrences')
+flags.DEFINE_integer('chunk_size', 16 * 1024 * 1024,
+                     'The number of bytes of input handed to a worker at once')
+flags.DEFINE_integer('shard_memory', 1024 * 1024 * 1024,
+                     'The number of bytes of co-occurrences to sort in memory')
 
 FLAGS = flags.FLAGS
 
-shard_cooc_fmt = struct.Struct('iif')
+# The record layout of the temporary shard files, i.e., struct 'iif'.
+shard_cooc_dtype = np.dtype(
+    [('row', np.int32), ('col', np.int32), ('value', np.float32)])
+
+# The layout of sorted runs of merged co-occurrences during shard assembly.
+merged_cooc_dtype = np.dtype(
+    [('row', np.int32), ('col', np.int32), ('value', np.float64)])
+
+# The number of word IDs that a worker turns into co-occurrence pairs at once;
+# this bounds the size of the temporary pair arrays.
+wid_block_size = 1 << 18
 
 
 def words(line):
@@ -133,20 +162,133 @@ def write_vocab_and_sums(vocab, sums, vocab_filename, sums_filename):
         print >> sums_out, cnt
 
 
+# Per-process state of the co-occurrence counting workers.  It is set up once by
+# init_cooc_worker so that the vocabulary isn't pickled along with every task.
+_cooc_worker = {}
+
+
+def init_cooc_worker(filename, vocab, window_size):
+  """Initializes the state of a co-occurrence counting process."""
+  _cooc_worker['filename'] = filename
+  _cooc_worker['word_to_id'] = {tok: idx for idx, tok in enumerate(vocab)}
+  _cooc_worker['vocab_size'] = len(vocab)
+  _cooc_worker['window_size'] = window_size
+
+
+def iter_wid_blocks(lines, start, end):
+  """Yields the word IDs of the lines that begin in the byte range [start, end).
+
+  The IDs are yielded in blocks of about wid_block_size as a (wids, line_ids)
+  pair of arrays: the in-vocabulary word IDs of the lines, concatenated, and
+  the index of the line that each word came from.  A line always belongs to the
+  range in which it begins, so adjacent ranges never split a line.
+
+  """
+  word_to_id = _cooc_worker['word_to_id']
+
+  if start > 0:
+    # Skip the remainder of a line that began in the previous range.
+    lines.seek(start - 1)
+    pos = start - 1 + len(lines.readline())
+  else:
+    lines.seek(0)
+    pos = 0
+
+  wids, line_lens = [], []
+  while pos < end:
+    line = lines.readline()
+    if not line:
+      break
+
+    pos += len(line)
+
+    # As in the sequential version, dropping OOV tokens "stretches" the window.
+    line_wids = [
+        wid for wid in (word_to_id.get(w) for w in words(line))
+        if wid is not None]
+
+    wids.extend(line_wids)
+    line_lens.append(len(line_wids))
+    if len(wids) >= wid_block_size:
+      yield (np.array(wids, dtype=np.int64),
+             np.repeat(np.arange(len(line_lens)), line_lens))
+
+      wids, line_lens = [], []
+
+  if wids:
+    yield (np.array(wids, dtype=np.int64),
+           np.repeat(np.arange(len(line_lens)), line_lens))
+
+
+def reduce_coocs(keys, values):
+  """Sums the values that share a key; returns the unique keys and the sums."""
+  keys, inverse = np.unique(keys, return_inverse=True)
+  return keys, np.bincount(inverse, weights=values)
+
+
+def count_coocs(byte_range):
+  """Counts the co-occurrences of the lines in a byte range of the input.
+
+  Each (a, b) pair is stored once with a <= b, encoded as the key
+  a * vocab_size + b.
+
+  Returns:
+    A (keys, values, sums) tuple: the sorted unique pair keys, the summed
+    co-occurrence count of each pair, and the marginal sum of each word.
+
+  """
+  start, end = byte_range
+  vocab_size = _cooc_worker['vocab_size']
+  window_size = _cooc_worker['window_size']
+
+  keys = np.zeros(0, dtype=np.int64)
+  values = np.zeros(0, dtype=np.float64)
+  sums = np.zeros(vocab_size, dtype=np.float64)
+
+  with open(_cooc_worker['filename'], 'r') as lines:
+    for wids, line_ids in iter_wid_blocks(lines, start, end):
+      # Every word co-occurs with itself; only add 1/2 since we output (a, b)
+      # and (b, a).
+      block_keys = [keys, wids * vocab_size + wids]
+      block_values = [values, np.full(len(wids), 0.5)]
+      sums += np.bincount(wids, minlength=vocab_size)
+
+      for off in range(1, min(window_size + 1, len(wids))):
+        in_line = line_ids[off:] == line_ids[:-off]
+        lid = wids[:-off][in_line]
+        rid = wids[off:][in_line]
+        count = 1.0 / off
+
+        sums += count * np.bincount(lid, minlength=vocab_size)
+        sums += count * np.bincount(rid, minlength=vocab_size)
+
+        block_keys.append(np.minimum(lid, rid) * vocab_size +
+                          np.maximum(lid, rid))
+        block_values.append(np.full(len(lid), count))
+
+      keys, values = reduce_coocs(
+          np.concatenate(block_keys), np.concatenate(block_values))
+
+  return keys, values, sums
+
+
 def compute_coocs(lines, vocab):
   """Compute the co-occurrence statistics from the text.
 
+  The input is split into byte ranges of --chunk_size bytes that are counted
+  in --num_workers processes.  The per-range counts are merged in input order,
+  so the result doesn't depend on the number of workers.
+
   This generates a temporary file for each shard that contains the intermediate
   counts from the shard: these counts must be subsequently sorted and collated.
 
   """
-  word_to_id = {tok: idx for idx, tok in enumerate(vocab)}
-
   lines.seek(0, os.SEEK_END)
   nbytes = lines.tell()
   lines.seek(0, os.SEEK_SET)
 
-  num_shards = len(vocab) / FLAGS.shard_size
+  vocab_size = len(vocab)
+  num_shards = vocab_size / FLAGS.shard_size
 
   shardfiles = {}
   for row in range(num_shards):
@@ -156,61 +298,176 @@ def compute_coocs(lines, vocab):
 
       shardfiles[(row, col)] = open(filename, 'w+')
 
-  def flush_coocs():
-    for (row_id, col_id), cnt in coocs.iteritems():
-      row_shard = row_id % num_shards
-      row_off = row_id / num_shards
-      col_shard = col_id % num_shards
-      col_off = col_id / num_shards
+  def flush_coocs(keys, values):
+    row_ids = keys // vocab_size
+    col_ids = keys % vocab_size
 
-      # Since we only stored (a, b), we emit both (a, b) and (b, a).
-      shardfiles[(row_shard, col_shard)].write(
-          shard_cooc_fmt.pack(row_off, col_off, cnt))
+    # Since we only stored (a, b), we emit both (a, b) and (b, a).
+    recs = np.empty(2 * len(keys), dtype=shard_cooc_dtype)
+    recs['row'] = np.concatenate((row_ids, col_ids)) // num_shards
+    recs['col'] = np.concatenate((col_ids, row_ids)) // num_shards
+    recs['value'] = np.concatenate((values, values))
 
-      shardfiles[(col_shard, row_shard)].write(
-          shard_cooc_fmt.pack(col_off, row_off, cnt))
+    shard_ids = (np.concatenate((row_ids, col_ids)) % num_shards * num_shards +
+                 np.concatenate((col_ids, row_ids)) % num_shards)
 
-  coocs = {}
-  sums = [0.0] * len(vocab)
+    order = np.argsort(shard_ids, kind='mergesort')
+    recs = recs[order]
+    bounds = np.searchsorted(
+        shard_ids[order], np.arange(num_shards * num_shards + 1))
 
-  for lineno, line in enumerate(lines, start=1):
-    # Computes the word IDs for each word in the sentence.  This has the effect
-    # of "stretching" the window past OOV tokens.
-    wids = filter(
-        lambda wid: wid is not None,
-        (word_to_id.get(w) for w in words(line)))
-
-    for pos in xrange(len(wids)):
-      lid = wids[pos]
-      window_extent = min(FLAGS.window_size + 1, len(wids) - pos)
-      for off in xrange(1, window_extent):
-        rid = wids[pos + off]
-        pair = (min(lid, rid), max(lid, rid))
-        count = 1.0 / off
-        sums[lid] += count
-        sums[rid] += count
-        coocs.setdefault(pair, 0.0)
-        coocs[pair] += count
+    for shard_id in range(num_shards * num_shards):
+      lo, hi = bounds[shard_id], bounds[shard_id + 1]
+      if lo < hi:
+        recs[lo:hi].tofile(
+            shardfiles[(shard_id // num_shards, shard_id % num_shards)])
 
-      sums[lid] += 1.0
-      pair = (lid, lid)
-      coocs.setdefault(pair, 0.0)
-      coocs[pair] += 0.5  # Only add 1/2 since we output (a, b) and (b, a)
+  byte_ranges = [
+      (start, min(start + FLAGS.chunk_size, nbytes))
+      for start in range(0, nbytes, FLAGS.chunk_size)]
 
-    if lineno % 10000 == 0:
-      pos = lines.tell()
-      sys.stdout.write('\rComputing co-occurrences: %0.1f%% (%d/%d)...' % (
-          100.0 * pos / nbytes, pos, nbytes))
-      sys.stdout.flush()
+  initargs = (lines.name, vocab, FLAGS.window_size)
+  if FLAGS.num_workers > 1:
+    pool = multiprocessing.Pool(
+        FLAGS.num_workers, initializer=init_cooc_worker, initargs=initargs)
+
+    results = pool.imap(count_coocs, byte_ranges)
+  else:
+    pool = None
+    init_cooc_worker(*initargs)
+    results = itertools.imap(count_coocs, byte_ranges)
+
+  keys = np.zeros(0, dtype=np.int64)
+  values = np.zeros(0, dtype=np.float64)
+  sums = np.zeros(vocab_size, dtype=np.float64)
+
+  for (_, end), (range_keys, range_values, range_sums) in itertools.izip(
+      byte_ranges, results):
+    keys, values = reduce_coocs(
+        np.concatenate((keys, range_keys)),
+        np.concatenate((values, range_values)))
 
-      if len(coocs) > FLAGS.bufsz:
-        flush_coocs()
-        coocs = {}
+    sums += range_sums
+
+    if len(keys) > FLAGS.bufsz:
+      flush_coocs(keys, values)
+      keys = np.zeros(0, dtype=np.int64)
+      values = np.zeros(0, dtype=np.float64)
+
+    sys.stdout.write('\rComputing co-occurrences: %0.1f%% (%d/%d)...' % (
+        100.0 * end / nbytes, end, nbytes))
+    sys.stdout.flush()
 
-  flush_coocs()
+  if pool:
+    pool.close()
+    pool.join()
+
+  flush_coocs(keys, values)
   sys.stdout.write('\n')
 
-  return shardfiles, sums
+  return shardfiles, sums.tolist()
+
+
+def merge_coocs(coocs):
+  """Sorts co-occurrence records and sums the values of duplicate cells.
+
+  Duplicates are summed in order of increasing value, just as sorting the
+  records as (row, col, value) tuples would.
+
+  Args:
+    coocs: an array of shard_cooc_dtype or merged_cooc_dtype records.
+
+  Returns:
+    An array of merged_cooc_dtype records, sorted by (row, col), with one
+    record per cell.
+  """
+  coocs = coocs[np.lexsort((coocs['value'], coocs['col'], coocs['row']))]
+  rows, cols = coocs['row'], coocs['col']
+
+  merged = np.empty(0, dtype=merged_cooc_dtype)
+  if len(coocs):
+    starts = np.flatnonzero(np.concatenate((
+        [True], (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1]))))
+
+    merged = np.empty(len(starts), dtype=merged_cooc_dtype)
+    merged['row'] = rows[starts]
+    merged['col'] = cols[starts]
+    merged['value'] = np.add.reduceat(
+        coocs['value'].astype(np.float64), starts)
+
+  return merged
+
+
+def cooc_keys(coocs):
+  """Returns a sortable int64 key for the (row, col) cell of each record."""
+  return (coocs['row'].astype(np.int64) << 32) | coocs['col']
+
+
+def merge_runs(runs, block_len):
+  """Merges sorted runs of merged_cooc_dtype records into one sorted array.
+
+  Each step reads a block of at most block_len records from every run.  All
+  the records up to the smallest last key of those blocks can be merged and
+  emitted, since no later record of any run can precede it.
+  """
+  positions = [0] * len(runs)
+  merged = []
+  while True:
+    blocks = [
+        (ix, run[pos:pos + block_len])
+        for ix, (run, pos) in enumerate(itertools.izip(runs, positions))
+        if pos < len(run)]
+
+    if not blocks:
+      break
+
+    bound = min(cooc_keys(block[-1:])[0] for _, block in blocks)
+
+    ready = []
+    for ix, block in blocks:
+      count = np.searchsorted(cooc_keys(block), bound, side='right')
+      ready.append(block[:count])
+      positions[ix] += count
+
+    merged.append(merge_coocs(np.concatenate(ready)))
+
+  return np.concatenate(merged) if merged else np.empty(
+      0, dtype=merged_cooc_dtype)
+
+
+def read_shard_coocs(filename):
+  """Reads, sorts and merges the co-occurrences of a temporary shard file.
+
+  If the file is larger than --shard_memory bytes, it is merged as sorted runs
+  of that size that are spilled to disk and then merged together.
+
+  """
+  if not os.path.getsize(filename):
+    return np.empty(0, dtype=merged_cooc_dtype)
+
+  coocs = np.memmap(filename, dtype=shard_cooc_dtype, mode='r')
+  if coocs.nbytes <= FLAGS.shard_memory:
+    return merge_coocs(coocs)
+
+  run_len = max(1, FLAGS.shard_memory // shard_cooc_dtype.itemsize)
+  run_filenames = []
+  for start in range(0, len(coocs), run_len):
+    run_filenames.append('%s.run%03d' % (filename, len(run_filenames)))
+    merge_coocs(coocs[start:start + run_len]).tofile(run_filenames[-1])
+
+  runs = [
+      np.memmap(run_filename, dtype=merged_cooc_dtype, mode='r')
+      for run_filename in run_filenames]
+
+  # Give every run an equal share of the budget, but don't let the blocks get
+  # so small that the merge is dominated by per-block overhead.
+  merged = merge_runs(runs, max(4096, run_len // len(runs)))
+
+  del runs
+  for run_filename in run_filenames:
+    os.unlink(run_filename)
+
+  return merged
 
 
 def write_shards(vocab, shardfiles):
@@ -228,37 +485,10 @@ def write_shards(vocab, shardfiles):
     sys.stdout.write('\rwriting shard %d/%d' % (ix, len(shardfiles)))
     sys.stdout.flush()
 
-    # Read the entire binary co-occurrence and unpack it into an array.
-    fh.seek(0)
-    buf = fh.read()
-    os.unlink(fh.name)
-    fh.close()
-
-    coocs = [
-        shard_cooc_fmt.unpack_from(buf, off)
-        for off in range(0, len(buf), shard_cooc_fmt.size)]
-
     # Sort and merge co-occurrences for the same pairs.
-    coocs.sort()
-
-    if coocs:
-      current_pos = 0
-      current_row_col = (coocs[current_pos][0], coocs[current_pos][1])
-      for next_pos in range(1, len(coocs)):
-        next_row_col = (coocs[next_pos][0], coocs[next_pos][1])
-        if current_row_col == next_row_col:
-          coocs[current_pos] = (
-              coocs[current_pos][0],
-              coocs[current_pos][1],
-              coocs[current_pos][2] + coocs[next_pos][2])
-        else:
-          current_pos += 1
-          if current_pos < next_pos:
-            coocs[current_pos] = coocs[next_pos]
-
-          current_row_col = (coocs[current_pos][0], coocs[current_pos][1])
-
-      coocs = coocs[:(1 + current_pos)]
+    fh.close()
+    coocs = read_shard_coocs(fh.name)
+    os.unlink(fh.name)
 
     # Convert to a TF Example proto.
     def _int64s(xs):
@@ -273,9 +503,9 @@ def write_shards(vocab, shardfiles):
         'global_col': _int64s(
             col + num_shards * i for i in range(FLAGS.shard_size)),
 
-        'sparse_local_row': _int64s(cooc[0] for cooc in coocs),
-        'sparse_local_col': _int64s(cooc[1] for cooc in coocs),
-        'sparse_value': _floats(cooc[2] for cooc in coocs),
+        'sparse_local_row': _int64s(coocs['row'].tolist()),
+        'sparse_local_col': _int64s(coocs['col'].tolist()),
+        'sparse_value': _floats(coocs['value'].tolist()),
     }))
 
     filename = os.path.join(FLAGS.output_dir, 'shard-%03d-%03d.pb' % (row, col))
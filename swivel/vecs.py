@@ -18,8 +18,13 @@ import os
 import struct
 
 class Vecs(object):
-  def __init__(self, vocab_filename, rows_filename, cols_filename=None):
-    """Initializes the vectors from a text vocabulary and binary data."""
+  def __init__(self, vocab_filename, rows_filename, cols_filename=None,
+               index_filename=None):
+    """Initializes the vectors from a text vocabulary and binary data.
+
+    If index_filename is given, the nearest neighbor index is loaded from it;
+    if it doesn't exist yet, the index is built and saved there.
+    """
     with open(vocab_filename, 'r') as lines:
       self.vocab = [line.split()[0] for line in lines]
       self.word_to_idx = {word: idx for idx, word in enumerate(self.vocab)}
@@ -60,6 +65,14 @@ class Vecs(object):
       self.vecs = rows / np.linalg.norm(rows, axis=1).reshape(n, 1)
       rows_mm.close()
 
+    self.index_centroids = None
+    if index_filename:
+      if os.path.exists(index_filename):
+        self.load_index(index_filename)
+      else:
+        self.build_index()
+        self.save_index(index_filename)
+
   def similarity(self, word1, word2):
     """Computes the similarity of two tokens."""
     idx1 = self.word_to_idx.get(word1)
@@ -69,8 +82,64 @@ class Vecs(object):
 
     return float(self.vecs[idx1] * self.vecs[idx2].transpose())
 
-  def neighbors(self, query):
-    """Returns the nearest neighbors to the query (a word or vector)."""
+  def build_index(self, num_lists=None, num_iters=10, seed=0):
+    """Builds an inverted-file index for approximate nearest neighbors.
+
+    The vectors are clustered into num_lists partitions with spherical
+    k-means; a query is then only compared with the vectors of the partitions
+    whose centroids are closest to it.  By default, num_lists is about the
+    square root of the vocabulary size.
+    """
+    vecs = np.asarray(self.vecs)
+    n = len(vecs)
+    if not num_lists:
+      num_lists = int(np.sqrt(n))
+
+    num_lists = max(1, min(num_lists, n))
+
+    rng = np.random.RandomState(seed)
+    centroids = vecs[rng.choice(n, num_lists, replace=False)]
+    for _ in xrange(num_iters):
+      assignments = self._assign(vecs, centroids)
+      sums = np.zeros_like(centroids)
+      np.add.at(sums, assignments, vecs)
+
+      # Keep the old centroid for partitions that lost all their members.
+      counts = np.bincount(assignments, minlength=num_lists)
+      sums[counts == 0] = centroids[counts == 0]
+      centroids = sums / np.linalg.norm(sums, axis=1).reshape(num_lists, 1)
+
+    assignments = self._assign(vecs, centroids)
+    self.index_centroids = centroids.astype(np.float32)
+    self.index_ids = np.argsort(assignments, kind='mergesort')
+    self.index_offsets = np.concatenate(
+        ([0], np.cumsum(np.bincount(assignments, minlength=num_lists))))
+
+  @staticmethod
+  def _assign(vecs, centroids, block_size=65536):
+    """Returns the index of the most similar centroid for each vector."""
+    return np.concatenate([
+        np.argmax(np.dot(vecs[start:start + block_size], centroids.T), axis=1)
+        for start in xrange(0, len(vecs), block_size)])
+
+  def save_index(self, index_filename):
+    """Saves the index built by build_index, e.g. to "<vecs>.ivf.npz"."""
+    with open(index_filename, 'wb') as fh:
+      np.savez(fh, centroids=self.index_centroids, ids=self.index_ids,
+               offsets=self.index_offsets)
+
+  def load_index(self, index_filename):
+    """Loads an index saved with save_index."""
+    index = np.load(index_filename)
+    if len(index['ids']) != len(self.vocab):
+      raise IOError('index %s does not match the vocabulary' % index_filename)
+
+    self.index_centroids = index['centroids']
+    self.index_ids = index['ids']
+    self.index_offsets = index['offsets']
+
+  def _query_vec(self, query):
+    """Returns the vector for a query word or vector, or None if it's OOV."""
     if isinstance(query, basestring):
       idx = self.word_to_idx.get(query)
       if idx is None:
@@ -78,11 +147,71 @@ class Vecs(object):
 
       query = self.vecs[idx]
 
-    neighbors = self.vecs * query.transpose()
-
-    return sorted(
-      zip(self.vocab, neighbors.flat),
-      key=lambda kv: kv[1], reverse=True)
+    return np.asarray(query, dtype=np.float32).reshape(-1)
+
+  def _top_k(self, ids, scores, k):
+    """Returns the k best (word, score) pairs of the candidates, best first."""
+    if k < len(scores):
+      top = np.argpartition(-scores, k - 1)[:k]
+      ids, scores = ids[top], scores[top]
+
+    order = np.argsort(-scores, kind='mergesort')
+    return [(self.vocab[idx], float(score))
+            for idx, score in zip(ids[order], scores[order])]
+
+  def neighbors(self, query, k=None, exact=False, nprobe=8):
+    """Returns the nearest neighbors to the query (a word or vector).
+
+    With k=None, every word is returned, sorted by similarity.  Otherwise only
+    the k nearest are returned; if an index was built or loaded, they come from
+    the nprobe partitions closest to the query, unless exact is set.
+    """
+    res = self.batch_neighbors([query], k=k, exact=exact, nprobe=nprobe)
+    return res[0]
+
+  def batch_neighbors(self, queries, k=None, exact=False, nprobe=8,
+                      block_size=1024):
+    """Returns the nearest neighbors for each of a list of queries.
+
+    The queries are words or vectors; see neighbors() for the meaning of the
+    other arguments.  The result for an out-of-vocabulary word is None.
+    """
+    query_vecs = [self._query_vec(query) for query in queries]
+    valid = [ix for ix, vec in enumerate(query_vecs) if vec is not None]
+    res = [None] * len(queries)
+    if not valid:
+      return res
+
+    vecs = np.asarray(self.vecs)
+    use_index = (k is not None and not exact and
+                 self.index_centroids is not None)
+
+    if k is None:
+      k = len(vecs)
+    for start in xrange(0, len(valid), block_size):
+      block = valid[start:start + block_size]
+      block_vecs = np.vstack([query_vecs[ix] for ix in block])
+
+      if not use_index:
+        all_ids = np.arange(len(vecs))
+        for ix, scores in zip(block, np.dot(block_vecs, vecs.T)):
+          res[ix] = self._top_k(all_ids, scores, k)
+
+        continue
+
+      # Probe the partitions whose centroids are closest to each query.
+      num_lists = len(self.index_centroids)
+      probe = min(nprobe, num_lists)
+      centroid_scores = np.dot(block_vecs, self.index_centroids.T)
+      lists = np.argpartition(-centroid_scores, probe - 1, axis=1)[:, :probe]
+      for ix, query_vec, query_lists in zip(block, block_vecs, lists):
+        ids = np.concatenate([
+            self.index_ids[self.index_offsets[l]:self.index_offsets[l + 1]]
+            for l in query_lists])
+
+        res[ix] = self._top_k(ids, np.dot(vecs[ids], query_vec), k)
+
+    return res
 
   def lookup(self, word):
     """Returns the embedding for a token, or None if no embedding exists."""
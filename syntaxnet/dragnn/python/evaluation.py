@@ -16,76 +16,76 @@
 
 from __future__ import division
 
+import multiprocessing
+
 import tensorflow as tf
 
 from syntaxnet import sentence_pb2
 from syntaxnet.util import check
 
 
-def calculate_parse_metrics(gold_corpus, annotated_corpus):
-  """Calculate POS/UAS/LAS accuracy based on gold and annotated sentences."""
-  check.Eq(len(gold_corpus), len(annotated_corpus), 'Corpora are not aligned')
-  num_tokens = 0
-  num_correct_pos = 0
-  num_correct_uas = 0
-  num_correct_las = 0
-  for gold_str, annotated_str in zip(gold_corpus, annotated_corpus):
-    gold = sentence_pb2.Sentence()
-    annotated = sentence_pb2.Sentence()
-    gold.ParseFromString(gold_str)
-    annotated.ParseFromString(annotated_str)
-    check.Eq(gold.text, annotated.text, 'Text is not aligned')
+def _ratio(numerator, denominator):
+  check.Ge(numerator, 0)
+  check.Ge(denominator, 0)
+  if denominator > 0:
+    return numerator / denominator
+  elif numerator == 0:
+    return 0.0  # map 0/0 to 0
+  else:
+    return float('inf')  # map x/0 to inf
+
+
+def _parse_sentences(gold_str, annotated_str):
+  """Parses a pair of serialized gold and annotated sentences."""
+  gold = sentence_pb2.Sentence()
+  annotated = sentence_pb2.Sentence()
+  gold.ParseFromString(gold_str)
+  annotated.ParseFromString(annotated_str)
+  check.Eq(gold.text, annotated.text, 'Text is not aligned')
+  return gold, annotated
+
+
+def _count_parse_batch(batch):
+  """Returns the document, token, POS, UAS and LAS counts of a batch.
+
+  Args:
+    batch: Pair of aligned lists of serialized gold and annotated sentences.
+
+  Returns:
+    List of the number of documents, tokens, and tokens with a correct tag,
+    head, and head and label.
+  """
+  counts = [0] * 5
+  for gold_str, annotated_str in zip(*batch):
+    gold, annotated = _parse_sentences(gold_str, annotated_str)
     check.Eq(len(gold.token), len(annotated.token), 'Tokens are not aligned')
     tokens = zip(gold.token, annotated.token)
-    num_tokens += len(tokens)
-    num_correct_pos += sum(1 for x, y in tokens if x.tag == y.tag)
-    num_correct_uas += sum(1 for x, y in tokens if x.head == y.head)
-    num_correct_las += sum(1 for x, y in tokens
-                           if x.head == y.head and x.label == y.label)
-
-  tf.logging.info('Total num documents: %d', len(annotated_corpus))
-  tf.logging.info('Total num tokens: %d', num_tokens)
-  pos = num_correct_pos * 100.0 / num_tokens
-  uas = num_correct_uas * 100.0 / num_tokens
-  las = num_correct_las * 100.0 / num_tokens
-  tf.logging.info('POS: %.2f%%', pos)
-  tf.logging.info('UAS: %.2f%%', uas)
-  tf.logging.info('LAS: %.2f%%', las)
-  return pos, uas, las
+    counts[0] += 1
+    counts[1] += len(tokens)
+    counts[2] += sum(1 for x, y in tokens if x.tag == y.tag)
+    counts[3] += sum(1 for x, y in tokens if x.head == y.head)
+    counts[4] += sum(1 for x, y in tokens
+                     if x.head == y.head and x.label == y.label)
+  return counts
 
 
-def parser_summaries(gold_corpus, annotated_corpus):
-  """Computes parser evaluation summaries for gold and annotated sentences."""
-  pos, uas, las = calculate_parse_metrics(gold_corpus, annotated_corpus)
-  return {'POS': pos, 'LAS': las, 'UAS': uas, 'eval_metric': las}
+def _count_segmentation_batch(batch):
+  """Returns the document, gold, test and correct token counts of a batch.
 
+  Args:
+    batch: Pair of aligned lists of serialized gold and annotated sentences.
 
-def calculate_segmentation_metrics(gold_corpus, annotated_corpus):
-  """Calculate precision/recall/f1 based on gold and annotated sentences."""
-  check.Eq(len(gold_corpus), len(annotated_corpus), 'Corpora are not aligned')
-  num_gold_tokens = 0
-  num_test_tokens = 0
-  num_correct_tokens = 0
+  Returns:
+    List of the number of documents, gold token spans, annotated token spans
+    and annotated token spans that are also gold token spans.
+  """
   def token_span(token):
     check.Ge(token.end, token.start)
     return (token.start, token.end)
 
-  def ratio(numerator, denominator):
-    check.Ge(numerator, 0)
-    check.Ge(denominator, 0)
-    if denominator > 0:
-      return numerator / denominator
-    elif numerator == 0:
-      return 0.0  # map 0/0 to 0
-    else:
-      return float('inf')  # map x/0 to inf
-
-  for gold_str, annotated_str in zip(gold_corpus, annotated_corpus):
-    gold = sentence_pb2.Sentence()
-    annotated = sentence_pb2.Sentence()
-    gold.ParseFromString(gold_str)
-    annotated.ParseFromString(annotated_str)
-    check.Eq(gold.text, annotated.text, 'Text is not aligned')
+  counts = [0] * 4
+  for gold_str, annotated_str in zip(*batch):
+    gold, annotated = _parse_sentences(gold_str, annotated_str)
     gold_spans = set()
     test_spans = set()
     for token in gold.token:
@@ -94,21 +94,179 @@ def calculate_segmentation_metrics(gold_corpus, annotated_corpus):
     for token in annotated.token:
       check.NotIn(token_span(token), test_spans, 'Duplicate token')
       test_spans.add(token_span(token))
-    num_gold_tokens += len(gold_spans)
-    num_test_tokens += len(test_spans)
-    num_correct_tokens += len(gold_spans.intersection(test_spans))
-
-  tf.logging.info('Total num documents: %d', len(annotated_corpus))
-  tf.logging.info('Total gold tokens: %d', num_gold_tokens)
-  tf.logging.info('Total test tokens: %d', num_test_tokens)
-  precision = 100 * ratio(num_correct_tokens, num_test_tokens)
-  recall = 100 * ratio(num_correct_tokens, num_gold_tokens)
-  f1 = ratio(2 * precision * recall, precision + recall)
+    counts[0] += 1
+    counts[1] += len(gold_spans)
+    counts[2] += len(test_spans)
+    counts[3] += len(gold_spans.intersection(test_spans))
+  return counts
+
+
+class StreamingEvaluator(object):
+  """Accumulates evaluation counts over batches of serialized sentences.
+
+  Batches are added as soon as they are annotated, and are deserialized and
+  counted in a pool of num_processes worker processes, so that neither corpus
+  has to be held in memory as a whole.  With num_processes=0, batches are
+  counted in the calling thread.  The metrics can be read at any time; with
+  wait=False, they only cover the batches counted so far.
+
+  Subclasses define _count_batch, a module-level function mapping a pair of
+  gold and annotated batches to a list of counts, _metrics, which turns the
+  summed counts into a tuple of metrics, and _summary_keys, the names of those
+  metrics in the summaries.  The last metric is also the 'eval_metric'.
+  """
+
+  def __init__(self, num_processes=None):
+    """Creates the evaluator.
+
+    Args:
+      num_processes: Number of worker processes; defaults to the number of
+        CPUs.  The pool is started right away, so evaluators should be created
+        before any threads (e.g. a TF session) are.
+    """
+    if num_processes is None:
+      num_processes = multiprocessing.cpu_count()
+    self._pool = multiprocessing.Pool(num_processes) if num_processes else None
+    self.reset()
+
+  def reset(self):
+    """Discards all counts, e.g. before evaluating a new set of annotations."""
+    self._counts = None
+    self._pending = []
+
+  def close(self):
+    """Shuts down the worker processes."""
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool = None
+
+  def add_batch(self, gold_batch, annotated_batch):
+    """Adds aligned batches of serialized gold and annotated sentences."""
+    check.Eq(len(gold_batch), len(annotated_batch), 'Corpora are not aligned')
+    batch = (list(gold_batch), list(annotated_batch))
+    if self._pool is None:
+      self._add_counts(self._count_batch(batch))
+    else:
+      self._pending.append(self._pool.apply_async(self._count_batch, (batch,)))
+
+  def _add_counts(self, counts):
+    if self._counts is None:
+      self._counts = counts
+    else:
+      self._counts = [x + y for x, y in zip(self._counts, counts)]
+
+  def counts(self, wait=True):
+    """Returns the summed counts, waiting for pending batches if wait is set."""
+    while self._pending and (wait or self._pending[0].ready()):
+      self._add_counts(self._pending.pop(0).get())
+    if self._counts is None:
+      return self._count_batch(([], []))
+    return list(self._counts)
+
+  def metrics(self, wait=True):
+    """Returns the metrics over all batches, or those counted so far."""
+    return self._metrics(self.counts(wait))
+
+  def summaries(self, wait=True):
+    """Returns a dict of metrics, including the 'eval_metric' summary."""
+    metrics = self.metrics(wait)
+    summaries = dict(zip(self._summary_keys, metrics))
+    summaries['eval_metric'] = metrics[-1]
+    return summaries
+
+
+class ParserEvaluator(StreamingEvaluator):
+  """Streaming POS/UAS/LAS evaluation."""
+
+  _count_batch = staticmethod(_count_parse_batch)
+  _summary_keys = ('POS', 'UAS', 'LAS')
+
+  def _metrics(self, counts):
+    num_tokens = counts[1]
+    return tuple(100.0 * _ratio(correct, num_tokens) for correct in counts[2:])
+
+
+class SegmentationEvaluator(StreamingEvaluator):
+  """Streaming token segmentation precision/recall/F1 evaluation."""
+
+  _count_batch = staticmethod(_count_segmentation_batch)
+  _summary_keys = ('precision', 'recall', 'f1')
+
+  def _metrics(self, counts):
+    _, num_gold_tokens, num_test_tokens, num_correct_tokens = counts
+    precision = 100 * _ratio(num_correct_tokens, num_test_tokens)
+    recall = 100 * _ratio(num_correct_tokens, num_gold_tokens)
+    f1 = _ratio(2 * precision * recall, precision + recall)
+    return round(precision, 2), round(recall, 2), round(f1, 2)
+
+
+def _evaluate(evaluator, gold_corpus, annotated_corpus, batch_size):
+  """Adds the corpora to evaluator in batches and returns the summed counts."""
+  check.Eq(len(gold_corpus), len(annotated_corpus), 'Corpora are not aligned')
+  try:
+    for start in range(0, len(gold_corpus), batch_size):
+      evaluator.add_batch(gold_corpus[start:start + batch_size],
+                          annotated_corpus[start:start + batch_size])
+    return evaluator.counts()
+  finally:
+    evaluator.close()
+
+
+def calculate_parse_metrics(gold_corpus, annotated_corpus, num_processes=0,
+                            batch_size=1024):
+  """Calculate POS/UAS/LAS accuracy based on gold and annotated sentences.
+
+  Args:
+    gold_corpus: List of serialized gold sentences.
+    annotated_corpus: List of serialized annotated sentences.
+    num_processes: Number of processes to deserialize sentences in; if 0,
+      they are deserialized in the calling thread.
+    batch_size: Number of sentences per unit of work.
+
+  Returns:
+    POS, UAS and LAS accuracy, in percent.
+  """
+  evaluator = ParserEvaluator(num_processes)
+  counts = _evaluate(evaluator, gold_corpus, annotated_corpus, batch_size)
+  pos, uas, las = evaluator.metrics()
+  tf.logging.info('Total num documents: %d', counts[0])
+  tf.logging.info('Total num tokens: %d', counts[1])
+  tf.logging.info('POS: %.2f%%', pos)
+  tf.logging.info('UAS: %.2f%%', uas)
+  tf.logging.info('LAS: %.2f%%', las)
+  return pos, uas, las
+
+
+def parser_summaries(gold_corpus, annotated_corpus):
+  """Computes parser evaluation summaries for gold and annotated sentences."""
+  pos, uas, las = calculate_parse_metrics(gold_corpus, annotated_corpus)
+  return {'POS': pos, 'LAS': las, 'UAS': uas, 'eval_metric': las}
+
+
+def calculate_segmentation_metrics(gold_corpus, annotated_corpus,
+                                   num_processes=0, batch_size=1024):
+  """Calculate precision/recall/f1 based on gold and annotated sentences.
+
+  Args:
+    gold_corpus: List of serialized gold sentences.
+    annotated_corpus: List of serialized annotated sentences.
+    num_processes: Number of processes to deserialize sentences in; if 0,
+      they are deserialized in the calling thread.
+    batch_size: Number of sentences per unit of work.
+
+  Returns:
+    Precision, recall and F1, in percent and rounded to two decimals.
+  """
+  evaluator = SegmentationEvaluator(num_processes)
+  counts = _evaluate(evaluator, gold_corpus, annotated_corpus, batch_size)
+  precision, recall, f1 = evaluator.metrics()
+  tf.logging.info('Total num documents: %d', counts[0])
+  tf.logging.info('Total gold tokens: %d', counts[1])
+  tf.logging.info('Total test tokens: %d', counts[2])
   tf.logging.info('Precision: %.2f%%', precision)
   tf.logging.info('Recall: %.2f%%', recall)
   tf.logging.info('F1: %.2f%%', f1)
-
-  return round(precision, 2), round(recall, 2), round(f1, 2)
+  return precision, recall, f1
 
 
 def segmentation_summaries(gold_corpus, annotated_corpus):
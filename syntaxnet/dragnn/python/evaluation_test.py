@@ -53,6 +53,33 @@ class EvaluationTest(tf.test.TestCase):
     self.assertEqual(50, uas)
     self.assertEqual(25, las)
 
+  def testCalculateParseMetricsInProcesses(self):
+    pos, uas, las = evaluation.calculate_parse_metrics(
+        self._gold_corpus, self._test_corpus, num_processes=2, batch_size=1)
+    self.assertEqual(75, pos)
+    self.assertEqual(50, uas)
+    self.assertEqual(25, las)
+
+  def testParserEvaluator(self):
+    evaluator = evaluation.ParserEvaluator(num_processes=0)
+    self.assertEqual((0, 0, 0), evaluator.metrics())
+
+    # Partial metrics cover the batches added so far.
+    evaluator.add_batch(self._gold_corpus[:1], self._test_corpus[:1])
+    self.assertEqual((100, 100, 100), evaluator.metrics())
+    evaluator.add_batch(self._gold_corpus[1:], self._test_corpus[1:])
+    self.assertEqual({
+        'POS': 75,
+        'UAS': 50,
+        'LAS': 25,
+        'eval_metric': 25
+    }, evaluator.summaries())
+    self.assertEqual([2, 4, 3, 2, 1], evaluator.counts())
+
+    evaluator.reset()
+    evaluator.add_batch(self._gold_corpus[1:], self._test_corpus[1:])
+    self.assertEqual([1, 3, 2, 1, 0], evaluator.counts())
+
   def testCalculateSegmentationMetrics(self):
     self._gold_corpus = []
     self._test_corpus = []
@@ -14,6 +14,10 @@
 # ==============================================================================
 
 """Utilities for reading and writing sentences in dragnn."""
+import hashlib
+import threading
+import Queue
+
 import tensorflow as tf
 from syntaxnet.ops import gen_parser_ops
 
@@ -66,14 +70,198 @@ class ConllSentenceReader(object):
       sentences, is_last = [], True
     return sentences, is_last
 
+  def batches(self):
+    """Yields the remaining batches of sentences, until the last one."""
+    while True:
+      sentences, is_last = self.read()
+      if len(sentences):
+        yield sentences
+      if is_last:
+        break
+
   def corpus(self):
     """Reads the entire corpus, and returns in a list."""
     tf.logging.info('Reading corpus...')
     corpus = []
-    while True:
-      sentences, is_last = self.read()
+    for sentences in self.batches():
       corpus.extend(sentences)
-      if is_last:
-        break
     tf.logging.info('Read %d sentences.' % len(corpus))
     return corpus
+
+
+class _EndOfShard(object):
+  """Marks the end of a shard in its prefetch queue."""
+
+  def __init__(self, error=None):
+    self.error = error
+
+
+class ShardedConllSentenceReader(object):
+  """A reader for sharded conll files, which reads shards in parallel.
+
+  Up to num_threads shards are read at once, each with its own
+  ConllSentenceReader, into prefetch queues of at most prefetch_batches
+  batches each.  The batches are yielded lazily, shard by shard in the sorted
+  order of the file names, so the order of the sentences is deterministic.
+  """
+
+  def __init__(self, filepattern, batch_size=32, projectivize=False,
+               morph_to_pos=False, num_threads=4, prefetch_batches=16):
+    """Creates the reader.
+
+    Args:
+      filepattern: Comma-separated list of file patterns of the shards.
+      batch_size: Number of sentences per batch.
+      projectivize: Whether to projectivize the sentences.
+      morph_to_pos: Whether to join morphological attributes to the POS tag.
+      num_threads: Maximum number of shards to read at once.
+      prefetch_batches: Maximum number of batches read ahead per shard.
+    """
+    self._shards = sorted(set(
+        path for pattern in filepattern.split(',')
+        for path in tf.gfile.Glob(pattern)))
+    if not self._shards:
+      raise IOError('No files match %s' % filepattern)
+    self._reader_args = (batch_size, projectivize, morph_to_pos)
+    self._num_threads = num_threads
+    self._prefetch_batches = prefetch_batches
+
+  @property
+  def shards(self):
+    return self._shards
+
+  def _put(self, shard_queue, item, stop):
+    """Puts item into shard_queue, unless stop is set while it is full."""
+    while not stop.is_set():
+      try:
+        shard_queue.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def _read_shards(self, shard_queues, next_shard, lock, stop):
+    """Reads whole shards into their queues, until none are left."""
+    while not stop.is_set():
+      with lock:
+        index = next_shard[0]
+        next_shard[0] += 1
+      if index >= len(self._shards):
+        return
+      try:
+        reader = ConllSentenceReader(self._shards[index], *self._reader_args)
+        for sentences in reader.batches():
+          if not self._put(shard_queues[index], sentences, stop):
+            return
+        end = _EndOfShard()
+      except Exception as error:  # pylint: disable=broad-except
+        end = _EndOfShard(error)
+      if not self._put(shard_queues[index], end, stop):
+        return
+
+  def batches(self):
+    """Yields the batches of sentences of all shards."""
+    shard_queues = [Queue.Queue(self._prefetch_batches) for _ in self._shards]
+    next_shard = [0]
+    lock = threading.Lock()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=self._read_shards,
+                         args=(shard_queues, next_shard, lock, stop))
+        for _ in xrange(min(self._num_threads, len(self._shards)))]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    try:
+      for shard_queue in shard_queues:
+        while True:
+          item = shard_queue.get()
+          if isinstance(item, _EndOfShard):
+            if item.error is not None:
+              raise item.error
+            break
+          yield item
+    finally:
+      stop.set()
+      for thread in threads:
+        thread.join()
+
+  def corpus(self):
+    """Reads the entire corpus, and returns in a list."""
+    tf.logging.info('Reading corpus from %d shards...', len(self._shards))
+    corpus = []
+    for sentences in self.batches():
+      corpus.extend(sentences)
+    tf.logging.info('Read %d sentences.' % len(corpus))
+    return corpus
+
+
+def write_corpus(path, batches):
+  """Writes batches of serialized sentences to a TFRecord file.
+
+  The file is written under a temporary name and then renamed, so that an
+  interrupted write does not leave a partial corpus at path.
+
+  Args:
+    path: Path of the file to write.
+    batches: Iterable of lists of serialized sentences.
+
+  Returns:
+    The number of sentences written.
+  """
+  tmp_path = '%s.tmp' % path
+  num_sentences = 0
+  writer = tf.python_io.TFRecordWriter(tmp_path)
+  try:
+    for sentences in batches:
+      for sentence in sentences:
+        writer.write(sentence)
+      num_sentences += len(sentences)
+  finally:
+    writer.close()
+  tf.gfile.Rename(tmp_path, path, overwrite=True)
+  return num_sentences
+
+
+def read_corpus(filepattern, projectivize=False, morph_to_pos=False,
+                cache_dir=None, num_threads=4):
+  """Reads a sharded conll corpus into a list of serialized sentences.
+
+  If cache_dir is set, the serialized sentences are cached there, in a file
+  named after the arguments; later calls read the cache instead of parsing
+  (and projectivizing) the conll files again, as long as none of the files is
+  newer than the cache.
+
+  Args:
+    filepattern: Comma-separated list of file patterns of the shards.
+    projectivize: Whether to projectivize the sentences.
+    morph_to_pos: Whether to join morphological attributes to the POS tag.
+    cache_dir: Optional directory of cached corpora.
+    num_threads: Maximum number of shards to read at once.
+
+  Returns:
+    List of serialized sentences.
+  """
+  reader = ShardedConllSentenceReader(
+      filepattern, projectivize=projectivize, morph_to_pos=morph_to_pos,
+      num_threads=num_threads)
+  if not cache_dir:
+    return reader.corpus()
+
+  key = repr((reader.shards, bool(projectivize), bool(morph_to_pos)))
+  cache_path = '%s/corpus-%s.tfrecord' % (
+      cache_dir, hashlib.md5(key).hexdigest())
+  if tf.gfile.Exists(cache_path):
+    cache_mtime = tf.gfile.Stat(cache_path).mtime_nsec
+    if all(tf.gfile.Stat(path).mtime_nsec <= cache_mtime
+           for path in reader.shards):
+      tf.logging.info('Reading cached corpus %s...', cache_path)
+      corpus = list(tf.python_io.tf_record_iterator(cache_path))
+      tf.logging.info('Read %d sentences.' % len(corpus))
+      return corpus
+
+  corpus = reader.corpus()
+  tf.gfile.MakeDirs(cache_dir)
+  write_corpus(cache_path, [corpus])
+  tf.logging.info('Cached corpus in %s.', cache_path)
+  return corpus
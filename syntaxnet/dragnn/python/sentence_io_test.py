@@ -77,6 +77,82 @@ class ConllSentenceReaderTest(test_util.TensorFlowTestCase):
     self.assertParseable(reader, 0, True)
     self.assertParseable(reader, 0, True)
 
+  def testReadBatches(self):
+    reader = sentence_io.ConllSentenceReader(self.filepath, self.batch_size)
+    self.assertEqual([20, 20, 14], [len(b) for b in reader.batches()])
+
+
+class ShardedConllSentenceReaderTest(test_util.TensorFlowTestCase):
+
+  def setUp(self):
+    self.filepath = os.path.join(
+        FLAGS.test_srcdir,
+        'syntaxnet/testdata/mini-training-set')
+    self.shard_dir = os.path.join(FLAGS.test_tmpdir, 'shards')
+    tf.gfile.MakeDirs(self.shard_dir)
+    for shard in ['shard-00000-of-00002', 'shard-00001-of-00002']:
+      tf.gfile.Copy(self.filepath, os.path.join(self.shard_dir, shard),
+                    overwrite=True)
+    self.filepattern = os.path.join(self.shard_dir, 'shard-*')
+    self.expected = sentence_io.ConllSentenceReader(self.filepath).corpus()
+
+  def testReadShards(self):
+    reader = sentence_io.ShardedConllSentenceReader(
+        self.filepattern, batch_size=20, num_threads=2, prefetch_batches=1)
+    self.assertEqual(2, len(reader.shards))
+    self.assertEqual([20, 20, 14, 20, 20, 14],
+                     [len(b) for b in reader.batches()])
+    self.assertEqual(self.expected * 2, reader.corpus())
+
+  def testReadCorpusWithCache(self):
+    # Count the reads of the shards.
+    reads = []
+    reader_class = sentence_io.ShardedConllSentenceReader
+    read_shards = reader_class.__dict__['corpus']
+
+    def counting_corpus(reader):
+      reads.append(reader.shards)
+      return read_shards(reader)
+
+    reader_class.corpus = counting_corpus
+    self.addCleanup(setattr, reader_class, 'corpus', read_shards)
+
+    cache_dir = os.path.join(FLAGS.test_tmpdir, 'cache')
+    if tf.gfile.IsDirectory(cache_dir):
+      tf.gfile.DeleteRecursively(cache_dir)
+    corpus = sentence_io.read_corpus(self.filepattern, cache_dir=cache_dir)
+    self.assertEqual(self.expected * 2, corpus)
+    self.assertEqual(1, len(reads))
+    cache_paths = tf.gfile.Glob(os.path.join(cache_dir, '*'))
+    self.assertEqual(1, len(cache_paths))
+
+    # The second read comes from the cache.
+    corpus = sentence_io.read_corpus(self.filepattern, cache_dir=cache_dir)
+    self.assertEqual(self.expected * 2, corpus)
+    self.assertEqual(1, len(reads))
+
+    # A shard newer than the cache is read again, and the cache is updated.
+    shard_mtime = os.stat(os.path.join(self.shard_dir,
+                                       'shard-00000-of-00002')).st_mtime
+    os.utime(cache_paths[0], (shard_mtime - 10, shard_mtime - 10))
+    corpus = sentence_io.read_corpus(self.filepattern, cache_dir=cache_dir)
+    self.assertEqual(self.expected * 2, corpus)
+    self.assertEqual(2, len(reads))
+    corpus = sentence_io.read_corpus(self.filepattern, cache_dir=cache_dir)
+    self.assertEqual(self.expected * 2, corpus)
+    self.assertEqual(2, len(reads))
+
+    # Projectivized corpora are cached separately.
+    sentence_io.read_corpus(self.filepattern, projectivize=True,
+                            cache_dir=cache_dir)
+    self.assertEqual(3, len(reads))
+    self.assertEqual(2, len(tf.gfile.Glob(os.path.join(cache_dir, '*'))))
+
+  def testMissingShards(self):
+    with self.assertRaises(IOError):
+      sentence_io.ShardedConllSentenceReader(
+          os.path.join(self.shard_dir, 'missing-*'))
+
 
 if __name__ == '__main__':
   googletest.main()
@@ -19,14 +19,18 @@ Provides functions to finish a MasterSpec, building required lexicons for it and
 adding them as resources, as well as setting features sizes.
 """
 
+import collections
+from multiprocessing.pool import ThreadPool
 import random
 
-
 import tensorflow as tf
 from tensorflow.core.framework.summary_pb2 import Summary
 from tensorflow.python.framework import errors
 from tensorflow.python.platform import gfile
 
+from dragnn.python import evaluation
+from syntaxnet import sentence_pb2
+
 flags = tf.app.flags
 FLAGS = flags.FLAGS
 
@@ -49,22 +53,126 @@ def write_summary(summary_writer, label, value, step):
   summary_writer.flush()
 
 
-def annotate_dataset(sess, annotator, eval_corpus):
-  """Annotate eval_corpus given a model."""
-  batch_size = min(len(eval_corpus), 1024)
-  processed = []
+def sentence_lengths(corpus):
+  """Returns the number of tokens of each serialized sentence in corpus."""
+  sentence = sentence_pb2.Sentence()
+  lengths = []
+  for serialized_sentence in corpus:
+    sentence.ParseFromString(serialized_sentence)
+    lengths.append(len(sentence.token))
+  return lengths
+
+
+def annotate_batches(sess, annotator, corpus, batch_size=1024,
+                     num_in_flight=2, lengths=None, feed_dict=None,
+                     run_metadata=None):
+  """Annotates corpus in batches of sentences of similar length.
+
+  The sentences are sorted by token count before they are cut into batches,
+  which keeps the padding to the longest sentence of each batch small.  Up to
+  num_in_flight batches are run at once on a thread pool, so the feeds of the
+  next batches are built while the graph runs and batches can use idle cores.
+
+  Args:
+    sess: TF session to use.
+    annotator: Annotation op.
+    corpus: List of serialized sentences to annotate.
+    batch_size: Maximum number of sentences per batch.
+    num_in_flight: Maximum number of batches being annotated at once.
+    lengths: Sort key of each sentence; defaults to its number of tokens.
+    feed_dict: Additional feeds for every batch, e.g. inference beam sizes.
+    run_metadata: If set, the last batch is run with full tracing, and its
+      run metadata is stored here.
+
+  Yields:
+    Pairs of the indices in corpus of the sentences of a batch, and their
+    serialized annotations.
+  """
+  if lengths is None:
+    lengths = sentence_lengths(corpus)
+  assert len(lengths) == len(corpus)
+  order = sorted(range(len(corpus)), key=lengths.__getitem__)
+  batches = [order[start:start + batch_size]
+             for start in range(0, len(order), batch_size)]
+
+  def run_batch(batch_index):
+    indices = batches[batch_index]
+    batch_feed_dict = dict(feed_dict or {})
+    batch_feed_dict[annotator['input_batch']] = [corpus[i] for i in indices]
+    if run_metadata is not None and batch_index == len(batches) - 1:
+      serialized_annotations = sess.run(
+          annotator['annotations'], feed_dict=batch_feed_dict,
+          options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+          run_metadata=run_metadata)
+    else:
+      serialized_annotations = sess.run(
+          annotator['annotations'], feed_dict=batch_feed_dict)
+    assert len(serialized_annotations) == len(indices)
+    return indices, serialized_annotations
+
+  pool = ThreadPool(max(num_in_flight, 1))
+  try:
+    in_flight = collections.deque()
+    for batch_index in range(len(batches)):
+      if len(in_flight) >= num_in_flight:
+        yield in_flight.popleft().get()
+      in_flight.append(pool.apply_async(run_batch, (batch_index,)))
+    while in_flight:
+      yield in_flight.popleft().get()
+  finally:
+    pool.terminate()
+
+
+def annotate_dataset(sess, annotator, eval_corpus, batch_size=1024,
+                     num_in_flight=2, feed_dict=None, run_metadata=None):
+  """Annotate eval_corpus given a model.
+
+  See annotate_batches for the arguments; the annotations are returned in the
+  order of eval_corpus.
+  """
+  processed = [None] * len(eval_corpus)
   tf.logging.info('Annotating datset: %d examples', len(eval_corpus))
-  for start in range(0, len(eval_corpus), batch_size):
-    end = min(start + batch_size, len(eval_corpus))
-    serialized_annotations = sess.run(
-        annotator['annotations'],
-        feed_dict={annotator['input_batch']: eval_corpus[start:end]})
-    assert len(serialized_annotations) == end - start
-    processed.extend(serialized_annotations)
+  for indices, serialized_annotations in annotate_batches(
+      sess, annotator, eval_corpus, batch_size, num_in_flight,
+      feed_dict=feed_dict, run_metadata=run_metadata):
+    for index, serialized_annotation in zip(indices, serialized_annotations):
+      processed[index] = serialized_annotation
   tf.logging.info('Done. Produced %d annotations', len(processed))
   return processed
 
 
+def evaluate_dataset(sess, annotator, evaluator, eval_corpus, eval_gold):
+  """Annotates eval_corpus and streams the annotations into evaluator.
+
+  Each batch is handed to the evaluator as soon as it is annotated, so it is
+  scored by the evaluator's worker processes while the next batch is being
+  annotated, and the annotated corpus is never held in memory as a whole.
+
+  Args:
+    sess: TF session to use.
+    annotator: Annotation op.
+    evaluator: evaluation.StreamingEvaluator to add the annotations to; it is
+      reset first.
+    eval_corpus: Corpus to annotate.
+    eval_gold: Reference of eval_corpus.
+
+  Returns:
+    The evaluator's summaries over the whole corpus.
+  """
+  evaluator.reset()
+  num_annotated = 0
+  tf.logging.info('Evaluating datset: %d examples', len(eval_corpus))
+  for indices, serialized_annotations in annotate_batches(
+      sess, annotator, eval_corpus):
+    evaluator.add_batch([eval_gold[i] for i in indices],
+                        serialized_annotations)
+    num_annotated += len(indices)
+    tf.logging.info('Annotated %d examples, partial eval_metric: %.2f',
+                    num_annotated,
+                    evaluator.summaries(wait=False)['eval_metric'])
+  return evaluator.summaries()
+
+
 def get_summary_writer(tensorboard_dir):
   """Creates a directory for writing summaries and returns a writer."""
   tf.logging.info('TensorBoard directory: %s', tensorboard_dir)
@@ -97,8 +205,9 @@ def run_training(sess, trainers, annotator, evaluator, pretrain_steps,
     trainers: List of training ops to use.
     annotator: Annotation op.
     evaluator: Function taking two serialized corpora and returning a dict of
-      scalar summaries representing evaluation metrics. The 'eval_metric'
-      summary will be used for early stopping.
+      scalar summaries representing evaluation metrics, or an
+      evaluation.StreamingEvaluator to stream the annotations into. The
+      'eval_metric' summary will be used for early stopping.
     pretrain_steps: List of the no. of pre-training steps for each train op.
     train_steps: List of the total no. of steps for each train op.
     train_corpus: Training corpus to use.
@@ -147,8 +256,12 @@ def run_training(sess, trainers, annotator, evaluator, pretrain_steps,
     if step % report_every == 0:
       tf.logging.info('finished step: %d, actual: %d', step, actual_step + step)
 
-      annotated = annotate_dataset(sess, annotator, eval_corpus)
-      summaries = evaluator(eval_gold, annotated)
+      if isinstance(evaluator, evaluation.StreamingEvaluator):
+        summaries = evaluate_dataset(sess, annotator, evaluator, eval_corpus,
+                                     eval_gold)
+      else:
+        annotated = annotate_dataset(sess, annotator, eval_corpus)
+        summaries = evaluator(eval_gold, annotated)
       for label, metric in summaries.iteritems():
         write_summary(summary_writer, label, metric, actual_step + step)
       eval_metric = summaries['eval_metric']
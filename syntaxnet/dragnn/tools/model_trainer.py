@@ -78,6 +78,12 @@ flags.DEFINE_string(
     'train_epochs', None,
     'Comma-delimited list of training epochs per training target.')
 
+flags.DEFINE_bool('cache_corpora', True,
+                  'Whether to cache the serialized corpora in the model '
+                  'directory, so later runs skip reading the CoNLL files.')
+flags.DEFINE_integer('reader_threads', 4,
+                     'Number of corpus shards to read in parallel.')
+
 flags.DEFINE_integer('batch_size', 4, 'Batch size.')
 flags.DEFINE_integer('report_every', 200,
                      'Report cost and training accuracy every this many steps.')
@@ -114,12 +120,17 @@ def main(unused_argv):
   check.Ne(FLAGS.train_steps is None, FLAGS.train_epochs is None,
            'Exactly one of --train_steps or --train_epochs is required')
 
+  # The evaluator forks its worker processes, so start them before any TF
+  # session or summary writer thread exists.
+  evaluator = evaluation.ParserEvaluator()
+
   config_path = os.path.join(FLAGS.model_dir, 'config.txt')
   master_path = os.path.join(FLAGS.model_dir, 'master.pbtxt')
   hyperparameters_path = os.path.join(FLAGS.model_dir, 'hyperparameters.pbtxt')
   targets_path = os.path.join(FLAGS.model_dir, 'targets.pbtxt')
   checkpoint_path = os.path.join(FLAGS.model_dir, 'checkpoints/best')
   tensorboard_dir = os.path.join(FLAGS.model_dir, 'tensorboard')
+  corpus_dir = os.path.join(FLAGS.model_dir, 'corpora')
 
   with tf.gfile.FastGFile(config_path) as config_file:
     config = collections.defaultdict(bool, ast.literal_eval(config_file.read()))
@@ -145,10 +156,13 @@ def main(unused_argv):
     builder.add_saver()
 
   # Read in serialized protos from training data.
-  train_corpus = sentence_io.ConllSentenceReader(
-      train_corpus_path, projectivize=projectivize_train_corpus).corpus()
-  tune_corpus = sentence_io.ConllSentenceReader(
-      tune_corpus_path, projectivize=False).corpus()
+  corpus_cache_dir = corpus_dir if FLAGS.cache_corpora else None
+  train_corpus = sentence_io.read_corpus(
+      train_corpus_path, projectivize=projectivize_train_corpus,
+      cache_dir=corpus_cache_dir, num_threads=FLAGS.reader_threads)
+  tune_corpus = sentence_io.read_corpus(
+      tune_corpus_path, projectivize=False, cache_dir=corpus_cache_dir,
+      num_threads=FLAGS.reader_threads)
   gold_tune_corpus = tune_corpus
 
   # Convert to char-based corpora, if requested.
@@ -181,14 +195,18 @@ def main(unused_argv):
     tf.gfile.Remove(checkpoint_dir)
   tf.gfile.MakeDirs(checkpoint_dir)
 
-  with tf.Session(FLAGS.tf_master, graph=graph) as sess:
-    # Make sure to re-initialize all underlying state.
-    sess.run(tf.global_variables_initializer())
-    trainer_lib.run_training(sess, trainers, annotator,
-                             evaluation.parser_summaries, pretrain_steps,
-                             train_steps, train_corpus, tune_corpus,
-                             gold_tune_corpus, FLAGS.batch_size, summary_writer,
-                             FLAGS.report_every, builder.saver, checkpoint_path)
+  try:
+    with tf.Session(FLAGS.tf_master, graph=graph) as sess:
+      # Make sure to re-initialize all underlying state.
+      sess.run(tf.global_variables_initializer())
+      trainer_lib.run_training(sess, trainers, annotator,
+                               evaluator, pretrain_steps,
+                               train_steps, train_corpus, tune_corpus,
+                               gold_tune_corpus, FLAGS.batch_size,
+                               summary_writer, FLAGS.report_every,
+                               builder.saver, checkpoint_path)
+  finally:
+    evaluator.close()
 
   tf.logging.info('Best checkpoint written to:\n%s', checkpoint_path)
 
@@ -29,6 +29,7 @@ from dragnn.protos import spec_pb2
 from dragnn.python import graph_builder
 from dragnn.python import sentence_io
 from dragnn.python import spec_builder
+from dragnn.python import trainer_lib
 from syntaxnet import sentence_pb2
 from syntaxnet.ops import gen_parser_ops
 from syntaxnet.util import check
@@ -63,6 +64,8 @@ flags.DEFINE_string('inference_beam_size', '', 'Comma separated list of '
                     'component_name=beam_size pairs.')
 flags.DEFINE_string('locally_normalize', '', 'Comma separated list of '
                     'component names to do local normalization on.')
+flags.DEFINE_integer('batches_in_flight', 2, 'Number of batches annotated '
+                     'in parallel; sentences are batched by length.')
 flags.DEFINE_integer('threads', 10, 'Number of threads used for intra- and '
                      'inter-op parallelism.')
 flags.DEFINE_string('timeline_output_file', '', 'Path to save timeline to. '
@@ -72,6 +75,13 @@ flags.DEFINE_bool('use_gold_segmentation', False,
                   'Whether or not to use gold segmentation.')
 
 
+def write_timeline(run_metadata):
+  """Saves the TensorFlow timeline of a traced run to timeline_output_file."""
+  trace = timeline.Timeline(step_stats=run_metadata.step_stats)
+  with open(FLAGS.timeline_output_file, 'w') as trace_file:
+    trace_file.write(trace.generate_chrome_trace_format())
+
+
 def main(unused_argv):
 
   # Parse the flags containint lists, using regular expressions.
@@ -127,24 +137,14 @@ def main(unused_argv):
 
       tf.logging.info('Processing sentences...')
 
-      processed = []
       start_time = time.time()
       run_metadata = tf.RunMetadata()
-      for start in range(0, len(char_corpus), FLAGS.max_batch_size):
-        end = min(start + FLAGS.max_batch_size, len(char_corpus))
-        feed_dict = {annotator['input_batch']: char_corpus[start:end]}
-        if FLAGS.timeline_output_file and end == len(char_corpus):
-          serialized_annotations = sess.run(
-              annotator['annotations'], feed_dict=feed_dict,
-              options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
-              run_metadata=run_metadata)
-          trace = timeline.Timeline(step_stats=run_metadata.step_stats)
-          with open(FLAGS.timeline_output_file, 'w') as trace_file:
-            trace_file.write(trace.generate_chrome_trace_format())
-        else:
-          serialized_annotations = sess.run(
-              annotator['annotations'], feed_dict=feed_dict)
-        processed.extend(serialized_annotations)
+      processed = trainer_lib.annotate_dataset(
+          sess, annotator, char_corpus, FLAGS.max_batch_size,
+          FLAGS.batches_in_flight,
+          run_metadata=run_metadata if FLAGS.timeline_output_file else None)
+      if FLAGS.timeline_output_file:
+        write_timeline(run_metadata)
 
       tf.logging.info('Processed %d documents in %.2f seconds.',
                       len(char_corpus), time.time() - start_time)
@@ -190,28 +190,20 @@ def main(unused_argv):
 
     tf.logging.info('Processing sentences...')
 
-    processed = []
+    feed_dict = {}
+    for comp, beam_size in component_beam_sizes:
+      feed_dict['%s/InferenceBeamSize:0' % comp] = beam_size
+    for comp in components_to_locally_normalize:
+      feed_dict['%s/LocallyNormalize:0' % comp] = True
+
     start_time = time.time()
     run_metadata = tf.RunMetadata()
-    for start in range(0, len(input_corpus), FLAGS.max_batch_size):
-      end = min(start + FLAGS.max_batch_size, len(input_corpus))
-      feed_dict = {annotator['input_batch']: input_corpus[start:end]}
-      for comp, beam_size in component_beam_sizes:
-        feed_dict['%s/InferenceBeamSize:0' % comp] = beam_size
-      for comp in components_to_locally_normalize:
-        feed_dict['%s/LocallyNormalize:0' % comp] = True
-      if FLAGS.timeline_output_file and end == len(input_corpus):
-        serialized_annotations = sess.run(
-            annotator['annotations'], feed_dict=feed_dict,
-            options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
-            run_metadata=run_metadata)
-        trace = timeline.Timeline(step_stats=run_metadata.step_stats)
-        with open(FLAGS.timeline_output_file, 'w') as trace_file:
-          trace_file.write(trace.generate_chrome_trace_format())
-      else:
-        serialized_annotations = sess.run(
-            annotator['annotations'], feed_dict=feed_dict)
-      processed.extend(serialized_annotations)
+    processed = trainer_lib.annotate_dataset(
+        sess, annotator, input_corpus, FLAGS.max_batch_size,
+        FLAGS.batches_in_flight, feed_dict=feed_dict,
+        run_metadata=run_metadata if FLAGS.timeline_output_file else None)
+    if FLAGS.timeline_output_file:
+      write_timeline(run_metadata)
 
     tf.logging.info('Processed %d documents in %.2f seconds.',
                     len(input_corpus), time.time() - start_time)
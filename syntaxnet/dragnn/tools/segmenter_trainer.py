@@ -77,6 +77,10 @@ flags.DEFINE_string('hyperparams',
 def main(unused_argv):
   logging.set_verbosity(logging.INFO)
 
+  # The evaluator forks its worker processes, so start them before any TF
+  # session or summary writer thread exists.
+  evaluator = evaluation.SegmentationEvaluator()
+
   if not gfile.IsDirectory(FLAGS.resource_path):
     gfile.MakeDirs(FLAGS.resource_path)
 
@@ -162,14 +166,17 @@ def main(unused_argv):
   gfile.MakeDirs(os.path.dirname(FLAGS.checkpoint_filename))
   summary_writer = trainer_lib.get_summary_writer(FLAGS.tensorboard_dir)
 
-  with tf.Session(FLAGS.tf_master, graph=graph) as sess:
-    # Make sure to re-initialize all underlying state.
-    sess.run(tf.global_variables_initializer())
-    trainer_lib.run_training(
-        sess, trainers, annotator, evaluation.segmentation_summaries,
-        pretrain_steps, train_steps, char_training_set, char_dev_set, dev_set,
-        FLAGS.batch_size, summary_writer, FLAGS.report_every, builder.saver,
-        FLAGS.checkpoint_filename)
+  try:
+    with tf.Session(FLAGS.tf_master, graph=graph) as sess:
+      # Make sure to re-initialize all underlying state.
+      sess.run(tf.global_variables_initializer())
+      trainer_lib.run_training(
+          sess, trainers, annotator, evaluator,
+          pretrain_steps, train_steps, char_training_set, char_dev_set, dev_set,
+          FLAGS.batch_size, summary_writer, FLAGS.report_every, builder.saver,
+          FLAGS.checkpoint_filename)
+  finally:
+    evaluator.close()
 
 
 if __name__ == '__main__':
@@ -87,6 +87,10 @@ def main(unused_argv):
   check.IsTrue(FLAGS.tensorboard_dir)
   check.IsTrue(FLAGS.resource_path)
 
+  # The evaluator forks its worker processes, so start them before any TF
+  # session or summary writer thread exists.
+  evaluator = evaluation.ParserEvaluator()
+
   if not gfile.IsDirectory(FLAGS.resource_path):
     gfile.MakeDirs(FLAGS.resource_path)
 
@@ -178,26 +182,29 @@ def main(unused_argv):
   tagger_steps = 100000
   train_steps = [tagger_steps, 8 * tagger_steps]
 
-  with tf.Session(FLAGS.tf_master, graph=g) as sess:
-    # Make sure to re-initialize all underlying state.
-    sess.run(tf.global_variables_initializer())
-
-    if do_restore:
-      tf.logging.info('Restoring from checkpoint...')
-      builder.saver.restore(sess, FLAGS.checkpoint_filename)
-
-      prev_tagger_steps = stats[1]
-      prev_parser_steps = stats[2]
-      tf.logging.info('adjusting schedule from steps: %d, %d',
-                      prev_tagger_steps, prev_parser_steps)
-      pretrain_steps[0] = max(pretrain_steps[0] - prev_tagger_steps, 0)
-      tf.logging.info('new pretrain steps: %d', pretrain_steps[0])
-
-    trainer_lib.run_training(
-        sess, trainers, annotator, evaluation.parser_summaries, pretrain_steps,
-        train_steps, training_set, tune_set, tune_set, FLAGS.batch_size,
-        summary_writer, FLAGS.report_every, builder.saver,
-        FLAGS.checkpoint_filename, stats)
+  try:
+    with tf.Session(FLAGS.tf_master, graph=g) as sess:
+      # Make sure to re-initialize all underlying state.
+      sess.run(tf.global_variables_initializer())
+
+      if do_restore:
+        tf.logging.info('Restoring from checkpoint...')
+        builder.saver.restore(sess, FLAGS.checkpoint_filename)
+
+        prev_tagger_steps = stats[1]
+        prev_parser_steps = stats[2]
+        tf.logging.info('adjusting schedule from steps: %d, %d',
+                        prev_tagger_steps, prev_parser_steps)
+        pretrain_steps[0] = max(pretrain_steps[0] - prev_tagger_steps, 0)
+        tf.logging.info('new pretrain steps: %d', pretrain_steps[0])
+
+      trainer_lib.run_training(
+          sess, trainers, annotator, evaluator, pretrain_steps,
+          train_steps, training_set, tune_set, tune_set, FLAGS.batch_size,
+          summary_writer, FLAGS.report_every, builder.saver,
+          FLAGS.checkpoint_filename, stats)
+  finally:
+    evaluator.close()
 
 
 if __name__ == '__main__':
@@ -16,7 +16,9 @@
 """Batch reader to seq2seq attention model, with bucketing support."""
 
 from collections import namedtuple
+import multiprocessing
 from random import shuffle
+from threading import Lock
 from threading import Thread
 import time
 
@@ -33,6 +35,151 @@ ModelInput = namedtuple('ModelInput',
 
 BUCKET_CACHE_BATCH = 100
 QUEUE_NUM_BATCH = 100
+# Number of shared-memory blocks per input process.
+BLOCKS_PER_PROCESS = 2
+
+
+def _ConvertExample(article, abstract, vocab, hps, max_article_sentences,
+                    max_abstract_sentences, truncate_input):
+  """Converts the text of an example to unpadded word ids.
+
+  Args:
+    article: article text.
+    abstract: abstract text.
+    vocab: Vocabulary.
+    hps: Seq2SeqAttention model hyperparameters.
+    max_article_sentences: Max number of sentences used from article.
+    max_abstract_sentences: Max number of sentences used from abstract.
+    truncate_input: Whether to truncate input that is too long.
+
+  Returns:
+    (enc_inputs, dec_inputs, targets, article, abstract) with the article and
+    abstract sentences joined, or None if the example is dropped.
+  """
+  start_id = vocab.WordToId(data.SENTENCE_START)
+  end_id = vocab.WordToId(data.SENTENCE_END)
+  article_sentences = [sent.strip() for sent in
+                       data.ToSentences(article, include_token=False)]
+  abstract_sentences = [sent.strip() for sent in
+                        data.ToSentences(abstract, include_token=False)]
+
+  enc_inputs = []
+  # Use the <s> as the <GO> symbol for decoder inputs.
+  dec_inputs = [start_id]
+
+  # Convert first N sentences to word IDs, stripping existing <s> and </s>.
+  for i in xrange(min(max_article_sentences, len(article_sentences))):
+    enc_inputs += data.GetWordIds(article_sentences[i], vocab)
+  for i in xrange(min(max_abstract_sentences, len(abstract_sentences))):
+    dec_inputs += data.GetWordIds(abstract_sentences[i], vocab)
+
+  # Filter out too-short input
+  if (len(enc_inputs) < hps.min_input_len or
+      len(dec_inputs) < hps.min_input_len):
+    tf.logging.warning('Drop an example - too short.\nenc:%d\ndec:%d',
+                       len(enc_inputs), len(dec_inputs))
+    return None
+
+  # If we're not truncating input, throw out too-long input
+  if not truncate_input:
+    if (len(enc_inputs) > hps.enc_timesteps or
+        len(dec_inputs) > hps.dec_timesteps):
+      tf.logging.warning('Drop an example - too long.\nenc:%d\ndec:%d',
+                         len(enc_inputs), len(dec_inputs))
+      return None
+  # If we are truncating input, do so if necessary
+  else:
+    if len(enc_inputs) > hps.enc_timesteps:
+      enc_inputs = enc_inputs[:hps.enc_timesteps]
+    if len(dec_inputs) > hps.dec_timesteps:
+      dec_inputs = dec_inputs[:hps.dec_timesteps]
+
+  # targets is dec_inputs without <s> at beginning, plus </s> at end
+  targets = dec_inputs[1:]
+  targets.append(end_id)
+
+  # Now len(enc_inputs) should be <= enc_timesteps, and
+  # len(targets) = len(dec_inputs) should be <= dec_timesteps
+  return (enc_inputs, dec_inputs, targets, ' '.join(article_sentences),
+          ' '.join(abstract_sentences))
+
+
+def _BlockArrays(block, block_size, hps):
+  """Returns int32 views of a shared-memory block of padded examples.
+
+  Args:
+    block: multiprocessing.RawArray holding the block.
+    block_size: Number of examples in the block.
+    hps: Seq2SeqAttention model hyperparameters.
+
+  Returns:
+    (enc_inputs, dec_inputs, targets, enc_lens, dec_lens) arrays of shapes
+    [block_size, enc_timesteps], [block_size, dec_timesteps] twice, and
+    [block_size] twice.
+  """
+  shapes = [(block_size, hps.enc_timesteps), (block_size, hps.dec_timesteps),
+            (block_size, hps.dec_timesteps), (block_size,), (block_size,)]
+  flat = np.frombuffer(block, dtype=np.int32)
+  arrays = []
+  offset = 0
+  for shape in shapes:
+    size = int(np.prod(shape))
+    arrays.append(flat[offset:offset + size].reshape(shape))
+    offset += size
+  return arrays
+
+
+def _FillSharedBlocks(data_path, shard_index, num_shards, vocab, hps,
+                      article_key, abstract_key, max_article_sentences,
+                      max_abstract_sentences, truncate_input, blocks,
+                      block_size, free_blocks, full_blocks):
+  """Input process: fills free shared-memory blocks with padded examples.
+
+  Reads its shard of the data files, and for each filled block puts
+  (block index, articles, abstracts, secs waited for a free block) on
+  full_blocks.
+  """
+  end_id = vocab.WordToId(data.SENTENCE_END)
+  pad_id = vocab.WordToId(data.PAD_TOKEN)
+  example_gen = data.ExampleGen(
+      data_path, shard_index=shard_index, num_shards=num_shards)
+  while True:
+    wait_start = time.time()
+    index = free_blocks.get()
+    wait_secs = time.time() - wait_start
+
+    enc_batch, dec_batch, target_batch, enc_lens, dec_lens = _BlockArrays(
+        blocks[index], block_size, hps)
+    enc_batch.fill(pad_id)
+    dec_batch.fill(end_id)
+    target_batch.fill(end_id)
+    articles, abstracts = [], []
+    while len(articles) < block_size:
+      e = next(example_gen)
+      try:
+        article_text = data.GetExFeatureText(e, article_key)
+        abstract_text = data.GetExFeatureText(e, abstract_key)
+      except ValueError:
+        tf.logging.error('Failed to get article or abstract from example')
+        continue
+
+      example = _ConvertExample(article_text, abstract_text, vocab, hps,
+                                max_article_sentences, max_abstract_sentences,
+                                truncate_input)
+      if example is None:
+        continue
+
+      enc_inputs, dec_inputs, targets, article, abstract = example
+      i = len(articles)
+      enc_batch[i, :len(enc_inputs)] = enc_inputs
+      dec_batch[i, :len(dec_inputs)] = dec_inputs
+      target_batch[i, :len(targets)] = targets
+      enc_lens[i] = len(enc_inputs)
+      dec_lens[i] = len(targets)
+      articles.append(article)
+      abstracts.append(abstract)
+
+    full_blocks.put((index, articles, abstracts, wait_secs))
 
 
 class Batcher(object):
@@ -40,7 +187,8 @@ class Batcher(object):
 
   def __init__(self, data_path, vocab, hps,
                article_key, abstract_key, max_article_sentences,
-               max_abstract_sentences, bucketing=True, truncate_input=False):
+               max_abstract_sentences, bucketing=True, truncate_input=False,
+               num_processes=0):
     """Batcher constructor.
 
     Args:
@@ -54,6 +202,10 @@ class Batcher(object):
       bucketing: Whether bucket articles of similar length into the same batch.
       truncate_input: Whether to truncate input that is too long. Alternative is
         to discard such examples.
+      num_processes: If > 0, examples are read and padded by this many
+        processes, each reading its own subset of the data files, and handed
+        over as int32 blocks in shared memory. Otherwise Python threads are
+        used.
     """
     self._data_path = data_path
     self._vocab = vocab
@@ -64,16 +216,27 @@ class Batcher(object):
     self._max_abstract_sentences = max_abstract_sentences
     self._bucketing = bucketing
     self._truncate_input = truncate_input
+    self._num_processes = min(num_processes, len(tf.gfile.Glob(data_path)))
     self._input_queue = Queue.Queue(QUEUE_NUM_BATCH * self._hps.batch_size)
     self._bucket_input_queue = Queue.Queue(QUEUE_NUM_BATCH)
+    self._stats_lock = Lock()
+    self._producer_wait_secs = 0.0
+    self._consumer_wait_secs = 0.0
+
     self._input_threads = []
-    for _ in xrange(16):
-      self._input_threads.append(Thread(target=self._FillInputQueue))
-      self._input_threads[-1].daemon = True
-      self._input_threads[-1].start()
+    self._input_processes = []
+    if self._num_processes > 0:
+      self._StartInputProcesses()
+      fill_bucket_input_queue = self._FillBucketInputQueueFromBlocks
+    else:
+      for _ in xrange(16):
+        self._input_threads.append(Thread(target=self._FillInputQueue))
+        self._input_threads[-1].daemon = True
+        self._input_threads[-1].start()
+      fill_bucket_input_queue = self._FillBucketInputQueue
     self._bucketing_threads = []
     for _ in xrange(4):
-      self._bucketing_threads.append(Thread(target=self._FillBucketInputQueue))
+      self._bucketing_threads.append(Thread(target=fill_bucket_input_queue))
       self._bucketing_threads[-1].daemon = True
       self._bucketing_threads[-1].start()
 
@@ -94,6 +257,14 @@ class Batcher(object):
       origin_articles: original article words.
       origin_abstracts: original abstract words.
     """
+    wait_start = time.time()
+    buckets = self._bucket_input_queue.get()
+    with self._stats_lock:
+      self._consumer_wait_secs += time.time() - wait_start
+
+    if self._num_processes > 0:
+      return self._GatherBatch(*buckets)
+
     enc_batch = np.zeros(
         (self._hps.batch_size, self._hps.enc_timesteps), dtype=np.int32)
     enc_input_lens = np.zeros(
@@ -109,7 +280,6 @@ class Batcher(object):
     origin_articles = ['None'] * self._hps.batch_size
     origin_abstracts = ['None'] * self._hps.batch_size
 
-    buckets = self._bucket_input_queue.get()
     for i in xrange(self._hps.batch_size):
       (enc_inputs, dec_inputs, targets, enc_input_len, dec_output_len,
        article, abstract) = buckets[i]
@@ -121,79 +291,108 @@ class Batcher(object):
       enc_batch[i, :] = enc_inputs[:]
       dec_batch[i, :] = dec_inputs[:]
       target_batch[i, :] = targets[:]
-      for j in xrange(dec_output_len):
-        loss_weights[i][j] = 1
+      loss_weights[i, :dec_output_len] = 1
     return (enc_batch, dec_batch, target_batch, enc_input_lens, dec_output_lens,
             loss_weights, origin_articles, origin_abstracts)
 
+  def _GatherBatch(self, block, rows, articles, abstracts):
+    """Gathers a batch from a block of padded examples.
+
+    Args:
+      block: (enc_inputs, dec_inputs, targets, enc_lens, dec_lens) arrays of a
+        block, as returned by _BlockArrays.
+      rows: Indices of the batch's examples in the block.
+      articles: Original article words of the block.
+      abstracts: Original abstract words of the block.
+
+    Returns:
+      The same tuple as NextBatch.
+    """
+    enc_batch, dec_batch, target_batch, enc_lens, dec_lens = [
+        array[rows] for array in block]
+    loss_weights = (np.arange(self._hps.dec_timesteps) <
+                    dec_lens[:, None]).astype(np.float32)
+    return (enc_batch, dec_batch, target_batch, enc_lens, dec_lens,
+            loss_weights, [articles[i] for i in rows],
+            [abstracts[i] for i in rows])
+
+  def Stats(self):
+    """Returns input pipeline statistics.
+
+    Returns:
+      A dict with the current depths of the input queues, the total time the
+      producers (input threads or processes) have waited for queue space, and
+      the total time NextBatch has waited for a batch, in seconds.
+    """
+    with self._stats_lock:
+      stats = {
+          'bucket_queue_depth': self._bucket_input_queue.qsize(),
+          'producer_wait_secs': self._producer_wait_secs,
+          'consumer_wait_secs': self._consumer_wait_secs,
+      }
+    if self._num_processes > 0:
+      stats['block_queue_depth'] = self._full_blocks.qsize()
+    else:
+      stats['input_queue_depth'] = self._input_queue.qsize()
+    return stats
+
   def _FillInputQueue(self):
     """Fill input queue with ModelInput."""
-    start_id = self._vocab.WordToId(data.SENTENCE_START)
     end_id = self._vocab.WordToId(data.SENTENCE_END)
     pad_id = self._vocab.WordToId(data.PAD_TOKEN)
     input_gen = self._TextGenerator(data.ExampleGen(self._data_path))
     while True:
       (article, abstract) = input_gen.next()
-      article_sentences = [sent.strip() for sent in
-                           data.ToSentences(article, include_token=False)]
-      abstract_sentences = [sent.strip() for sent in
-                            data.ToSentences(abstract, include_token=False)]
-
-      enc_inputs = []
-      # Use the <s> as the <GO> symbol for decoder inputs.
-      dec_inputs = [start_id]
-
-      # Convert first N sentences to word IDs, stripping existing <s> and </s>.
-      for i in xrange(min(self._max_article_sentences,
-                          len(article_sentences))):
-        enc_inputs += data.GetWordIds(article_sentences[i], self._vocab)
-      for i in xrange(min(self._max_abstract_sentences,
-                          len(abstract_sentences))):
-        dec_inputs += data.GetWordIds(abstract_sentences[i], self._vocab)
-
-      # Filter out too-short input
-      if (len(enc_inputs) < self._hps.min_input_len or
-          len(dec_inputs) < self._hps.min_input_len):
-        tf.logging.warning('Drop an example - too short.\nenc:%d\ndec:%d',
-                           len(enc_inputs), len(dec_inputs))
+      example = _ConvertExample(
+          article, abstract, self._vocab, self._hps,
+          self._max_article_sentences, self._max_abstract_sentences,
+          self._truncate_input)
+      if example is None:
         continue
-
-      # If we're not truncating input, throw out too-long input
-      if not self._truncate_input:
-        if (len(enc_inputs) > self._hps.enc_timesteps or
-            len(dec_inputs) > self._hps.dec_timesteps):
-          tf.logging.warning('Drop an example - too long.\nenc:%d\ndec:%d',
-                             len(enc_inputs), len(dec_inputs))
-          continue
-      # If we are truncating input, do so if necessary
-      else:
-        if len(enc_inputs) > self._hps.enc_timesteps:
-          enc_inputs = enc_inputs[:self._hps.enc_timesteps]
-        if len(dec_inputs) > self._hps.dec_timesteps:
-          dec_inputs = dec_inputs[:self._hps.dec_timesteps]
-
-      # targets is dec_inputs without <s> at beginning, plus </s> at end
-      targets = dec_inputs[1:]
-      targets.append(end_id)
-
-      # Now len(enc_inputs) should be <= enc_timesteps, and
-      # len(targets) = len(dec_inputs) should be <= dec_timesteps
+      enc_inputs, dec_inputs, targets, article, abstract = example
 
       enc_input_len = len(enc_inputs)
       dec_output_len = len(targets)
 
       # Pad if necessary
-      while len(enc_inputs) < self._hps.enc_timesteps:
-        enc_inputs.append(pad_id)
-      while len(dec_inputs) < self._hps.dec_timesteps:
-        dec_inputs.append(end_id)
-      while len(targets) < self._hps.dec_timesteps:
-        targets.append(end_id)
+      enc_inputs += [pad_id] * (self._hps.enc_timesteps - len(enc_inputs))
+      dec_inputs += [end_id] * (self._hps.dec_timesteps - len(dec_inputs))
+      targets += [end_id] * (self._hps.dec_timesteps - len(targets))
 
       element = ModelInput(enc_inputs, dec_inputs, targets, enc_input_len,
-                           dec_output_len, ' '.join(article_sentences),
-                           ' '.join(abstract_sentences))
+                           dec_output_len, article, abstract)
+      wait_start = time.time()
       self._input_queue.put(element)
+      with self._stats_lock:
+        self._producer_wait_secs += time.time() - wait_start
+
+  def _StartInputProcesses(self):
+    """Starts the input processes and the shared-memory blocks they fill."""
+    self._block_size = self._hps.batch_size * BUCKET_CACHE_BATCH
+    block_ints = self._block_size * (
+        self._hps.enc_timesteps + 2 * self._hps.dec_timesteps + 2)
+    num_blocks = BLOCKS_PER_PROCESS * self._num_processes
+    self._blocks = [multiprocessing.RawArray('i', block_ints)
+                    for _ in xrange(num_blocks)]
+    self._free_blocks = multiprocessing.Queue()
+    self._full_blocks = multiprocessing.Queue()
+    for index in xrange(num_blocks):
+      self._free_blocks.put(index)
+    for shard_index in xrange(self._num_processes):
+      self._input_processes.append(self._StartInputProcess(shard_index))
+
+  def _StartInputProcess(self, shard_index):
+    """Starts the input process that reads the given shard of the data."""
+    process = multiprocessing.Process(
+        target=_FillSharedBlocks,
+        args=(self._data_path, shard_index, self._num_processes, self._vocab,
+              self._hps, self._article_key, self._abstract_key,
+              self._max_article_sentences, self._max_abstract_sentences,
+              self._truncate_input, self._blocks, self._block_size,
+              self._free_blocks, self._full_blocks))
+    process.daemon = True
+    process.start()
+    return process
 
   def _FillBucketInputQueue(self):
     """Fill bucketed batches into the bucket_input_queue."""
@@ -211,6 +410,30 @@ class Batcher(object):
       for b in batches:
         self._bucket_input_queue.put(b)
 
+  def _FillBucketInputQueueFromBlocks(self):
+    """Fill bucketed batches of blocks filled by the input processes."""
+    while True:
+      index, articles, abstracts, wait_secs = self._full_blocks.get()
+      with self._stats_lock:
+        self._producer_wait_secs += wait_secs
+
+      # Copy the block out of shared memory so that it can be refilled.
+      block = [array.copy() for array in _BlockArrays(
+          self._blocks[index], self._block_size, self._hps)]
+      self._free_blocks.put(index)
+
+      if self._bucketing:
+        rows = np.argsort(block[3], kind='mergesort')
+      else:
+        rows = np.arange(self._block_size)
+
+      batches = []
+      for i in xrange(0, self._block_size, self._hps.batch_size):
+        batches.append(rows[i:i+self._hps.batch_size])
+      shuffle(batches)
+      for b in batches:
+        self._bucket_input_queue.put((block, b, articles, abstracts))
+
   def _WatchThreads(self):
     """Watch the daemon input threads and restart if dead."""
     while True:
@@ -227,13 +450,25 @@ class Batcher(object):
           input_threads[-1].start()
       self._input_threads = input_threads
 
+      input_processes = []
+      for shard_index, p in enumerate(self._input_processes):
+        if p.is_alive():
+          input_processes.append(p)
+        else:
+          tf.logging.error('Found input process dead.')
+          input_processes.append(self._StartInputProcess(shard_index))
+      self._input_processes = input_processes
+
       bucketing_threads = []
       for t in self._bucketing_threads:
         if t.is_alive():
           bucketing_threads.append(t)
         else:
           tf.logging.error('Found bucketing thread dead.')
-          new_t = Thread(target=self._FillBucketInputQueue)
+          if self._num_processes > 0:
+            new_t = Thread(target=self._FillBucketInputQueueFromBlocks)
+          else:
+            new_t = Thread(target=self._FillBucketInputQueue)
           bucketing_threads.append(new_t)
           bucketing_threads[-1].daemon = True
           bucketing_threads[-1].start()
@@ -21,6 +21,7 @@ K*K results, and start over again until certain number of results are fully
 decoded.
 """
 
+import numpy as np
 from six.moves import xrange
 import tensorflow as tf
 
@@ -154,3 +155,127 @@ class BeamSearch(object):
       return sorted(hyps, key=lambda h: h.log_prob/len(h.tokens), reverse=True)
     else:
       return sorted(hyps, key=lambda h: h.log_prob, reverse=True)
+
+
+class BatchBeamSearch(BeamSearch):
+  """Beam search over a batch of articles at once.
+
+  Performs the same search as BeamSearch for every article, but the hypotheses
+  of batch_size / beam_size articles are kept in arrays of shape
+  [num_articles, beam_size, ...] and extended by a single decode_topk call per
+  step. The model must be built with batch_size = num_articles * beam_size.
+  """
+
+  def BeamSearch(self, sess, enc_inputs, enc_seqlen):
+    """Performs beam search for decoding a batch of articles.
+
+    Args:
+      sess: tf.Session, session
+      enc_inputs: ndarray of shape (batch_size, enc_length), one article per row
+      enc_seqlen: ndarray of shape (batch_size), the lengths of the articles
+
+    Returns:
+      results: list with, for each article, the list of best Hypothesis found by
+          beam search, ordered by score
+    """
+    # Run the encoder once for all articles, then search groups of
+    # batch_size / beam_size articles, with each article on beam_size rows.
+    enc_top_states, dec_in_states = self._model.encode_batch(
+        sess, enc_inputs, enc_seqlen)
+    batch_size = len(enc_inputs)
+    num_articles = batch_size // self._beam_size
+
+    results = []
+    for start in xrange(0, batch_size, num_articles):
+      group = np.arange(start, start + num_articles) % batch_size
+      group_results = self._SearchGroup(
+          sess,
+          np.repeat(enc_top_states[group], self._beam_size, axis=0),
+          np.repeat(dec_in_states[group], self._beam_size, axis=0))
+      results.extend(group_results[:batch_size - start])
+
+    return results
+
+  def _SearchGroup(self, sess, enc_top_states, dec_in_states):
+    """Beam searches a group of articles, each replicated on beam_size rows.
+
+    Args:
+      sess: tf.Session, session
+      enc_top_states: ndarray of shape (batch_size, enc_length, state_size)
+      dec_in_states: ndarray of shape (batch_size, dec_state_size)
+
+    Returns:
+      results: list with the sorted best Hypothesis list of each article.
+    """
+    k = self._beam_size
+    num_articles = len(dec_in_states) // k
+
+    tokens = np.full([num_articles, k, 1], self._start_token, dtype=np.int64)
+    log_probs = np.zeros([num_articles, k])
+    states = dec_in_states
+    results = [[] for _ in xrange(num_articles)]
+    done = np.zeros([num_articles], dtype=bool)
+    article_index = np.arange(num_articles)[:, None]
+
+    steps = 0
+    while steps < self._max_steps and not done.all():
+      topk_ids, topk_log_probs, new_states = self._model.decode_topk(
+          sess, tokens[:, :, -1].reshape(-1), enc_top_states, states)
+      new_states = np.asarray(new_states)
+
+      # The first step takes the best K results from first hyps. Following
+      # steps take the best K results from K*K hyps.
+      num_beam_source = 1 if steps == 0 else k
+      cand_ids = topk_ids[:, :2 * k].reshape(
+          num_articles, k, 2 * k)[:, :num_beam_source].reshape(num_articles, -1)
+      cand_log_probs = (
+          log_probs[:, :num_beam_source, None] +
+          topk_log_probs[:, :2 * k].reshape(
+              num_articles, k, 2 * k)[:, :num_beam_source]).reshape(
+                  num_articles, -1)
+
+      # All candidates have the same length, so _BestHyps reduces to a stable
+      # sort by log prob.
+      order = np.argsort(-cand_log_probs, axis=1, kind='mergesort')
+      cand_ids = cand_ids[article_index, order]
+      cand_log_probs = cand_log_probs[article_index, order]
+      cand_sources = order // (2 * k)
+      ended = cand_ids == self._end_token
+
+      # Walk the sorted candidates until K hypotheses continue or K results
+      # are complete, as BeamSearch does.
+      num_results = np.array([len(r) for r in results])
+      stop = ((np.cumsum(~ended, axis=1) >= k) |
+              (np.cumsum(ended, axis=1) + num_results[:, None] >= k))
+      taken = (np.cumsum(stop, axis=1) - stop) == 0
+      taken &= ~done[:, None]
+
+      for i, c in zip(*np.nonzero(taken & ended)):
+        source = cand_sources[i, c]
+        results[i].append(Hypothesis(
+            tokens[i, source].tolist() + [cand_ids[i, c]],
+            cand_log_probs[i, c], new_states[i * k + source]))
+
+      # Extend the K best continuing hypotheses of each article.
+      extended = taken & ~ended
+      best = np.argsort(~extended, axis=1, kind='mergesort')[:, :k]
+      best_sources = cand_sources[article_index, best]
+      tokens = np.concatenate(
+          [tokens[article_index, best_sources],
+           cand_ids[article_index, best][:, :, None]], axis=2)
+      log_probs = cand_log_probs[article_index, best]
+      states = new_states[(article_index * k + best_sources).reshape(-1)]
+
+      steps += 1
+      if steps == self._max_steps:
+        for i in np.flatnonzero(~done):
+          num_hyps = min(k, np.count_nonzero(extended[i]))
+          results[i].extend(
+              Hypothesis(tokens[i, j].tolist(), log_probs[i, j],
+                         states[i * k + j]) for j in xrange(num_hyps))
+
+      # Finished articles are retired; their rows are still fed to the
+      # fixed-size graph but are no longer extended.
+      done |= np.array([len(r) >= k for r in results])
+
+    return [self._BestHyps(r) for r in results]
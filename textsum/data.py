@@ -75,7 +75,7 @@ class Vocab(object):
     return self._count
 
 
-def ExampleGen(data_path, num_epochs=None):
+def ExampleGen(data_path, num_epochs=None, shard_index=0, num_shards=1):
   """Generates tf.Examples from path of data files.
 
     Binary data format: <length><blob>. <length> represents the byte size
@@ -85,6 +85,8 @@ def ExampleGen(data_path, num_epochs=None):
   Args:
     data_path: path to tf.Example data files.
     num_epochs: Number of times to go through the data. None means infinite.
+    shard_index: Index of the subset of the files to read.
+    num_shards: Number of disjoint subsets to split the files into.
 
   Yields:
     Deserialized tf.Example.
@@ -95,7 +97,7 @@ def ExampleGen(data_path, num_epochs=None):
   while True:
     if num_epochs is not None and epoch >= num_epochs:
       break
-    filelist = glob.glob(data_path)
+    filelist = sorted(glob.glob(data_path))[shard_index::num_shards]
     assert filelist, 'Empty filelist.'
     random.shuffle(filelist)
     for f in filelist:
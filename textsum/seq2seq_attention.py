@@ -63,6 +63,9 @@ tf.app.flags.DEFINE_bool('truncate_input', False,
                          'examples that are too long are discarded.')
 tf.app.flags.DEFINE_integer('num_gpus', 0, 'Number of gpus used.')
 tf.app.flags.DEFINE_integer('random_seed', 111, 'A seed value for randomness.')
+tf.app.flags.DEFINE_integer('input_processes', 0,
+                            'If > 0, number of processes that read and pad '
+                            'input examples, instead of threads.')
 
 
 def _RunningAvgLoss(loss, running_avg_loss, summary_writer, step, decay=0.999):
@@ -110,6 +113,10 @@ def _Train(model, data_batcher):
           running_avg_loss, loss, summary_writer, train_step)
       step += 1
       if step % 100 == 0:
+        stats_sum = tf.Summary()
+        for name, value in sorted(data_batcher.Stats().items()):
+          stats_sum.value.add(tag='input/' + name, simple_value=value)
+        summary_writer.add_summary(stats_sum, train_step)
         summary_writer.flush()
     sv.Stop()
     return running_avg_loss
@@ -167,7 +174,7 @@ def main(unused_argv):
 
   batch_size = 4
   if FLAGS.mode == 'decode':
-    batch_size = FLAGS.beam_size
+    batch_size = FLAGS.beam_size * max(1, FLAGS.decode_batch_articles)
 
   hps = seq2seq_attention_model.HParams(
       mode=FLAGS.mode,  # train, eval, decode
@@ -187,7 +194,8 @@ def main(unused_argv):
       FLAGS.data_path, vocab, hps, FLAGS.article_key,
       FLAGS.abstract_key, FLAGS.max_article_sentences,
       FLAGS.max_abstract_sentences, bucketing=FLAGS.use_bucketing,
-      truncate_input=FLAGS.truncate_input)
+      truncate_input=FLAGS.truncate_input,
+      num_processes=FLAGS.input_processes)
   tf.set_random_seed(FLAGS.random_seed)
 
   if hps.mode == 'train':
@@ -29,6 +29,10 @@ tf.app.flags.DEFINE_integer('max_decode_steps', 1000000,
 tf.app.flags.DEFINE_integer('decode_batches_per_ckpt', 8000,
                             'Number of batches to decode before restoring next '
                             'checkpoint')
+tf.app.flags.DEFINE_integer('decode_batch_articles', 0,
+                            'If > 0, the number of articles that are beam '
+                            'searched together; the decode graph then has '
+                            'beam_size rows per article.')
 
 DECODE_LOOP_DELAY_SECS = 60
 DECODE_IO_FLUSH_INTERVAL = 100
@@ -92,6 +96,8 @@ class BSDecoder(object):
     self._vocab = vocab
     self._saver = tf.train.Saver()
     self._decode_io = DecodeIO(FLAGS.decode_dir)
+    self._decoded_articles = 0
+    self._decode_secs = 0.0
 
   def DecodeLoop(self):
     """Decoding loop for long running process."""
@@ -127,6 +133,11 @@ class BSDecoder(object):
     for _ in xrange(FLAGS.decode_batches_per_ckpt):
       (article_batch, _, _, article_lens, _, _, origin_articles,
        origin_abstracts) = self._batch_reader.NextBatch()
+      if FLAGS.decode_batch_articles > 0:
+        self._DecodeParallel(sess, article_batch, article_lens,
+                             origin_articles, origin_abstracts)
+        continue
+
       for i in xrange(self._hps.batch_size):
         bs = beam_search.BeamSearch(
             self._model, self._hps.batch_size,
@@ -144,6 +155,39 @@ class BSDecoder(object):
             origin_articles[i], origin_abstracts[i], decode_output)
     return True
 
+  def _DecodeParallel(self, sess, article_batch, article_lens,
+                      origin_articles, origin_abstracts):
+    """Beam search decodes all articles of a batch together.
+
+    Args:
+      sess: Tensorflow session.
+      article_batch: The article ids of shape [batch_size, enc_timesteps].
+      article_lens: The article lengths of shape [batch_size].
+      origin_articles: The original article strings.
+      origin_abstracts: The human (correct) abstract strings.
+    """
+    start_time = time.time()
+    bs = beam_search.BatchBeamSearch(
+        self._model, self._hps.batch_size // FLAGS.decode_batch_articles,
+        self._vocab.WordToId(data.SENTENCE_START),
+        self._vocab.WordToId(data.SENTENCE_END),
+        self._hps.dec_timesteps)
+    best_beams = [hyps[0] for hyps in bs.BeamSearch(
+        sess, article_batch, article_lens)]
+    elapsed = time.time() - start_time
+
+    self._decoded_articles += len(best_beams)
+    self._decode_secs += elapsed
+    tf.logging.info('decoded %d articles in %.3f secs: %.2f articles/sec '
+                    '(%.2f articles/sec overall)', len(best_beams), elapsed,
+                    len(best_beams) / elapsed,
+                    self._decoded_articles / self._decode_secs)
+
+    for i, best_beam in enumerate(best_beams):
+      decode_output = [int(t) for t in best_beam.tokens[1:]]
+      self._DecodeBatch(
+          origin_articles[i], origin_abstracts[i], decode_output)
+
   def _DecodeBatch(self, article, abstract, output_ids):
     """Convert id to words and writing results.
 
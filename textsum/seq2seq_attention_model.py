@@ -273,6 +273,24 @@ class Seq2SeqAttentionModel(object):
                                   self._article_lens: enc_len})
     return results[0], results[1][0]
 
+  def encode_batch(self, sess, enc_inputs, enc_len):
+    """Return the top encoder states and decoder initial states of a batch.
+
+    Unlike encode_top_state, which assumes that every row holds the same
+    article, this returns the decoder initial state of each row.
+
+    Args:
+      sess: tensorflow session.
+      enc_inputs: encoder inputs of shape [batch_size, enc_timesteps].
+      enc_len: encoder input length of shape [batch_size]
+    Returns:
+      enc_top_states: The top level encoder states.
+      dec_in_states: The decoder layer initial states, one per row.
+    """
+    return sess.run([self._enc_top_states, self._dec_in_state],
+                    feed_dict={self._articles: enc_inputs,
+                               self._article_lens: enc_len})
+
   def decode_topk(self, sess, latest_tokens, enc_top_states, dec_init_states):
     """Return the topK results and new decoder states."""
     feed = {
@@ -74,6 +74,9 @@ flags.DEFINE_string("data_path", None,
                     "Where the training/test data is stored.")
 flags.DEFINE_string("save_path", None,
                     "Model output directory.")
+flags.DEFINE_string("cache_path", None,
+                    "Local directory where the vocabulary and word ids are "
+                    "cached, so that later runs do not parse the data.")
 flags.DEFINE_bool("use_fp16", False,
                   "Train using 16-bit floats instead of 32bit floats")
 
@@ -329,7 +332,7 @@ def main(_):
   if not FLAGS.data_path:
     raise ValueError("Must set --data_path to PTB data directory")
 
-  raw_data = reader.ptb_raw_data(FLAGS.data_path)
+  raw_data = reader.ptb_raw_data(FLAGS.data_path, FLAGS.cache_path)
   train_data, valid_data, test_data, _ = raw_data
 
   config = get_config()
@@ -20,20 +20,49 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import hashlib
 import os
 
+import numpy as np
 import tensorflow as tf
 
+# Number of words that the text files are read in at a time.
+_CHUNK_WORDS = 1 << 20
 
-def _read_words(filename):
+
+def _read_word_chunks(filename, chunk_words=_CHUNK_WORDS):
+  """Yields the words of a file in lists of about chunk_words words.
+
+  Newlines are replaced by "<eos>" and the text is split on whitespace, as
+  if the whole file was read at once, but only a chunk of lines is in memory.
+  """
   with tf.gfile.GFile(filename, "r") as f:
-    return f.read().decode("utf-8").replace("\n", "<eos>").split()
+    words = []
+    partial = ""
+    for line in f:
+      text = partial + tf.compat.as_text(line).replace("\n", "<eos>")
+      words.extend(text.split())
+      partial = ""
+      # The last word continues on the next line if there is no space.
+      if words and text and not text[-1].isspace():
+        partial = words.pop()
+      if len(words) >= chunk_words:
+        yield words
+        words = []
+    if partial:
+      words.append(partial)
+    if words:
+      yield words
 
 
-def _build_vocab(filename):
-  data = _read_words(filename)
+def _read_words(filename):
+  return [word for words in _read_word_chunks(filename) for word in words]
+
 
-  counter = collections.Counter(data)
+def _build_vocab(filename):
+  counter = collections.Counter()
+  for words in _read_word_chunks(filename):
+    counter.update(words)
   count_pairs = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
 
   words, _ = list(zip(*count_pairs))
@@ -42,12 +71,76 @@ def _build_vocab(filename):
   return word_to_id
 
 
-def _file_to_word_ids(filename, word_to_id):
-  data = _read_words(filename)
-  return [word_to_id[word] for word in data if word in word_to_id]
+def _file_to_word_ids(filename, word_to_id, ids_path=None):
+  """Converts the words of a file that are in word_to_id to their ids.
 
+  Args:
+    filename: path of the text file.
+    word_to_id: dict of the vocabulary.
+    ids_path: optional path of a local file to write the ids to.
 
-def ptb_raw_data(data_path=None):
+  Returns:
+    an int32 numpy array of the ids, memory-mapped from ids_path if it is set.
+  """
+  chunks = []
+  ids_file = open(ids_path + ".tmp", "wb") if ids_path else None
+  for words in _read_word_chunks(filename):
+    ids = np.fromiter(
+        (word_to_id[word] for word in words if word in word_to_id),
+        dtype=np.int32)
+    if ids_file:
+      ids.tofile(ids_file)
+    else:
+      chunks.append(ids)
+  if not ids_file:
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+  ids_file.close()
+  os.rename(ids_path + ".tmp", ids_path)
+  return _load_word_ids(ids_path)
+
+
+def _load_word_ids(ids_path):
+  if os.path.getsize(ids_path) == 0:
+    return np.zeros(0, dtype=np.int32)
+  return np.memmap(ids_path, dtype=np.int32, mode="r")
+
+
+def _cached_raw_data(paths, cache_path):
+  """ptb_raw_data with the vocabulary and word ids cached in cache_path.
+
+  The cache files are keyed by the paths, sizes and modification times of the
+  text files, so the text files are only read again when they change.
+  """
+  stats = [(path, tf.gfile.Stat(path).length, tf.gfile.Stat(path).mtime_nsec)
+           for path in paths]
+  prefix = os.path.join(
+      cache_path, "ptb.%s" % hashlib.md5(repr(stats).encode()).hexdigest())
+  vocab_path = prefix + ".vocab"
+  ids_paths = [prefix + ".%d.ids" % i for i in range(len(paths))]
+  if not os.path.isdir(cache_path):
+    os.makedirs(cache_path)
+
+  if os.path.exists(vocab_path):
+    with open(vocab_path, "rb") as f:
+      words = f.read().decode("utf-8").split("\n")[:-1]
+    word_to_id = dict(zip(words, range(len(words))))
+  else:
+    word_to_id = _build_vocab(paths[0])
+    words = sorted(word_to_id, key=word_to_id.get)
+    with open(vocab_path + ".tmp", "wb") as f:
+      f.write("".join(word + "\n" for word in words).encode("utf-8"))
+    os.rename(vocab_path + ".tmp", vocab_path)
+
+  data = []
+  for path, ids_path in zip(paths, ids_paths):
+    if os.path.exists(ids_path):
+      data.append(_load_word_ids(ids_path))
+    else:
+      data.append(_file_to_word_ids(path, word_to_id, ids_path))
+  return data + [len(word_to_id)]
+
+
+def ptb_raw_data(data_path=None, cache_path=None):
   """Load PTB raw data from data directory "data_path".
 
   Reads PTB text files, converts strings to integer ids,
@@ -60,16 +153,23 @@ def ptb_raw_data(data_path=None):
   Args:
     data_path: string path to the directory where simple-examples.tgz has
       been extracted.
+    cache_path: optional local directory where the vocabulary and the word
+      ids are cached, so that later calls do not read the text files.
 
   Returns:
     tuple (train_data, valid_data, test_data, vocabulary)
-    where each of the data objects can be passed to PTBIterator.
+    where each of the data objects can be passed to PTBIterator; they are
+    int32 numpy arrays, memory-mapped from the cache if cache_path is set.
   """
 
   train_path = os.path.join(data_path, "ptb.train.txt")
   valid_path = os.path.join(data_path, "ptb.valid.txt")
   test_path = os.path.join(data_path, "ptb.test.txt")
 
+  if cache_path:
+    return tuple(_cached_raw_data([train_path, valid_path, test_path],
+                                  cache_path))
+
   word_to_id = _build_vocab(train_path)
   train_data = _file_to_word_ids(train_path, word_to_id)
   valid_data = _file_to_word_ids(valid_path, word_to_id)
@@ -98,6 +198,8 @@ def ptb_producer(raw_data, batch_size, num_steps, name=None):
     tf.errors.InvalidArgumentError: if batch_size or num_steps are too high.
   """
   with tf.name_scope(name, "PTBProducer", [raw_data, batch_size, num_steps]):
+    if isinstance(raw_data, np.memmap):
+      return _memmap_producer(raw_data, batch_size, num_steps)
     raw_data = tf.convert_to_tensor(raw_data, name="raw_data", dtype=tf.int32)
 
     data_len = tf.size(raw_data)
@@ -120,3 +222,31 @@ def ptb_producer(raw_data, batch_size, num_steps, name=None):
                          [batch_size, (i + 1) * num_steps + 1])
     y.set_shape([batch_size, num_steps])
     return x, y
+
+
+def _memmap_producer(raw_data, batch_size, num_steps):
+  """ptb_producer for memory-mapped raw data.
+
+  The data is not copied into the graph, each batch is sliced from the memmap
+  by a py_func when it is dequeued.
+  """
+  batch_len = len(raw_data) // batch_size
+  data = raw_data[0 : batch_size * batch_len].reshape([batch_size, batch_len])
+
+  epoch_size = tf.constant((batch_len - 1) // num_steps)
+  assertion = tf.assert_positive(
+      epoch_size,
+      message="epoch_size == 0, decrease batch_size or num_steps")
+  with tf.control_dependencies([assertion]):
+    epoch_size = tf.identity(epoch_size, name="epoch_size")
+
+  def slice_batch(i):
+    start = i * num_steps
+    return (np.array(data[:, start : start + num_steps]),
+            np.array(data[:, start + 1 : start + num_steps + 1]))
+
+  i = tf.train.range_input_producer(epoch_size, shuffle=False).dequeue()
+  x, y = tf.py_func(slice_batch, [i], [tf.int32, tf.int32], stateful=False)
+  x.set_shape([batch_size, num_steps])
+  y.set_shape([batch_size, num_steps])
+  return x, y
@@ -21,6 +21,7 @@ from __future__ import print_function
 
 import os.path
 
+import numpy as np
 import tensorflow as tf
 
 import reader
@@ -44,8 +45,35 @@ class PtbReaderTest(tf.test.TestCase):
     output = reader.ptb_raw_data(tmpdir)
     self.assertEqual(len(output), 4)
 
+  def testPtbRawDataCache(self):
+    tmpdir = tf.test.get_temp_dir()
+    for suffix in "train", "valid", "test":
+      filename = os.path.join(tmpdir, "ptb.%s.txt" % suffix)
+      with tf.gfile.GFile(filename, "w") as fh:
+        fh.write(self._string_data)
+    cache_path = os.path.join(tmpdir, "cache")
+    output = reader.ptb_raw_data(tmpdir)
+    cached_output = reader.ptb_raw_data(tmpdir, cache_path)
+    reloaded_output = reader.ptb_raw_data(tmpdir, cache_path)
+    self.assertEqual(output[3], cached_output[3])
+    self.assertEqual(output[3], reloaded_output[3])
+    for i in range(3):
+      self.assertAllEqual(output[i], cached_output[i])
+      self.assertAllEqual(output[i], reloaded_output[i])
+      self.assertTrue(isinstance(reloaded_output[i], np.memmap))
+
   def testPtbProducer(self):
     raw_data = [4, 3, 2, 1, 0, 5, 6, 1, 1, 1, 1, 0, 3, 4, 1]
+    self._testPtbProducer(raw_data)
+
+  def testPtbProducerMemmap(self):
+    filename = os.path.join(tf.test.get_temp_dir(), "ptb.ids")
+    raw_data = np.memmap(filename, dtype=np.int32, mode="w+", shape=[15])
+    raw_data[:] = [4, 3, 2, 1, 0, 5, 6, 1, 1, 1, 1, 0, 3, 4, 1]
+    raw_data.flush()
+    self._testPtbProducer(np.memmap(filename, dtype=np.int32, mode="r"))
+
+  def _testPtbProducer(self, raw_data):
     batch_size = 3
     num_steps = 2
     x, y = reader.ptb_producer(raw_data, batch_size, num_steps)
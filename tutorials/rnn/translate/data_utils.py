@@ -18,12 +18,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
 import gzip
+import io
 import os
 import re
 import tarfile
 
+import numpy as np
 from six.moves import urllib
+from six.moves import xrange  # pylint: disable=redefined-builtin
 
 from tensorflow.python.platform import gfile
 import tensorflow as tf
@@ -219,7 +223,8 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
 
   This function loads data line-by-line from data_path, calls the above
   sentence_to_token_ids, and saves the result to target_path. See comment
-  for sentence_to_token_ids on the details of token-ids format.
+  for sentence_to_token_ids on the details of token-ids format. The token-ids
+  are also packed into a binary file, see pack_token_ids.
 
   Args:
     data_path: path to the data file in one-sentence-per-line format.
@@ -232,6 +237,8 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
   if not gfile.Exists(target_path):
     print("Tokenizing data in %s" % data_path)
     vocab, _ = initialize_vocabulary(vocabulary_path)
+    tokens = array.array("i")
+    lengths = []
     with gfile.GFile(data_path, mode="rb") as data_file:
       with gfile.GFile(target_path, mode="w") as tokens_file:
         counter = 0
@@ -242,6 +249,184 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
           token_ids = sentence_to_token_ids(tf.compat.as_bytes(line), vocab,
                                             tokenizer, normalize_digits)
           tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
+          tokens.extend(token_ids)
+          lengths.append(len(token_ids))
+    _write_packed_token_ids(packed_token_ids_path(target_path),
+                            np.frombuffer(tokens, dtype=np.int32), lengths)
+  elif not gfile.Exists(packed_token_ids_path(target_path)):
+    pack_token_ids(target_path)
+
+
+def packed_token_ids_path(token_ids_path):
+  """Path of the binary file that pack_token_ids creates for token_ids_path."""
+  return token_ids_path + ".npz"
+
+
+def pack_sequences(sequences):
+  """Packs a list of sequences of token-ids into flat tokens and offsets.
+
+  Args:
+    sequences: a list of lists of token-ids.
+
+  Returns:
+    a pair: the int32 token-ids of all sequences, one after the other, and the
+    int64 offsets of the sequences in them, with a final offset at the end, so
+    that sequence i is tokens[offsets[i]:offsets[i + 1]].
+  """
+  tokens = np.fromiter((tok for sequence in sequences for tok in sequence),
+                       dtype=np.int32)
+  return tokens, _offsets_from_lengths([len(s) for s in sequences])
+
+
+def _offsets_from_lengths(lengths):
+  offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+  np.cumsum(lengths, out=offsets[1:])
+  return offsets
+
+
+def _write_packed_token_ids(path, tokens, lengths):
+  buf = io.BytesIO()
+  np.savez(buf, tokens=tokens, offsets=_offsets_from_lengths(lengths))
+  with gfile.GFile(path, mode="wb") as f:
+    f.write(buf.getvalue())
+
+
+def pack_token_ids(token_ids_path):
+  """Packs a file of token-ids into a binary file, see pack_sequences.
+
+  The binary file is written to packed_token_ids_path(token_ids_path), so the
+  token-ids can be loaded by load_token_ids without parsing them again.
+
+  Args:
+    token_ids_path: path to a file with space-separated token-ids, one
+      sentence per line.
+  """
+  print("Packing token-ids in %s" % token_ids_path)
+  tokens = array.array("i")
+  lengths = []
+  with gfile.GFile(token_ids_path, mode="r") as f:
+    for line in f:
+      token_ids = [int(x) for x in line.split()]
+      tokens.extend(token_ids)
+      lengths.append(len(token_ids))
+  _write_packed_token_ids(packed_token_ids_path(token_ids_path),
+                          np.frombuffer(tokens, dtype=np.int32), lengths)
+
+
+def load_token_ids(token_ids_path):
+  """Loads the packed token-ids of a file, packing the file if needed.
+
+  Args:
+    token_ids_path: path to a file with space-separated token-ids, one
+      sentence per line.
+
+  Returns:
+    a pair of flat tokens and offsets, see pack_sequences.
+  """
+  if not gfile.Exists(packed_token_ids_path(token_ids_path)):
+    pack_token_ids(token_ids_path)
+  with gfile.GFile(packed_token_ids_path(token_ids_path), mode="rb") as f:
+    packed = np.load(io.BytesIO(f.read()))
+    return packed["tokens"], packed["offsets"]
+
+
+def _gather_sequences(tokens, offsets, indices, end_id=None):
+  """Packs the sequences at indices of packed tokens and offsets, with end_id
+  appended to each sequence if it is not None."""
+  starts = offsets[indices]
+  lengths = offsets[indices + 1] - starts
+  new_offsets = _offsets_from_lengths(lengths + (end_id is not None))
+  new_tokens = np.empty(new_offsets[-1], dtype=np.int32)
+  # Position of each gathered token in its sequence.
+  within = (np.arange(np.sum(lengths)) -
+            np.repeat(np.cumsum(lengths) - lengths, lengths))
+  new_tokens[np.repeat(new_offsets[:-1], lengths) + within] = tokens[
+      np.repeat(starts, lengths) + within]
+  if end_id is not None:
+    new_tokens[new_offsets[1:] - 1] = end_id
+  return new_tokens, new_offsets
+
+
+class BucketedTokenIds(object):
+  """Pairs of source and target token-ids packed per bucket.
+
+  Each bucket holds the pairs whose source is shorter than its input size and
+  whose target, with EOS_ID appended, is shorter than its output size, and
+  that do not fit into an earlier bucket. The sources and targets of a bucket
+  are packed into flat tokens and offsets, see pack_sequences, in the order of
+  the pairs in the data.
+  """
+
+  def __init__(self, source, target, buckets, max_size=None):
+    """Buckets packed sources and their aligned targets.
+
+    Args:
+      source: a pair of flat tokens and offsets of the source sentences.
+      target: a pair of flat tokens and offsets of the target sentences;
+        the n-th target is the desired output for the n-th source.
+      buckets: a list of pairs (I, O) of input and output sizes.
+      max_size: maximum number of pairs to use, all other will be ignored;
+        if 0 or None, all pairs are used.
+    """
+    self.buckets = buckets
+    source_tokens, source_offsets = source
+    target_tokens, target_offsets = target
+    num_pairs = min(len(source_offsets), len(target_offsets)) - 1
+    if max_size:
+      num_pairs = min(num_pairs, max_size)
+    source_lengths = np.diff(source_offsets[:num_pairs + 1])
+    target_lengths = np.diff(target_offsets[:num_pairs + 1]) + 1
+    pair_buckets = np.full(num_pairs, -1, dtype=np.int32)
+    for bucket_id in reversed(xrange(len(buckets))):
+      source_size, target_size = buckets[bucket_id]
+      pair_buckets[np.logical_and(source_lengths < source_size,
+                                  target_lengths < target_size)] = bucket_id
+    self.sources = []
+    self.targets = []
+    for bucket_id in xrange(len(buckets)):
+      pairs = np.flatnonzero(pair_buckets == bucket_id)
+      self.sources.append(
+          _gather_sequences(source_tokens, source_offsets, pairs))
+      self.targets.append(
+          _gather_sequences(target_tokens, target_offsets, pairs, EOS_ID))
+
+  def bucket_size(self, bucket_id):
+    """Number of pairs in a bucket."""
+    return len(self.sources[bucket_id][1]) - 1
+
+  def num_tokens(self, bucket_id, indices):
+    """Number of source and target tokens of the pairs at indices of a bucket,
+    including the EOS_ID appended to the targets."""
+    source_offsets = self.sources[bucket_id][1]
+    target_offsets = self.targets[bucket_id][1]
+    return int(np.sum(source_offsets[indices + 1] - source_offsets[indices]) +
+               np.sum(target_offsets[indices + 1] - target_offsets[indices]))
+
+  def pad(self, bucket_id, indices, positions, target=False, out=None):
+    """Gathers tokens of the pairs at indices of a bucket into an array.
+
+    Args:
+      bucket_id: the bucket of the pairs.
+      indices: int vector of the indices of the pairs in the bucket.
+      positions: int vector of the positions in the sequences to gather.
+      target: whether to gather from the targets instead of the sources.
+      out: optional int32 array of shape [len(positions), len(indices)] to
+        gather into.
+
+    Returns:
+      an int32 array in which [p, b] is the token at positions[p] of the b-th
+      pair, or PAD_ID if the sequence is shorter; it is out if given.
+    """
+    tokens, offsets = (self.targets if target else self.sources)[bucket_id]
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    valid = positions[:, None] < lengths[None, :]
+    gather = np.where(valid, starts[None, :] + positions[:, None], 0)
+    if out is None:
+      out = np.empty(gather.shape, dtype=np.int32)
+    np.take(tokens, gather, out=out)
+    out[np.logical_not(valid)] = PAD_ID
+    return out
 
 
 def prepare_wmt_data(data_dir, en_vocabulary_size, fr_vocabulary_size, tokenizer=None):
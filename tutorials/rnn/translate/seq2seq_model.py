@@ -56,7 +56,8 @@ class Seq2SeqModel(object):
                use_lstm=False,
                num_samples=512,
                forward_only=False,
-               dtype=tf.float32):
+               dtype=tf.float32,
+               beam_search=False):
     """Create the model.
 
     Args:
@@ -79,6 +80,8 @@ class Seq2SeqModel(object):
       num_samples: number of samples for sampled softmax.
       forward_only: if set, we do not construct the backward pass in the model.
       dtype: the data type to use to store internal variables.
+      beam_search: if set with forward_only, the decoder can also be fed the
+        decoder inputs instead of its previous outputs, for beam_search(...).
     """
     self.source_vocab_size = source_vocab_size
     self.target_vocab_size = target_vocab_size
@@ -158,11 +161,20 @@ class Seq2SeqModel(object):
     targets = [self.decoder_inputs[i + 1]
                for i in xrange(len(self.decoder_inputs) - 1)]
 
+    # Decoding feeds the previous outputs to the decoder, unless beam search
+    # feeds it the hypotheses that it extends.
+    self.feed_previous = None
+    if forward_only and beam_search:
+      self.feed_previous = tf.placeholder_with_default(
+          True, shape=[], name="feed_previous")
+
     # Training outputs and losses.
     if forward_only:
+      feed_previous = True if self.feed_previous is None else self.feed_previous
       self.outputs, self.losses = tf.contrib.legacy_seq2seq.model_with_buckets(
           self.encoder_inputs, self.decoder_inputs, targets,
-          self.target_weights, buckets, lambda x, y: seq2seq_f(x, y, True),
+          self.target_weights, buckets,
+          lambda x, y: seq2seq_f(x, y, feed_previous),
           softmax_loss_function=softmax_loss_function)
       # If we use output projection, we need to project outputs for decoding.
       if output_projection is not None:
@@ -263,13 +275,16 @@ class Seq2SeqModel(object):
 
     Args:
       data: a tuple of size len(self.buckets) in which each element contains
-        lists of pairs of input and output data that we use to create a batch.
+        lists of pairs of input and output data that we use to create a batch,
+        or a data_utils.BucketedTokenIds, see get_packed_batch.
       bucket_id: integer, which bucket to get the batch for.
 
     Returns:
       The triple (encoder_inputs, decoder_inputs, target_weights) for
       the constructed batch that has the proper format to call step(...) later.
     """
+    if isinstance(data, data_utils.BucketedTokenIds):
+      return self.get_packed_batch(data, bucket_id)
     encoder_size, decoder_size = self.buckets[bucket_id]
     encoder_inputs, decoder_inputs = [], []
 
@@ -313,3 +328,132 @@ class Seq2SeqModel(object):
           batch_weight[batch_idx] = 0.0
       batch_weights.append(batch_weight)
     return batch_encoder_inputs, batch_decoder_inputs, batch_weights
+
+  def get_packed_batch(self, data, bucket_id, indices=None, out=None):
+    """Get a batch of packed data from the specified bucket, prepare for step.
+
+    This is get_batch for data_utils.BucketedTokenIds: each input is gathered
+    for the whole batch at once into a time-major array, whose rows are the
+    batch-major vectors that step(...) feeds.
+
+    Args:
+      data: a data_utils.BucketedTokenIds, bucketed like this model.
+      bucket_id: integer, which bucket to get the batch for.
+      indices: int vector of batch_size indices of the pairs of the bucket to
+        put in the batch; if None, random pairs are picked.
+      out: optional triple of arrays returned by an earlier call for the same
+        bucket, which are filled instead of allocating new arrays.
+
+    Returns:
+      The triple (encoder_inputs, decoder_inputs, target_weights) of arrays of
+      shapes [encoder_size, batch_size], [decoder_size, batch_size] and
+      [decoder_size, batch_size], to call step(...) with.
+    """
+    encoder_size, decoder_size = self.buckets[bucket_id]
+    if indices is None:
+      indices = np.random.randint(data.bucket_size(bucket_id),
+                                  size=self.batch_size)
+    if out is None:
+      out = (np.empty([encoder_size, self.batch_size], dtype=np.int32),
+             np.empty([decoder_size, self.batch_size], dtype=np.int32),
+             np.empty([decoder_size, self.batch_size], dtype=np.float32))
+    encoder_inputs, decoder_inputs, target_weights = out
+
+    # Encoder inputs are padded and then reversed.
+    data.pad(bucket_id, indices, np.arange(encoder_size - 1, -1, -1),
+             out=encoder_inputs)
+
+    # Decoder inputs get an extra "GO" symbol, and are padded then.
+    decoder_inputs[0] = data_utils.GO_ID
+    data.pad(bucket_id, indices, np.arange(decoder_size - 1), target=True,
+             out=decoder_inputs[1:])
+
+    # Target weights are 0 for targets that are padding; the target is the
+    # decoder input shifted by 1 forward.
+    np.not_equal(decoder_inputs[1:], data_utils.PAD_ID,
+                 out=target_weights[:-1])
+    target_weights[-1] = 0.0
+    return encoder_inputs, decoder_inputs, target_weights
+
+  def beam_search(self, session, encoder_inputs, bucket_id, beam_size):
+    """Decode a batch of sentences with beam search.
+
+    The model must be built with forward_only and beam_search. Each decoding
+    position runs the model on the beam_size best hypotheses of each sentence,
+    fed as decoder inputs, and keeps the beam_size best extensions by total
+    log-probability. Hypotheses that reached EOS are only extended by PAD.
+
+    Args:
+      session: tensorflow session to use.
+      encoder_inputs: int array of shape [encoder_size, batch_size //
+        beam_size], the encoder inputs of the sentences, as for step(...).
+      bucket_id: which bucket of the model to use.
+      beam_size: number of hypotheses kept for each sentence.
+
+    Returns:
+      An int array of shape [decoder_size, batch_size // beam_size] with the
+      outputs of the best hypothesis of each sentence.
+
+    Raises:
+      ValueError: if the model was not built for beam search, or if the
+        encoder_inputs do not have beam_size times fewer sentences than
+        batch_size.
+    """
+    if self.feed_previous is None:
+      raise ValueError("The model was not built for beam search.")
+    encoder_size, decoder_size = self.buckets[bucket_id]
+    num_sentences = len(encoder_inputs[0])
+    if num_sentences * beam_size != self.batch_size:
+      raise ValueError("Beams of %d sentences must fill the batch, %d != %d."
+                       % (num_sentences, num_sentences * beam_size,
+                          self.batch_size))
+
+    # Each sentence is decoded in beam_size consecutive rows of the batch.
+    input_feed = {self.feed_previous: False}
+    encoder_inputs = np.repeat(encoder_inputs, beam_size, axis=1)
+    for l in xrange(encoder_size):
+      input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+    weights = np.zeros([self.batch_size], dtype=np.float32)
+    for l in xrange(decoder_size):
+      input_feed[self.target_weights[l].name] = weights
+    input_feed[self.decoder_inputs[decoder_size].name] = np.zeros(
+        [self.batch_size], dtype=np.int32)
+
+    # decoder_inputs[1:] are the hypotheses, only the first one is scored
+    # at the start so that the beams do not repeat it.
+    decoder_inputs = np.zeros([decoder_size + 1, self.batch_size],
+                              dtype=np.int32)
+    decoder_inputs[0] = data_utils.GO_ID
+    scores = np.full([num_sentences, beam_size], -np.inf)
+    scores[:, 0] = 0.0
+    finished = np.zeros([num_sentences, beam_size], dtype=bool)
+    sentences = np.arange(num_sentences)[:, None]
+    for position in xrange(decoder_size):
+      for l in xrange(decoder_size):
+        input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
+      logits = session.run(self.outputs[bucket_id][position], input_feed)
+      logits = logits.astype(np.float64)
+      logits -= np.max(logits, axis=1, keepdims=True)
+      log_probs = logits - np.log(np.sum(np.exp(logits), axis=1,
+                                         keepdims=True))
+      log_probs = log_probs.reshape([num_sentences, beam_size, -1])
+      log_probs[finished] = -np.inf
+      log_probs[finished, data_utils.PAD_ID] = 0.0
+      vocab_size = log_probs.shape[2]
+
+      # The beam_size best extensions of the hypotheses of each sentence,
+      # best first.
+      totals = (scores[:, :, None] + log_probs).reshape([num_sentences, -1])
+      best = np.argpartition(-totals, beam_size - 1, axis=1)[:, :beam_size]
+      best = best[sentences, np.argsort(-totals[sentences, best], axis=1)]
+      scores = totals[sentences, best]
+      beams = best // vocab_size
+      outputs = best % vocab_size
+      rows = (sentences * beam_size + beams).reshape([-1])
+      decoder_inputs[1:position + 1] = decoder_inputs[1:position + 1, rows]
+      decoder_inputs[position + 1] = outputs.reshape([-1])
+      finished = np.logical_or(finished[sentences, beams],
+                               outputs == data_utils.EOS_ID)
+      if np.all(finished):
+        break
+    return decoder_inputs[1:, ::beam_size]
@@ -20,7 +20,9 @@ the directory specified as --data_dir and tokenize it in a very basic way,
 and then start training a model saving checkpoints to --train_dir.
 
 Running with --decode starts an interactive loop so you can see how
-the current checkpoint translates English sentences into French.
+the current checkpoint translates English sentences into French. Running with
+--decode and --decode_input translates a file of sentences in batches into
+--decode_output, with beam search if --beam_size is more than 1.
 
 See the following papers for more information on neural translation models.
  * http://arxiv.org/abs/1409.3215
@@ -35,10 +37,12 @@ import math
 import os
 import random
 import sys
+import threading
 import time
 import logging
 
 import numpy as np
+from six.moves import queue
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
@@ -67,8 +71,18 @@ tf.app.flags.DEFINE_integer("max_train_data_size", 0,
                             "Limit on the size of training data (0: no limit).")
 tf.app.flags.DEFINE_integer("steps_per_checkpoint", 200,
                             "How many training steps to do per checkpoint.")
+tf.app.flags.DEFINE_integer("prefetch_batches", 2,
+                            "How many training batches to prepare ahead.")
 tf.app.flags.DEFINE_boolean("decode", False,
                             "Set to True for interactive decoding.")
+tf.app.flags.DEFINE_string("decode_input", "",
+                           "File of sentences to translate in batches, one "
+                           "per line, instead of decoding interactively.")
+tf.app.flags.DEFINE_string("decode_output", "/tmp/translations",
+                           "File to write the translations of decode_input to.")
+tf.app.flags.DEFINE_integer("beam_size", 1,
+                            "Beam size for decoding decode_input, 1 for "
+                            "greedy decoding.")
 tf.app.flags.DEFINE_boolean("self_test", False,
                             "Run a self-test if this is set to True.")
 tf.app.flags.DEFINE_boolean("use_fp16", False,
@@ -93,33 +107,66 @@ def read_data(source_path, target_path, max_size=None):
       if 0 or None, data files will be read completely (no limit).
 
   Returns:
-    data_set: a list of length len(_buckets); data_set[n] contains a list of
+    data_set: a data_utils.BucketedTokenIds whose n-th bucket contains the
       (source, target) pairs read from the provided data files that fit
       into the n-th bucket, i.e., such that len(source) < _buckets[n][0] and
-      len(target) < _buckets[n][1]; source and target are lists of token-ids.
+      len(target) < _buckets[n][1]; the targets end with EOS_ID. The token-ids
+      are loaded from the binary files that data_utils.data_to_token_ids
+      packs them into.
   """
-  data_set = [[] for _ in _buckets]
-  with tf.gfile.GFile(source_path, mode="r") as source_file:
-    with tf.gfile.GFile(target_path, mode="r") as target_file:
-      source, target = source_file.readline(), target_file.readline()
-      counter = 0
-      while source and target and (not max_size or counter < max_size):
-        counter += 1
-        if counter % 100000 == 0:
-          print("  reading data line %d" % counter)
-          sys.stdout.flush()
-        source_ids = [int(x) for x in source.split()]
-        target_ids = [int(x) for x in target.split()]
-        target_ids.append(data_utils.EOS_ID)
-        for bucket_id, (source_size, target_size) in enumerate(_buckets):
-          if len(source_ids) < source_size and len(target_ids) < target_size:
-            data_set[bucket_id].append([source_ids, target_ids])
-            break
-        source, target = source_file.readline(), target_file.readline()
-  return data_set
+  return data_utils.BucketedTokenIds(data_utils.load_token_ids(source_path),
+                                     data_utils.load_token_ids(target_path),
+                                     _buckets, max_size)
+
+
+def prefetch_batches(model, data_set, buckets_scale):
+  """Yields training batches, prepared by a background thread.
 
+  Buckets are picked at random according to buckets_scale, and batches are
+  gathered by model.get_packed_batch into FLAGS.prefetch_batches + 2 sets of
+  arrays per bucket, which are reused once step(...) is done with them.
 
-def create_model(session, forward_only):
+  Yields:
+    quadruples (bucket_id, encoder_inputs, decoder_inputs, target_weights) and
+    the number of source and target tokens in the batch.
+  """
+  batches = queue.Queue(max(FLAGS.prefetch_batches, 1))
+  num_buffers = FLAGS.prefetch_batches + 2
+  buffers = [[None] * num_buffers for _ in _buckets]
+  counts = [0] * len(_buckets)
+
+  def produce():
+    try:
+      while True:
+        # Choose a bucket according to data distribution. We pick a random
+        # number in [0, 1] and use the corresponding interval in
+        # buckets_scale.
+        random_number_01 = np.random.random_sample()
+        bucket_id = min([i for i in xrange(len(buckets_scale))
+                         if buckets_scale[i] > random_number_01])
+        indices = np.random.randint(data_set.bucket_size(bucket_id),
+                                    size=model.batch_size)
+        slot = counts[bucket_id] % num_buffers
+        counts[bucket_id] += 1
+        buffers[bucket_id][slot] = model.get_packed_batch(
+            data_set, bucket_id, indices, out=buffers[bucket_id][slot])
+        batches.put(((bucket_id,) + buffers[bucket_id][slot],
+                     data_set.num_tokens(bucket_id, indices)))
+    except Exception as e:  # pylint: disable=broad-except
+      # Hand the error to the training loop, which would wait forever.
+      batches.put(e)
+
+  thread = threading.Thread(target=produce)
+  thread.daemon = True
+  thread.start()
+  while True:
+    batch = batches.get()
+    if isinstance(batch, Exception):
+      raise batch
+    yield batch
+
+
+def create_model(session, forward_only, beam_search=False):
   """Create translation model and initialize or load parameters in session."""
   dtype = tf.float16 if FLAGS.use_fp16 else tf.float32
   model = seq2seq_model.Seq2SeqModel(
@@ -133,7 +180,8 @@ def create_model(session, forward_only):
       FLAGS.learning_rate,
       FLAGS.learning_rate_decay_factor,
       forward_only=forward_only,
-      dtype=dtype)
+      dtype=dtype,
+      beam_search=beam_search)
   ckpt = tf.train.get_checkpoint_state(FLAGS.train_dir)
   if ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
     print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
@@ -182,7 +230,8 @@ def train():
            % FLAGS.max_train_data_size)
     dev_set = read_data(from_dev, to_dev)
     train_set = read_data(from_train, to_train, FLAGS.max_train_data_size)
-    train_bucket_sizes = [len(train_set[b]) for b in xrange(len(_buckets))]
+    train_bucket_sizes = [train_set.bucket_size(b)
+                          for b in xrange(len(_buckets))]
     train_total_size = float(sum(train_bucket_sizes))
 
     # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
@@ -190,35 +239,34 @@ def train():
     # the size if i-th training bucket, as used later.
     train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
                            for i in xrange(len(train_bucket_sizes))]
+    train_batches = prefetch_batches(model, train_set, train_buckets_scale)
 
     # This is the training loop.
-    step_time, loss = 0.0, 0.0
+    step_time, loss, num_tokens = 0.0, 0.0, 0
     current_step = 0
     previous_losses = []
     while True:
-      # Choose a bucket according to data distribution. We pick a random number
-      # in [0, 1] and use the corresponding interval in train_buckets_scale.
-      random_number_01 = np.random.random_sample()
-      bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                       if train_buckets_scale[i] > random_number_01])
-
-      # Get a batch and make a step.
+      # Get a prefetched batch and make a step.
       start_time = time.time()
-      encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-          train_set, bucket_id)
+      (bucket_id, encoder_inputs, decoder_inputs,
+       target_weights), batch_tokens = next(train_batches)
       _, step_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
                                    target_weights, bucket_id, False)
       step_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
       loss += step_loss / FLAGS.steps_per_checkpoint
+      num_tokens += batch_tokens
       current_step += 1
 
       # Once in a while, we save checkpoint, print statistics, and run evals.
       if current_step % FLAGS.steps_per_checkpoint == 0:
         # Print statistics for the previous epoch.
         perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
-        print ("global step %d learning rate %.4f step-time %.2f perplexity "
-               "%.2f" % (model.global_step.eval(), model.learning_rate.eval(),
-                         step_time, perplexity))
+        print ("global step %d learning rate %.4f step-time %.2f tokens/sec "
+               "%.0f perplexity %.2f" % (
+                   model.global_step.eval(), model.learning_rate.eval(),
+                   step_time, num_tokens / (step_time *
+                                            FLAGS.steps_per_checkpoint),
+                   perplexity))
         # Decrease learning rate if no improvement was seen over last 3 times.
         if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
           sess.run(model.learning_rate_decay_op)
@@ -226,10 +274,10 @@ def train():
         # Save checkpoint and zero timer and loss.
         checkpoint_path = os.path.join(FLAGS.train_dir, "translate.ckpt")
         model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-        step_time, loss = 0.0, 0.0
+        step_time, loss, num_tokens = 0.0, 0.0, 0
         # Run evals on development set and print their perplexity.
         for bucket_id in xrange(len(_buckets)):
-          if len(dev_set[bucket_id]) == 0:
+          if dev_set.bucket_size(bucket_id) == 0:
             print("  eval: empty bucket %d" % (bucket_id))
             continue
           encoder_inputs, decoder_inputs, target_weights = model.get_batch(
@@ -290,6 +338,102 @@ def decode():
       sentence = sys.stdin.readline()
 
 
+def decode_batch(session, model, batch, bucket_id, beam_size=1):
+  """Translate a batch of token-id lists that fit in bucket bucket_id.
+
+  Args:
+    session: tensorflow session to use.
+    model: forward-only Seq2SeqModel, built for beam search if beam_size > 1.
+    batch: list of at most model.batch_size // beam_size token-id lists.
+    bucket_id: which bucket of the model to use.
+    beam_size: number of hypotheses kept for each sentence; with 1, the
+      outputs are decoded greedily.
+
+  Returns:
+    A list with the output token-ids of each sentence, cut at their first EOS.
+  """
+  encoder_size, decoder_size = model.buckets[bucket_id]
+  # Encoder inputs are padded and then reversed, the batch is filled up with
+  # empty sentences.
+  encoder_inputs = np.full([encoder_size, model.batch_size // beam_size],
+                           data_utils.PAD_ID, dtype=np.int32)
+  for i, token_ids in enumerate(batch):
+    encoder_inputs[encoder_size - len(token_ids):, i] = token_ids[::-1]
+  if beam_size > 1:
+    outputs = model.beam_search(session, encoder_inputs, bucket_id, beam_size)
+  else:
+    decoder_inputs = np.zeros([decoder_size, model.batch_size], dtype=np.int32)
+    decoder_inputs[0] = data_utils.GO_ID
+    target_weights = np.zeros([decoder_size, model.batch_size],
+                              dtype=np.float32)
+    _, _, output_logits = model.step(session, encoder_inputs, decoder_inputs,
+                                     target_weights, bucket_id, True)
+    # This is a greedy decoder - outputs are just argmaxes of output_logits.
+    outputs = np.argmax(np.array(output_logits), axis=2)
+  # Cut the outputs at their first EOS symbol.
+  is_eos = outputs == data_utils.EOS_ID
+  lengths = np.where(np.any(is_eos, axis=0), np.argmax(is_eos, axis=0),
+                     decoder_size)
+  return [outputs[:lengths[i], i].tolist() for i in xrange(len(batch))]
+
+
+def decode_file():
+  """Translate the sentences of FLAGS.decode_input into FLAGS.decode_output.
+
+  Sentences are grouped by bucket and translated a full batch at a time, or
+  FLAGS.batch_size // FLAGS.beam_size sentences at a time with beam search.
+  The translations are written in the order of the input sentences.
+  """
+  with tf.Session() as sess:
+    # Create model and load parameters.
+    beam_size = max(FLAGS.beam_size, 1)
+    model = create_model(sess, True, beam_search=beam_size > 1)
+    sentences_per_batch = max(model.batch_size // beam_size, 1)
+    model.batch_size = sentences_per_batch * beam_size
+
+    # Load vocabularies.
+    en_vocab_path = os.path.join(FLAGS.data_dir,
+                                 "vocab%d.from" % FLAGS.from_vocab_size)
+    fr_vocab_path = os.path.join(FLAGS.data_dir,
+                                 "vocab%d.to" % FLAGS.to_vocab_size)
+    en_vocab, _ = data_utils.initialize_vocabulary(en_vocab_path)
+    _, rev_fr_vocab = data_utils.initialize_vocabulary(fr_vocab_path)
+    rev_fr_vocab = np.array(rev_fr_vocab, dtype=object)
+
+    # Group the token-ids of the sentences by bucket.
+    bucketed = [[] for _bucket in _buckets]
+    num_sentences = 0
+    with tf.gfile.GFile(FLAGS.decode_input, mode="rb") as input_file:
+      for sentence in input_file:
+        token_ids = data_utils.sentence_to_token_ids(
+            tf.compat.as_bytes(sentence), en_vocab)
+        bucket_id = len(_buckets) - 1
+        for i, bucket in enumerate(_buckets):
+          if bucket[0] >= len(token_ids):
+            bucket_id = i
+            break
+        else:
+          logging.warning("Sentence truncated: %s", sentence)
+          token_ids = token_ids[:_buckets[-1][0]]
+        bucketed[bucket_id].append((num_sentences, token_ids))
+        num_sentences += 1
+
+    translations = [b""] * num_sentences
+    for bucket_id, sentences in enumerate(bucketed):
+      for start in xrange(0, len(sentences), sentences_per_batch):
+        sentence_ids, batch = zip(*sentences[start:start + sentences_per_batch])
+        outputs = decode_batch(sess, model, batch, bucket_id, beam_size)
+        for sentence_id, output in zip(sentence_ids, outputs):
+          translations[sentence_id] = b" ".join(rev_fr_vocab[output])
+      print("  translated %d sentences of bucket %d" % (len(sentences),
+                                                        bucket_id))
+
+    with tf.gfile.GFile(FLAGS.decode_output, mode="wb") as output_file:
+      for translation in translations:
+        output_file.write(translation + b"\n")
+    print("Wrote %d translations to %s" % (num_sentences, FLAGS.decode_output))
+
+
 def self_test():
   """Test the translation model."""
   with tf.Session() as sess:
@@ -309,10 +453,47 @@ def self_test():
       model.step(sess, encoder_inputs, decoder_inputs, target_weights,
                  bucket_id, False)
 
+    # Fake data set packed into the same buckets, EOS_ID is appended to the
+    # targets.
+    sources = [[1, 1], [3, 3], [5], [1, 1, 1, 1], [3, 3, 3]]
+    targets = [[2], [4], [6], [2, 2, 2, 2], [5, 6]]
+    packed_set = data_utils.BucketedTokenIds(
+        data_utils.pack_sequences(sources), data_utils.pack_sequences(targets),
+        [(3, 3), (6, 6)])
+    for _ in xrange(5):  # Train the fake model for 5 more steps.
+      bucket_id = random.choice([0, 1])
+      encoder_inputs, decoder_inputs, target_weights = model.get_batch(
+          packed_set, bucket_id)
+      model.step(sess, encoder_inputs, decoder_inputs, target_weights,
+                 bucket_id, False)
+
+  with tf.Graph().as_default(), tf.Session() as sess:
+    # Create a forward-only model for beam search with batches of 4.
+    model = seq2seq_model.Seq2SeqModel(10, 10, [(3, 3), (6, 6)], 32, 2,
+                                       5.0, 4, 0.3, 0.99, num_samples=8,
+                                       forward_only=True, beam_search=True)
+    sess.run(tf.global_variables_initializer())
+
+    # Decode fake sentences of both buckets, greedily a full batch at a time
+    # and with beams of 2 for 2 sentences at a time.
+    batches = [[[1, 1], [3, 3], [5]], [[1, 1, 1, 1], [3, 3, 3]]]
+    for bucket_id, batch in enumerate(batches):
+      decoder_size = model.buckets[bucket_id][1]
+      for beam_size in [1, 2]:
+        for start in xrange(0, len(batch), model.batch_size // beam_size):
+          outputs = decode_batch(
+              sess, model, batch[start:start + model.batch_size // beam_size],
+              bucket_id, beam_size)
+          for output in outputs:
+            assert len(output) <= decoder_size
+            assert data_utils.EOS_ID not in output
+
 
 def main(_):
   if FLAGS.self_test:
     self_test()
+  elif FLAGS.decode and FLAGS.decode_input:
+    decode_file()
   elif FLAGS.decode:
     decode()
   else: